@@ -1,7 +1,21 @@
-import numpy as np
+from hindemith.core import compose
+from hindemith.operations.reduce import Sum
+
+
+@compose
+def hm_loss(top, top_diff):
+    loss = Sum(top * top_diff)
+    return loss
 
 
 class Layer(object):
+    def precompile(self, backward=False):
+        """
+        Build the kernels used by forward (and backward) ahead of the first
+        call, layers without composed functions have nothing to build.
+        """
+        pass
+
     def update_params(self, rate, weight_decay, momentum):
         pass
 
@@ -9,8 +23,9 @@ class Layer(object):
         self.forward()
         loss = 0
         if hasattr(self, 'top') and hasattr(self, 'top_diff'):
-            self.top.sync_host()
-            self.top_diff.sync_host()
-            for i in range(self.top.shape[0]):
-                loss += np.sum(self.top[i] * self.top_diff[i])
+            # The product is reduced on the device, only the sum is read
+            # back
+            total = hm_loss(self.top, self.top_diff)
+            total.sync_host()
+            loss = float(total[0])
         return loss
@@ -74,6 +74,16 @@ class ConvLayer(Layer):
         self.top_diff = hmarray.zeros(top_shape)
         return [(self.top, self.top_diff)]
 
+    def precompile(self, backward=False):
+        self.hm_forward.precompile(self.top, self.bottom, self.weights,
+                                   self.bias, self.kernel_size, self.padding,
+                                   self.stride)
+        if backward and self.bottom_diff is not None:
+            self.hm_backward.precompile(
+                self.bottom_diff, self.bottom, self.top_diff, self.weights,
+                self.weights_diff, self.bias_diff, self.kernel_size,
+                self.padding, self.stride)
+
     def forward(self):
         self.hm_forward(self.top, self.bottom, self.weights, self.bias,
                         self.kernel_size, self.padding, self.stride)
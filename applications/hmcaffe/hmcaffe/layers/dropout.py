@@ -7,11 +7,14 @@ from hindemith.core import compose
 class DropoutLayer(Layer):
     def __init__(self, layer_param, phase):
         self.phase = phase
-        self.threshold = layer_param.dropout_param.dropout_ratio
+        self.scale = 1.0 / (1.0 - layer_param.dropout_param.dropout_ratio)
 
-        @compose
-        def hm_dropout(top, bottom, mask, threshold):
-            top = Dropout(bottom, mask, threshold=threshold)
+        # The scale is passed to the kernel when it runs, layers with
+        # different dropout ratios generate the same code and share its
+        # compiled program
+        @compose(runtime_constants=True)
+        def hm_dropout(top, bottom, mask, scale):
+            top = Dropout(bottom, mask, scale)
             return top
 
         self.hm_dropout = hm_dropout
@@ -24,9 +27,16 @@ class DropoutLayer(Layer):
         self.top_diff = hmarray.zeros(bottom.shape)
         return [(self.top, self.top_diff)]
 
+    def precompile(self, backward=False):
+        self.hm_dropout.precompile(self.top, self.bottom, self.mask,
+                                   self.scale)
+        if backward:
+            self.hm_dropout.precompile(self.bottom_diff, self.top_diff,
+                                       self.mask, self.scale)
+
     def forward(self):
-        self.hm_dropout(self.top, self.bottom, self.mask, self.threshold)
+        self.hm_dropout(self.top, self.bottom, self.mask, self.scale)
 
     def backward(self):
         self.hm_dropout(self.bottom_diff, self.top_diff, self.mask,
-                        self.threshold)
+                        self.scale)
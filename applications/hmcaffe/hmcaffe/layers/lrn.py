@@ -35,6 +35,15 @@ class LrnLayer(Layer):
         self.top_diff = hmarray.zeros(bottom.shape)
         return [(self.top, self.top_diff)]
 
+    def precompile(self, backward=False):
+        self.hm_forward.precompile(self.top, self.scale, self.bottom,
+                                   self.alpha, self.beta, self.local_size)
+        if backward:
+            self.hm_backward.precompile(self.bottom_diff, self.bottom,
+                                        self.top, self.scale, self.top_diff,
+                                        self.alpha, self.beta,
+                                        self.local_size)
+
     def forward(self):
         self.hm_forward(self.top, self.scale, self.bottom, self.alpha,
                         self.beta, self.local_size)
@@ -47,6 +47,14 @@ class PoolingLayer(Layer):
         self.top_diff = hmarray.zeros(top_shape)
         return [(self.top, self.top_diff)]
 
+    def precompile(self, backward=False):
+        self.hm_forward.precompile(self.top, self.bottom, self.mask,
+                                   self.kernel_size, self.padding, self.stride)
+        if backward:
+            self.hm_backward.precompile(self.bottom_diff, self.top_diff,
+                                        self.mask, self.kernel_size,
+                                        self.padding, self.stride)
+
     def forward(self):
         self.hm_forward(self.top, self.bottom, self.mask, self.kernel_size,
                         self.padding, self.stride)
@@ -26,6 +26,11 @@ class ReluLayer(Layer):
         self.bottom, self.bottom_diff = bottom, bottom_diff
         return [(self.bottom, self.bottom_diff)]
 
+    def precompile(self, backward=False):
+        self.hm_forward.precompile(self.bottom)
+        if backward:
+            self.hm_backward.precompile(self.bottom, self.bottom_diff)
+
     def forward(self):
         self.hm_forward(self.bottom)
 
@@ -21,5 +21,8 @@ class SoftmaxLayer(Layer):
         self.top = hmarray.zeros(bottom.shape)
         return [(self.top, None)]
 
+    def precompile(self, backward=False):
+        self.hm_forward.precompile(self.top, self.bottom)
+
     def forward(self):
         self.hm_forward(self.top, self.bottom)
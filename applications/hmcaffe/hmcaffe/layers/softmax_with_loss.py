@@ -29,6 +29,13 @@ class SoftmaxWithLossLayer(Layer):
         self.prob = hmarray.zeros(bottom.shape)
         return [(self.top, None)]
 
+    def precompile(self, backward=False):
+        self.hm_forward.precompile(self.top, self.bottom, self.label,
+                                   self.prob)
+        if backward:
+            self.hm_backward.precompile(self.bottom_diff, self.top,
+                                        self.label, self.prob)
+
     def forward(self):
         self.hm_forward(self.top, self.bottom, self.label, self.prob)
 
@@ -17,6 +17,7 @@ from layers import ConvLayer, ReluLayer, PoolingLayer, InnerProductLayer, \
     SoftmaxWithLossLayer, ConcatLayer
 import numpy as np
 from hindemith.types import hmarray
+from hindemith.cl import compile_concurrently
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger("hmcaffe")
@@ -44,7 +45,7 @@ class Net(object):
         "Data": DataLayer
     }
 
-    def __init__(self, net_param, params=None):
+    def __init__(self, net_param, params=None, precompile=False):
         self.blobs = {}
         self.layers = []
 
@@ -86,6 +87,22 @@ class Net(object):
             for top, top_name in zip(tops, layer_param.top):
                 self.blobs[top_name] = top[0]
                 self.blobs["{}_diff".format(top_name)] = top[1]
+        if precompile:
+            self.precompile()
+
+    def precompile(self):
+        """
+        Build every layer's kernels so the first forward (and backward when
+        training) pass does not pay for compilation.  Layers are compiled
+        concurrently, most layers are a single kernel or launcher.
+        """
+        backward = self.net_param.state.phase == pb.TRAIN
+
+        def precompile_layer(layer):
+            log.info("Precompiling %s", type(layer).__name__)
+            layer.precompile(backward)
+
+        compile_concurrently(precompile_layer, self.layers)
 
     def forward(self, _from=0, to=None):
         if to is None:
@@ -3,6 +3,7 @@ from hindemith.types import hmarray
 from hindemith.core import compose
 from hindemith.operations.array import Square
 from hindemith.operations.convolve import Convolve2D
+from hindemith.operations.reduce import MaxAbsDiff
 import numpy as np
 import cv2
 from scipy.ndimage.filters import convolve
@@ -34,7 +35,6 @@ def np_hs_jacobi(im0, im1, u, v):
     return u, v
 
 
-alpha2 = alpha ** 2
 epsilon = .01
 
 @compose
@@ -42,7 +42,7 @@ def hs_jacobi(im0, im1, u, v):
     It = im1 - im0
     Iy = Convolve2D(im1, dy)
     Ix = Convolve2D(im1, dx)
-    denom = Square(Ix) + Square(Iy) + alpha2
+    denom = Square(Ix) + Square(Iy) + alpha ** 2
 
     for _ in range(100):
         ubar = Convolve2D(u, jacobi)
@@ -50,7 +50,10 @@ def hs_jacobi(im0, im1, u, v):
         t = (Ix * ubar + Iy * vbar + It) / denom
         u_new = ubar - Ix * t
         v_new = vbar - Iy * t
+        change = MaxAbsDiff(u_new, u)
         u, v = u_new, v_new
+        if change < epsilon:
+            break
     return u, v
 
 
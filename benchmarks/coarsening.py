@@ -0,0 +1,80 @@
+"""
+Throughput of element kernels for work-item coarsening factors, against
+one element per work item.
+
+    python benchmarks/coarsening.py
+    HM_VECTOR_WIDTH=4 python benchmarks/coarsening.py
+
+Only OpenCL kernels can be coarsened.
+"""
+import time
+import hindemith as hm
+from hindemith.core import compose
+from hindemith.operations.array import ArrayAdd
+
+launches = 20
+repeats = 3
+shape = (2048, 2048)
+alpha = 15.0
+factors = (1, 2, 4, 8, 16)
+
+
+def add(a, b, c):
+    c = ArrayAdd(a, b)
+    return c
+
+
+def hs_update(Ix, Iy, It, denom, ubar, vbar, u, v):
+    t = (Ix * ubar + Iy * vbar + It) / denom
+    u = ubar - Ix * t
+    v = vbar - Iy * t
+    return u, v
+
+
+def best_of(kernels):
+    """
+    Return the best time of repeats runs of launches launches of kernels
+    in seconds per launch.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        for _ in range(launches):
+            for kernel in kernels:
+                kernel.enqueue([])
+        hm.synchronize()
+        times.append(time.time() - start)
+    return min(times) / launches
+
+
+def get_kernels(fn, args):
+    composed = compose(fn)
+    composed(*args)
+    return composed.composed.kernels
+
+
+def configure(kernels, coarsening, order):
+    for kernel in kernels:
+        kernel.configure(coarsening=coarsening, coarsening_order=order)
+
+
+if __name__ == '__main__':
+    arrays = [hm.random(shape, _range=(1, 2)) for _ in range(8)]
+    cases = [("ArrayAdd", add, arrays[:3], 3),
+             ("HS update", hs_update, arrays, 8)]
+    print("{:<10} {:>6} {:>11} {:>10} {:>8}".format(
+        "kernel", "factor", "order", "GB/s", "speedup"))
+    for name, fn, args, num_arrays in cases:
+        kernels = get_kernels(fn, args)
+        nbytes = num_arrays * arrays[0].nbytes
+        configure(kernels, 1, "contiguous")
+        baseline = best_of(kernels)
+        for factor in factors:
+            for order in ("contiguous", "strided"):
+                if factor == 1 and order == "strided":
+                    continue
+                configure(kernels, factor, order)
+                elapsed = best_of(kernels)
+                print("{:<10} {:>6} {:>11} {:>10.2f} {:>7.2f}x".format(
+                    name, factor, order, nbytes / elapsed / 1e9,
+                    baseline / elapsed))
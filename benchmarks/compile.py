@@ -0,0 +1,66 @@
+"""
+Wall-clock time saved by compiling the kernels of a composed function
+concurrently.
+
+Precompiles functions with many distinct kernels once with a single
+compile thread and once with HM_COMPILE_THREADS threads (cpu_count() by
+default), and reports both times and the time saved.  The kernel cache
+is disabled so every kernel is really built.  Builds only overlap on a
+host with several cores.
+
+    python benchmarks/compile.py
+    CC=gcc HM_BACKEND=omp python benchmarks/compile.py
+"""
+import os
+os.environ["HM_CACHE"] = "0"
+import time
+import hindemith as hm
+import hindemith.cl as hmcl
+from hindemith.core import compose
+from hindemith.operations.array import ArrayAdd, ArrayScalarMul, Square
+
+shape = (256, 256)
+num_kernels = 16
+repeats = 3
+
+
+def make_fn():
+    # The three operations fuse into a single kernel
+    @compose(max_plans=num_kernels)
+    def fn(a, b, c, scale):
+        d = ArrayScalarMul(a, scale)
+        c = ArrayAdd(d, b)
+        e = Square(c)
+        return e
+    return fn
+
+
+def precompile_time(threads, offset):
+    """
+    Return the time to precompile num_kernels distinct plans with threads
+    compile threads.  Scalar values differ per call (and per offset), so no
+    source is ever built twice.
+    """
+    hmcl.compile_threads = threads
+    a = hm.random(shape)
+    fns = [make_fn() for _ in range(num_kernels)]
+    start = time.time()
+    hmcl.compile_concurrently(
+        lambda i: fns[i].precompile(a, a, a, float(offset + i)),
+        range(num_kernels))
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    threads = hmcl.compile_threads
+    serial, concurrent = [], []
+    for repeat in range(repeats):
+        offset = 2 * repeat * num_kernels
+        serial.append(precompile_time(1, offset))
+        concurrent.append(precompile_time(threads, offset + num_kernels))
+    serial, concurrent = min(serial), min(concurrent)
+    print("{} kernels, {} compile threads".format(num_kernels, threads))
+    print("serial      {:8.3f} s".format(serial))
+    print("concurrent  {:8.3f} s".format(concurrent))
+    print("saved       {:8.3f} s ({:.2f}x)".format(serial - concurrent,
+                                                 serial / concurrent))
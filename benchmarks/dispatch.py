@@ -0,0 +1,90 @@
+"""
+Per-call dispatch overhead of composed functions.
+
+Calls composed functions on small arrays, where the Python work done per
+call (selecting the plan, binding arguments, launching kernels) dominates,
+and reports the time per call next to the time spent launching and
+running the same kernels directly.  The difference is the dispatch
+overhead.
+
+    python benchmarks/dispatch.py
+    CC=gcc HM_BACKEND=omp python benchmarks/dispatch.py
+"""
+import time
+import hindemith as hm
+from hindemith.core import compose
+from hindemith.operations.array import ArrayAdd, ArrayMul, ArraySub, \
+    ArrayScalarMul
+
+calls = 2000
+repeats = 5
+
+
+@compose
+def single(a, b, c):
+    c = ArrayAdd(a, b)
+    return c
+
+
+@compose
+def fused(a, b, c):
+    d = ArrayAdd(a, b)
+    e = ArrayMul(d, a)
+    f = ArraySub(e, b)
+    c = ArrayAdd(f, d)
+    return c
+
+
+@compose
+def blocks(a, b, c):
+    d = ArrayAdd(a, b)
+    e = ArrayScalarMul(d, 2.0)
+    c = ArrayAdd(e, b)
+    return c
+
+
+def best_of(fn):
+    """
+    Return the best time of repeats runs of fn in microseconds per call.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        for _ in range(calls):
+            fn()
+        hm.synchronize()
+        times.append(time.time() - start)
+    return min(times) / calls * 1e6
+
+
+def benchmark(name, composed, shape):
+    a = hm.random(shape)
+    b = hm.random(shape)
+    c = hm.zeros(shape)
+    composed(a, b, c)
+    kernels = composed.composed.kernels
+
+    def launch():
+        for kernel in kernels:
+            kernel.enqueue([])
+
+    def run():
+        call_time = best_of(lambda: composed(a, b, c))
+        kernel_time = best_of(launch)
+        print("{:<8} {:>12} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name, "x".join(str(d) for d in shape), len(kernels), call_time,
+            kernel_time, call_time - kernel_time))
+    return run
+
+
+if __name__ == '__main__':
+    # Compile everything first so build output does not break up the table
+    runs = [benchmark(name, composed, shape)
+            for shape in [(8, 8), (64, 64), (240, 320)]
+            for name, composed in [("single", single), ("fused", fused),
+                                   ("blocks", blocks)]]
+    print("{:<8} {:>12} {:>8} {:>10} {:>10} {:>10}".format(
+        "function", "shape", "kernels", "call us", "kernel us",
+        "overhead"))
+    for run in runs:
+        run()
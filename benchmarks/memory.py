@@ -0,0 +1,88 @@
+"""
+Activation memory of GoogLeNet before and after memory planning.
+
+Plans the intermediates of the forward function of
+applications/hmcaffe/benchmarks/googlenet.py as if none of its blobs had
+been preallocated, with layer sizes taken from its prototxt.  Only the
+compile pipeline runs, so neither caffe nor the trained model is needed.
+
+    python benchmarks/memory.py
+    CC=gcc HM_BACKEND=omp python benchmarks/memory.py
+"""
+import atexit
+import os
+import re
+import sys
+import shutil
+import tempfile
+import hindemith as hm
+from hindemith.core import Compose, UnpackBinOps, ReplaceArrayOps
+from hindemith.memory import Placeholder
+from hindemith.operations.conv import ConvForward
+from hindemith.operations.relu import ReluForward
+from hindemith.operations.pool import PoolForward, AvePoolForward
+from hindemith.operations.lrn import LrnForward
+from hindemith.operations.softmax import SoftmaxForward
+from hindemith.operations.concat import ConcatForward
+from hindemith.operations.inner_product import InnerProductForward
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+benchmark_dir = os.path.join(root, "applications", "hmcaffe", "benchmarks")
+
+
+def load_forward():
+    """
+    Return the forward function of the GoogLeNet benchmark, the rest of
+    the benchmark needs caffe.
+    """
+    with open(os.path.join(benchmark_dir, "googlenet.py")) as f:
+        lines = f.read().splitlines()
+    start = lines.index("def forward(data):")
+    end = [i for i, line in enumerate(lines)
+           if i > start and line.startswith("    return")][0]
+    # inspect needs the source of the function, it is compiled from a
+    # module of its own
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory)
+    with open(os.path.join(directory, "hm_googlenet_forward.py"), "w") as f:
+        f.write("\n".join(lines[start:end + 1]) + "\n")
+    sys.path.insert(0, directory)
+    import hm_googlenet_forward
+    sys.path.remove(directory)
+    return hm_googlenet_forward.forward
+
+
+def get_params():
+    """
+    Return placeholders for the weights of each layer of the prototxt,
+    only their number of outputs affect the shapes of the activations.
+    """
+    with open(os.path.join(benchmark_dir, "googlenet.prototxt")) as f:
+        prototxt = f.read()
+    params = {}
+    for layer in prototxt.split("layer {")[1:]:
+        name = re.search(r'name: "([^"]*)"', layer).group(1)
+        num_output = re.search(r'num_output: (\d+)', layer)
+        if num_output is not None:
+            name = name.replace('/', '_')
+            num_output = int(num_output.group(1))
+            params[name + "_filters"] = Placeholder((num_output, 1))
+            params[name + "_bias"] = Placeholder((num_output, ))
+    batch_size = int(re.search(r'input_dim: (\d+)', prototxt).group(1))
+    return params, batch_size
+
+
+if __name__ == '__main__':
+    forward = load_forward()
+    params, batch_size = get_params()
+    symbol_table = dict(globals())
+    symbol_table.update(params)
+    composed = Compose(forward, symbol_table, True)
+    composed.bind([hm.zeros((batch_size, 3, 224, 224))], {})
+    tree = UnpackBinOps().visit(composed.tree)
+    replace_array_ops = ReplaceArrayOps(composed.symbol_table)
+    tree = replace_array_ops.visit(tree)
+    body = composed.process_hm_ops(tree.body[0].body)
+    plan = composed.get_memory_plan(body, replace_array_ops.placeholders)
+    print("GoogLeNet, batch size {}".format(batch_size))
+    print(plan.report())
@@ -0,0 +1,98 @@
+"""
+Time per launch of single operations with and without the peephole
+rewrites of hindemith.peephole.
+
+    python benchmarks/peephole.py
+    CC=gcc HM_BACKEND=omp python benchmarks/peephole.py
+    HM_FAST_MATH=1 CC=gcc HM_BACKEND=omp python benchmarks/peephole.py
+"""
+import time
+import numpy as np
+import hindemith as hm
+from hindemith import peephole
+from hindemith.core import compose
+from hindemith.operations.array import Square, ArrayScalarDiv
+from hindemith.operations.convolve import Convolve2D
+from hindemith.operations.pool import PoolForward
+
+launches = 20
+repeats = 3
+shape = (2048, 2048)
+jacobi = np.array([
+    [1.0/12.0, 1.0/6.0, 1.0/12.0],
+    [1.0/6.0, 0.0, 1.0/6.0],
+    [1.0/12.0, 1.0/6.0, 1.0/12.0]
+])
+
+
+def square(a, b):
+    b = Square(a)
+    return b
+
+
+def divide(a, b):
+    b = ArrayScalarDiv(a, 3.0)
+    return b
+
+
+def convolve(a, b):
+    c = Convolve2D(a, jacobi)
+    b = Convolve2D(c, jacobi)
+    return b
+
+
+def pool(a, top, mask):
+    top, mask = PoolForward(a, kernel_size=(3, 3), padding=(0, 0),
+                            stride=(2, 2))
+    return top, mask
+
+
+def best_of(kernels):
+    """
+    Return the best time of repeats runs of launches launches of kernels
+    in microseconds per launch.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        for _ in range(launches):
+            for kernel in kernels:
+                kernel.enqueue([])
+        hm.synchronize()
+        times.append(time.time() - start)
+    return min(times) / launches * 1e6
+
+
+def get_kernels(fn, args, enabled):
+    """
+    Compile fn for args with the rewrites enabled or disabled.
+    """
+    peephole.enabled = enabled
+    try:
+        composed = compose(fn)
+        composed(*args)
+    finally:
+        peephole.enabled = True
+    return composed.composed.kernels
+
+
+if __name__ == '__main__':
+    a = hm.random(shape, _range=(1, 2))
+    b = hm.zeros(shape)
+    pooled = hm.random((8, 16, 256, 256), _range=(0, 1))
+    top = hm.zeros((8, 16, 127, 127))
+    mask = hm.zeros((8, 16, 127, 127))
+    cases = [("Square", square, (a, b)), ("ScalarDiv", divide, (a, b)),
+             ("Convolve2D", convolve, (a, b)),
+             ("PoolForward", pool, (pooled, top, mask))]
+    # Compile everything first so build output does not break up the table
+    kernels = [(name, get_kernels(fn, args, False),
+                get_kernels(fn, args, True)) for name, fn, args in cases]
+    print("fast_math={}".format(peephole.fast_math))
+    print("{:<12} {:>12} {:>12} {:>8}".format(
+        "operation", "before us", "after us", "speedup"))
+    for name, before, after in kernels:
+        before_time = best_of(before)
+        after_time = best_of(after)
+        print("{:<12} {:>12.1f} {:>12.1f} {:>7.2f}x".format(
+            name, before_time, after_time, before_time / after_time))
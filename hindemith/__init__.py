@@ -1,22 +1,61 @@
 from hindemith.types import hmarray
 import numpy as np
+import pycl as _cl
+import os
+
+backend = os.getenv("HM_BACKEND", "ocl")
+if backend in {"ocl", "opencl", "OCL"}:
+    from hindemith.cl import queues
+
+
+# Byte boundary the data of arrays allocated here starts on, so simd
+# kernels can assume aligned pointers
+alignment = 64
+
+
+def aligned_empty(shape, dtype=np.float32):
+    """
+    Return an uninitialized numpy array whose data starts on an alignment
+    byte boundary.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buf = np.empty(nbytes + alignment, np.uint8)
+    offset = -buf.ctypes.data % alignment
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
 
 
 def ones(shape, dtype=np.float32):
-    return np.ones(shape, dtype).view(hmarray)
+    arr = aligned_empty(shape, dtype)
+    arr.fill(1)
+    return arr.view(hmarray)
 
 
 def zeros(shape, dtype=np.float32):
-    return np.zeros(shape, dtype).view(hmarray)
+    arr = aligned_empty(shape, dtype)
+    arr.fill(0)
+    return arr.view(hmarray)
 
 
 def zeros_like(arr):
-    return np.zeros_like(arr).view(hmarray)
+    return zeros(arr.shape, arr.dtype)
 
 
 def random(shape, _range=(0, 1), dtype=np.float32):
-    rand = np.random.rand(*shape).astype(dtype)
+    rand = aligned_empty(shape, dtype)
+    rand[...] = np.random.rand(*shape)
     length = _range[1] - _range[0]
     rand *= length
     rand += _range[0]
     return rand.view(hmarray)
+
+
+def synchronize():
+    """
+    Block until every command submitted to the device has completed.
+    Composed functions return without waiting for their kernels, use
+    sync_host on the arrays that are needed or this to wait on everything.
+    """
+    if backend in {"ocl", "opencl", "OCL"}:
+        for queue in queues:
+            _cl.clFinish(queue)
@@ -0,0 +1,162 @@
+"""
+Autotuning of kernel code generation and launch parameters.
+
+Kernels list the values of their parameters worth trying in ``tunable``
+and take new values through ``configure``.  tune times configurations of
+a kernel on scratch arrays shaped like its arguments and stores the
+fastest in a database on disk, under the kernel's tuning_key(): a digest
+of its code before the parameters are applied, the problem size and the
+device.  Kernels compiled later, in this or any other process, look their
+key up and are generated with the stored parameters.
+
+Set HM_TUNE=1 to tune kernels without an entry the first time their
+arguments are bound.  The database is tuning.json in the hindemith temp
+dir, it can be relocated with HM_TUNING_DB.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import hindemith as hm
+from hindemith.cache import hm_dir
+
+enabled = os.getenv("HM_TUNE", "0") not in {"0", "false", "False", "off"}
+database_path = os.getenv("HM_TUNING_DB", os.path.join(hm_dir,
+                                                       "tuning.json"))
+# A configuration is timed over launches launches, the best of repeats
+# runs counts
+launches = int(os.getenv("HM_TUNE_LAUNCHES", "10"))
+repeats = 3
+# Each pass tries every value of one parameter at a time, with the others
+# fixed at the best found so far
+passes = 2
+
+
+class TuningDatabase(object):
+    """
+    Best parameters found for each tuning key, persisted as JSON.  Entries
+    written by other processes are merged in before every write.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        """
+        Return the parameters stored for key, or None.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load()
+            entry = self.entries.get(key)
+        return entry and entry["parameters"]
+
+    def set(self, key, parameters, seconds):
+        """
+        Store the parameters found for key and the time per launch they
+        achieved, readers never observe a partially written database.
+        Entries on disk take precedence over those cached here, only key
+        is overwritten.
+        """
+        with self.lock:
+            entries = dict(self.entries or {})
+            entries.update(self.load())
+            entries[key] = {"parameters": parameters, "seconds": seconds}
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
+            self.entries = entries
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+database = TuningDatabase(database_path)
+
+
+def time_launches(kernel):
+    """
+    Return the time per launch of kernel with its bound arguments.
+    """
+    kernel.enqueue([])
+    hm.synchronize()
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        for _ in range(launches):
+            kernel.enqueue([])
+        hm.synchronize()
+        elapsed = (time.time() - start) / launches
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def search(tunable, parameters, measure):
+    """
+    Return the fastest parameters found by changing one parameter of
+    tunable at a time, starting from parameters, and their time.  measure
+    returns the time of parameters, or None if they do not work.
+    """
+    best = dict(parameters)
+    best_time = measure(best)
+    for _ in range(passes):
+        improved = False
+        for name in sorted(tunable):
+            for value in tunable[name]:
+                if value == best[name]:
+                    continue
+                candidate = dict(best)
+                candidate[name] = value
+                elapsed = measure(candidate)
+                if elapsed is not None and (best_time is None or
+                                            elapsed < best_time):
+                    best, best_time = candidate, elapsed
+                    improved = True
+        if not improved:
+            break
+    return best, best_time
+
+
+def tune(kernel, args):
+    """
+    Find the fastest parameters of kernel for arguments shaped like args
+    (arrays in the order of kernel.params), store them in the database
+    and configure kernel with them.  The kernel is timed on scratch
+    arrays, args are not modified.  Scalars are passed as they are.
+    """
+    scratch = [hm.random(arg.shape, dtype=arg.dtype)
+               if isinstance(arg, np.ndarray) else arg for arg in args]
+
+    def measure(parameters):
+        try:
+            kernel.configure(**parameters)
+            kernel.set_args(scratch)
+            return time_launches(kernel)
+        except Exception:
+            # Configurations the device or compiler rejects, such as a
+            # work group size above the device limit, are skipped
+            return None
+
+    current = dict((name, getattr(kernel, name)) for name in kernel.tunable)
+    parameters, seconds = search(kernel.tunable, current, measure)
+    database.set(kernel.tuning_key(), parameters, seconds)
+    kernel.configure(**parameters)
+    return parameters
@@ -0,0 +1,110 @@
+"""
+Content addressed cache for compiled kernels.
+
+Compiled artifacts (OpenCL program binaries and shared objects produced
+by the OpenMP backend) are stored under the hindemith temp dir, keyed
+on a digest of everything that determines the result of the build:
+the generated source, the build options and the identity of the device
+or compiler that produced it.  The cache can be relocated with the
+HM_CACHE_DIR environment variable and disabled with HM_CACHE=0.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+hm_dir = os.path.join(tempfile.gettempdir(), "hindemith")
+cache_dir = os.getenv("HM_CACHE_DIR", os.path.join(hm_dir, "cache"))
+enabled = os.getenv("HM_CACHE", "1") not in {"0", "false", "False", "off"}
+
+
+def make_key(*parts):
+    """
+    Return a hex digest identifying the given parts, each part is
+    converted to a string before hashing.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class KernelCache(object):
+    """
+    Two level cache for compiled kernels.  Objects built in this process
+    are kept in memory so identical sources are only built once, built
+    artifacts are persisted to ``directory`` so later processes can skip
+    the build entirely.
+    """
+    def __init__(self, directory, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.enabled and not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another process may have created it concurrently
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def path(self, key, ext):
+        return os.path.join(self.directory, "{}.{}".format(key, ext))
+
+    def get(self, key):
+        return self.memory.get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            return self.memory.setdefault(key, value)
+
+    def load(self, key, ext):
+        """
+        Return the bytes stored for key, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        try:
+            with open(self.path(key, ext), 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def store(self, key, ext, data):
+        """
+        Atomically write data for key, readers never observe a partially
+        written entry.
+        """
+        if not self.enabled or not data:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, self.path(key, ext))
+
+    def store_file(self, key, ext, tmp_path):
+        """
+        Atomically move a file produced by an external tool into the
+        cache, return the path of the cached entry.
+        """
+        path = self.path(key, ext)
+        os.rename(tmp_path, path)
+        return path
+
+    def clear(self):
+        self.memory.clear()
+        if os.path.isdir(self.directory):
+            for entry in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, entry))
+
+
+kernel_cache = KernelCache(cache_dir, enabled)
@@ -1,22 +1,123 @@
 from string import Template
 import pycl as cl
 import os
+import re
 import tempfile
 import subprocess
 import ctypes as ct
 import numpy as np
-import random
 import os
 import sys
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import hindemith as hm
+from hindemith.cache import hm_dir, kernel_cache, make_key
+from hindemith.peephole import optimize, simplify
+from hindemith import autotune
 
 
 backend = os.getenv("HM_BACKEND", "ocl")
+# Elements an element kernel processes per vector operation, 1 emits
+# scalar kernels.  OpenCL kernels load and store floatN, OpenMP loops are
+# marked simd.  Set per kernel with Kernel.vector_width.
+vector_width = int(os.getenv("HM_VECTOR_WIDTH", "1"))
+# Units (elements or vectors) each work item of an OpenCL element kernel
+# processes, HM_COARSENING_ORDER=strided interleaves the units of the work
+# items instead of giving each a contiguous range.  Set per kernel with
+# Kernel.coarsening and Kernel.coarsening_order.
+coarsening = int(os.getenv("HM_COARSENING", "1"))
+coarsening_order = os.getenv("HM_COARSENING_ORDER", "contiguous")
 
-count = 0
-def get_unique_kernel_name():
-    global count
-    count += 1
-    return "fn{}".format(count)
+
+class QueueScheduler(object):
+    """
+    Assigns launches to in-order command queues.  A launch that waits on
+    earlier events continues the chain of its producers on their queue, so
+    the in-order queue provides the ordering and those events are dropped
+    from the wait list.  Independent launches go to the queue with the
+    fewest outstanding commands, ties are broken round robin so
+    independent chains spread over all queues.  With out-of-order queues
+    (in_order=False) every wait is kept, ordering comes from events only.
+
+    Completed events are released whenever commands are submitted, at most
+    max_outstanding events are tracked per queue (older ones are dropped,
+    they only bias the load estimate).
+    """
+    max_outstanding = 1024
+
+    def __init__(self, queues, in_order=True):
+        self.queues = queues
+        self.in_order = in_order
+        self.indices = dict((q.value, i) for i, q in enumerate(queues))
+        self.outstanding = [deque(maxlen=self.max_outstanding)
+                            for _ in queues]
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def pending(self, index):
+        """
+        Return the number of commands submitted to queue index that have
+        not completed.
+        """
+        outstanding = self.outstanding[index]
+        if not self.in_order:
+            self.outstanding[index] = outstanding = deque(
+                (evt for evt in outstanding if not self.is_complete(evt)),
+                maxlen=self.max_outstanding)
+        # Commands on an in-order queue complete in submission order
+        while outstanding and self.is_complete(outstanding[0]):
+            outstanding.popleft()
+        return len(outstanding)
+
+    @staticmethod
+    def is_complete(evt):
+        # Negative statuses are errors, they are not waited on either
+        return ct.c_int(evt.status.value).value <= 0
+
+    def get_queue(self, wait_for=None):
+        """
+        Choose a queue for a launch that waits on wait_for.
+
+        :return: The queue and the events that still need to be waited on
+        :rtype: (cl_command_queue, list)
+        """
+        if isinstance(wait_for, cl.cl_event):
+            wait_for = [wait_for]
+        wait_for = [evt for evt in wait_for or () if evt]
+        with self.lock:
+            counts = {}
+            for evt in wait_for:
+                index = self.indices.get(evt.queue.value)
+                if index is not None:
+                    counts[index] = counts.get(index, 0) + 1
+            if len(self.queues) == 1:
+                index = 0
+            elif counts:
+                index = max(counts, key=lambda i: counts[i])
+            else:
+                num_queues = len(self.queues)
+                index = min(range(num_queues), key=lambda i: (
+                    self.pending(i), (i - self.next) % num_queues))
+                self.next = (index + 1) % num_queues
+            queue = self.queues[index]
+        if self.in_order:
+            wait_for = [evt for evt in wait_for
+                        if evt.queue.value != queue.value]
+        return queue, wait_for
+
+    def submitted(self, queue, events):
+        """
+        Record commands submitted to queue.
+        """
+        if isinstance(events, cl.cl_event):
+            events = [events]
+        index = self.indices.get(queue.value)
+        if index is not None:
+            with self.lock:
+                self.outstanding[index].extend(evt for evt in events if evt)
+                self.pending(index)
 
 
 if backend in {"ocl", "opencl", "OCL"}:
@@ -27,48 +128,431 @@ if backend in {"ocl", "opencl", "OCL"}:
     except cl.DeviceNotFoundError:
         devices = cl.clGetDeviceIDs()
     context = cl.clCreateContext(devices[-1:])
-    if os.environ.get("TRAVIS"):
-        queues = [cl.clCreateCommandQueue(context)]
-    else:
+
+    def get_num_queues(device):
+        """
+        Number of command queues to create, set with HM_NUM_QUEUES.  CPU
+        runtimes already spread every kernel over all cores, so extra
+        queues only add synchronization.  Other devices get up to 8 queues
+        for running independent kernels concurrently.
+        """
+        if os.getenv("HM_NUM_QUEUES"):
+            return max(int(os.getenv("HM_NUM_QUEUES")), 1)
+        if os.environ.get("TRAVIS") or \
+                device.type.value & cl.CL_DEVICE_TYPE_CPU.value:
+            return 1
+        return max(min(8, device.max_compute_units), 1)
+
+    # HM_QUEUE_MODE=out_of_order uses a single out-of-order queue, all
+    # ordering is then expressed through events
+    queue_mode = os.getenv("HM_QUEUE_MODE", "in_order")
+    if queue_mode in {"out_of_order", "ooo"}:
+        queue_mode = "out_of_order"
         queues = [
             cl.clCreateCommandQueue(
-                context
-            ) for _ in range(8)
+                context,
+                properties=cl.CL_QUEUE_OUT_OF_ORDER_EXEC_MODE_ENABLE
+            )
         ]
-        # queues = [
-        #     cl.clCreateCommandQueue(
-        #         context,
-        #         properties=cl.CL_QUEUE_OUT_OF_ORDER_EXEC_MODE_ENABLE
-        #     ) for _ in range(10)
-        # ]
+    elif queue_mode == "in_order":
+        queues = [cl.clCreateCommandQueue(context)
+                  for _ in range(get_num_queues(devices[-1]))]
+    else:
+        raise NotImplementedError(
+            "Hindemith has not implemented a queue mode called " +
+            queue_mode)
     queue = queues[0]
+    queue_scheduler = QueueScheduler(queues,
+                                     in_order=queue_mode == "in_order")
+
+    # Binaries are only valid for the device and driver that produced them
+    device_identity = make_key(devices[-1].name, devices[-1].vendor,
+                               devices[-1].version,
+                               devices[-1].driver_version)
+
+    _create_program_with_binary = cl._dll.clCreateProgramWithBinary
+    _create_program_with_binary.restype = cl.cl_program
+    _create_program_with_binary.argtypes = (
+        cl.cl_context, cl.cl_uint, ct.POINTER(cl.cl_device),
+        ct.POINTER(ct.c_size_t), ct.POINTER(ct.c_char_p),
+        ct.POINTER(ct.c_int), ct.POINTER(ct.c_int)
+    )
 
-hm_dir = os.path.join(tempfile.gettempdir(), "hindemith")
+    def get_program_binary(program):
+        """
+        Return the binary of a built program for the context device.
+        (pycl's binaries property truncates binaries at the first null
+        byte)
+        """
+        size = program.binary_sizes[0]
+        binary = (ct.c_char * size)()
+        pointers = (ct.c_char_p * 1)(ct.cast(binary, ct.c_char_p))
+        cl.clGetProgramInfo.call(program,
+                                 cl.cl_program_info.CL_PROGRAM_BINARIES,
+                                 ct.sizeof(pointers), pointers, None)
+        return binary.raw
+
+    def create_program_with_binary(binary):
+        """
+        Return a program created from a cached binary, or None if the
+        runtime rejects it.
+        """
+        device_array = (cl.cl_device * 1)(devices[-1])
+        lengths = (ct.c_size_t * 1)(len(binary))
+        binaries = (ct.c_char_p * 1)(binary)
+        status = ct.c_int()
+        err = ct.c_int()
+        program = _create_program_with_binary(
+            context, 1, device_array, lengths, binaries, ct.byref(status),
+            ct.byref(err))
+        if err.value or status.value:
+            return None
+        program._context = context
+        return program
+
+    def build_program(source, options=None):
+        """
+        Build an OpenCL program for the context device, identical sources
+        are only built once per process and the resulting binaries are
+        persisted across processes.
+        """
+        key = make_key(source, options, device_identity)
+        program = kernel_cache.get(key)
+        if program is not None:
+            return program
+        if options is not None and sys.version_info[0] > 2:
+            options = options.encode()
+        binary = kernel_cache.load(key, "bin")
+        if binary is not None:
+            program = create_program_with_binary(binary)
+            if program is not None:
+                try:
+                    program.build(options)
+                except cl.OpenCLError:
+                    program = None
+        if program is None:
+            program = cl.clCreateProgramWithSource(context, source)
+            program.build(options)
+            kernel_cache.store(key, "bin", get_program_binary(program))
+        return kernel_cache.set(key, program)
 
 if not os.path.exists(hm_dir):
     os.mkdir(hm_dir)
-unique_file_id = -1
+
+compile_threads = int(os.getenv("HM_COMPILE_THREADS",
+                                multiprocessing.cpu_count()))
+compile_pool = None
+compile_pool_lock = threading.Lock()
+compile_local = threading.local()
+
+
+def compile_concurrently(fn, items):
+    """
+    Call fn on every item on the shared pool of HM_COMPILE_THREADS
+    threads.  Calls made from a pool thread (such as the kernels of a
+    layer compiled while layers are compiled concurrently) run serially,
+    so the pool never waits on itself.
+    """
+    global compile_pool
+    items = list(items)
+    if compile_threads <= 1 or len(items) <= 1 or \
+            getattr(compile_local, "in_pool", False):
+        for item in items:
+            fn(item)
+        return
+    with compile_pool_lock:
+        if compile_pool is None:
+            compile_pool = ThreadPool(compile_threads)
+
+    def run(item):
+        compile_local.in_pool = True
+        fn(item)
+    compile_pool.map(run, items)
+
+
+def compile_kernels(kernels):
+    """
+    Compile kernels (and DeviceLevel launchers) concurrently.  Both
+    clBuildProgram and the compiler subprocess of the OpenMP backend
+    release the GIL, so independent builds overlap on the compile pool.
+    """
+    compile_concurrently(lambda kernel: kernel.compile(), kernels)
+
+# Without optimization the compiler ignores simd loops
+compiler_flags = "-shared -std=gnu99 -fPIC -fopenmp -O2"
+compiler_identities = {}
+
+
+def get_compiler_identity(compiler):
+    """
+    Return a string identifying the version of compiler, shared objects
+    are only reused if they were produced by the same compiler.
+    """
+    if compiler not in compiler_identities:
+        try:
+            identity = subprocess.check_output(
+                "{} --version".format(compiler), shell=True,
+                stderr=subprocess.STDOUT)
+        except (subprocess.CalledProcessError, OSError):
+            identity = compiler
+        compiler_identities[compiler] = identity
+    return compiler_identities[compiler]
 
 
 def hm_compile_and_load(_file):
-    print(_file)
-    file_path = os.path.join(hm_dir, "temp_file.c")
-    with open(file_path, 'w') as f:
-        f.write(_file)
-    global unique_file_id
-    unique_file_id += 1
-    so_name = "compiled{}.so".format(unique_file_id)
-    so_path = os.path.join(hm_dir, so_name)
-    flags = "-shared -std=gnu99 -fPIC -fopenmp"
     compiler = os.environ.get("CC", "CC")
-    compile_cmd = "{} {} -o {} {}".format(compiler, flags, so_path, file_path)
-    subprocess.check_call(compile_cmd, shell=True)
+    key = make_key(_file, compiler, compiler_flags,
+                   get_compiler_identity(compiler))
+    lib = kernel_cache.get(key)
+    if lib is not None:
+        return lib
+    so_path = kernel_cache.path(key, "so")
+    if not kernel_cache.enabled or not os.path.exists(so_path):
+        print(_file)
+        build_dir = kernel_cache.directory if kernel_cache.enabled else hm_dir
+        fd, file_path = tempfile.mkstemp(dir=build_dir, suffix=".c")
+        with os.fdopen(fd, 'w') as f:
+            f.write(_file)
+        tmp_so_path = file_path[:-len(".c")] + ".so"
+        compile_cmd = "{} {} -o {} {}".format(compiler, compiler_flags,
+                                              tmp_so_path, file_path)
+        try:
+            subprocess.check_call(compile_cmd, shell=True)
+        finally:
+            os.remove(file_path)
+        if kernel_cache.enabled:
+            kernel_cache.store_file(key, "so", tmp_so_path)
+        else:
+            so_path = tmp_so_path
     lib = ct.cdll.LoadLibrary(so_path)
-    return lib
+    return kernel_cache.set(key, lib)
+
+
+helper_template = Template("""
+    $qualifier float $name($params) {
+        $decls
+$body
+        return $result;
+    }
+""")
+
+
+def render_helpers(helpers, declare, qualifier=""):
+    """
+    Return the definitions of the functions computing the elements of
+    inlined producers, see Kernel.add_helper.  declare(param) returns the
+    declaration of a parameter.
+    """
+    definitions = []
+    for name, params, registers, body, result in helpers:
+        params = [declare(param) for param in params]
+        params.append("int index")
+        decls = "".join("float {};".format(register)
+                        for register in registers)
+        body = "\n".join("\t\t" + line.lstrip()
+                         for line in simplify(body).splitlines())
+        definitions.append(helper_template.substitute(
+            qualifier=qualifier, name=name, params=", ".join(params),
+            decls=decls, body=body, result=simplify(result)))
+    return "".join(definitions)
+
+
+element_access = re.compile(r"\b([A-Za-z_]\w*)\[index\]")
+element_store = re.compile(r"^([A-Za-z_]\w*)\[index\]\s*=\s*([^=].*);$")
+float_literal = re.compile(
+    r"(?<![\w.])(\d+\.\d*(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)(?![\w.])")
+# Code that does not mean the same for vectors: comparisons, selects,
+# control flow, declarations and pow, which has no overload for a vector
+# and a scalar exponent
+scalar_only = re.compile(r"[<>?{}!]|==|\b(if|for|while|int|float|pow)\b")
+
+
+def vectorize(body, width):
+    """
+    Return body rewritten to process width consecutive elements starting
+    at index with vloadN and vstoreN, or None if it does more than
+    elementwise arithmetic on the elements at index.
+    """
+    lines = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if scalar_only.search(line) or \
+                "index" in element_access.sub("", line):
+            return None
+        store = element_store.match(line)
+        if store:
+            target, line = store.group(1), store.group(2)
+        elif "[index]" in line.split("=")[0]:
+            return None
+        line = element_access.sub(
+            r"vload{}(index, \1)".format(width), line)
+        line = float_literal.sub(r"\1f", line)
+        if store:
+            line = "vstore{}({}, index, {});".format(width, line, target)
+        lines.append("\t\t\t" + line)
+    return "\n".join(lines) + "\n"
+
+
+def get_tuning_key(kernel, device):
+    """
+    Return the key of kernel in the tuning database, a digest of its code
+    before tunable parameters are applied, its size and device.
+    """
+    helpers = [(name, sorted(param.name for param in params), registers,
+                body, result)
+               for name, params, registers, body, result in kernel.helpers]
+    return make_key(
+        kernel.body, helpers,
+        sorted((param.name, param.level) for param in kernel.sources),
+        sorted((param.name, param.level) for param in kernel.sinks),
+        kernel.launch_parameters, device)
+
+
+def load_parameters(kernel):
+    """
+    Set the parameters stored in the tuning database on kernel, when it
+    is first compiled and was not configured explicitly.  Kernels without
+    an entry are tuned when their arguments are first bound, if autotune
+    is enabled.
+    """
+    if kernel.configured:
+        return
+    kernel.configured = True
+    parameters = autotune.database.get(kernel.tuning_key())
+    if parameters is None:
+        kernel.tune_pending = autotune.enabled
+        return
+    for name, value in parameters.items():
+        if name in kernel.tunable:
+            setattr(kernel, name, value)
+
+
+# How each ReduceLevel reduction starts, takes in an element, combines two
+# partial results and finishes, as C snippets where v and i are the value
+# (and index) reduced so far and e and j those of the element or partial
+# result taken in
+argmax = ("if ({e} > {v} || ({e} == {v} && {j} < {i})) "
+          "{{ {v} = {e}; {i} = {j}; }}")
+reductions = {
+    "sum": ("0.0f", "{v} += {e};", "{v} += {e};", "{v}"),
+    "norm": ("0.0f", "{v} += {e} * {e};", "{v} += {e};", "sqrt({v})"),
+    "max": ("-INFINITY", "{v} = fmax({v}, {e});", "{v} = fmax({v}, {e});",
+            "{v}"),
+    "min": ("INFINITY", "{v} = fmin({v}, {e});", "{v} = fmin({v}, {e});",
+            "{v}"),
+    "argmax": ("-INFINITY", argmax, argmax, "(float) {i}"),
+}
+
+
+def get_reduction(kernel):
+    """
+    Return the initial value, element and combine statements and result
+    of the reduction of kernel (a ReduceKernel) as C code.
+    """
+    initial, take, combine, result = reductions[kernel.operation.reduction]
+    element = kernel.operation.element(kernel.operands, kernel.keywords)
+    take = take.format(v="_hm_value", i="_hm_index", e="_hm_element",
+                       j="index")
+    return initial, element, take, combine, result
+
+
+def get_kernel_params(kernel):
+    """
+    Return the parameters of kernel that are passed in memory, sorted by
+    name.
+    """
+    params = {}
+    for param in set(kernel.sources) | set(kernel.sinks):
+        if param.level != 'register':
+            params.setdefault(param.name, param)
+    return [params[name] for name in sorted(params)]
+
+
+def get_register_decls(kernel):
+    """
+    Return the declarations of the registers of kernel as C code.
+    """
+    names = set(param.name for param in set(kernel.sources) | set(kernel.sinks)
+                if param.level == 'register')
+    return "".join("float {};".format(name) for name in sorted(names))
+
+
+def define_taps(kernel, read):
+    """
+    Return the definitions of the macros the body of kernel (a
+    StencilKernel) reads neighbours through, see Param.neighbour.
+    read(source, radius) returns the C expression of the neighbour dy rows
+    and dx columns away.
+    """
+    return "".join(
+        "#define HM_TAP_{}(dy, dx) {}\n".format(name, read(source, radius))
+        for name, (source, radius) in sorted(kernel.stencils.items()))
+
+
+def undefine_taps(kernel):
+    return "".join("#undef HM_TAP_{}\n".format(name)
+                   for name in sorted(kernel.stencils))
+
+
+def add_stencil(kernel, source, radius):
+    """
+    Record that the body of kernel reads the neighbours of source within
+    radius (rows, columns), see StencilKernel.add_stencil.
+    """
+    if source.name in kernel.stencils:
+        source, (rows, columns) = kernel.stencils[source.name]
+        radius = (max(radius[0], rows), max(radius[1], columns))
+    kernel.stencils[source.name] = (source, tuple(radius))
 
 
 if backend in {"ocl", "opencl", "OCL"}:
+    def declare_param(param, sinks=()):
+        """
+        Return the declaration of param as a kernel parameter, scalars
+        and filters passed at run time (see Param.constant) are a float
+        and a pointer to constant memory.
+        """
+        if param.level == 'scalar':
+            return "const float " + param.name
+        if param.level == 'constant':
+            return "constant float* " + param.name
+        if param.name in sinks:
+            return "global float* " + param.name
+        return "global const float* " + param.name
+
+    def get_argtypes(params):
+        return tuple(cl.cl_float if param.level == 'scalar' else cl.cl_mem
+                     for param in params)
+
+    def get_argument(param, arg):
+        """
+        Return the value of kernel argument param for arg and the array
+        holding it: filters that are not float32 device arrays are copied
+        to one, the copy must live as long as it is bound.
+        """
+        if param.level == 'scalar':
+            return float(arg), arg
+        if param.level == 'constant' and (
+                not isinstance(arg, hm.hmarray) or arg.dtype != np.float32):
+            arg = np.ascontiguousarray(arg, np.float32).view(hm.hmarray)
+        return arg.ocl_buf, arg
+
     class Kernel(object):
+        # Values of the code generation parameters worth trying, see
+        # configure
+        tunable = {
+            "vector_width": (1, 2, 4, 8),
+            "coarsening": (1, 2, 4, 8, 16),
+            "coarsening_order": ("contiguous", "strided"),
+            # None pads the global size to 32 and leaves the work group
+            # size to the runtime
+            "local_size": (None, ) + tuple(
+                size for size in (32, 64, 128, 256)
+                if size <= devices[-1].max_work_group_size),
+        }
+
         def __init__(self, launch_parameters):
             self.launch_parameters = launch_parameters
             self.body = ""
@@ -76,13 +560,45 @@ if backend in {"ocl", "opencl", "OCL"}:
             self.sinks = set()
             self.kernel = None
             self.kernel_str = None
+            self.bound = []
+            self.helpers = []
+            self.vector_width = vector_width
+            self.coarsening = coarsening
+            self.coarsening_order = coarsening_order
+            self.local_size = None
+            self.configured = False
+            self.tune_pending = False
 
         def append_body(self, string):
             lines = [l.lstrip() for l in string.splitlines()]
             self.body += "\t\t\t" + "\n\t\t\t".join(lines) + "\n"
 
+        def add_helper(self, name, params, registers, body, result):
+            """
+            Define a function of the element index, called by gathering
+            operations in the body.  It declares registers, runs body and
+            returns result, params are the buffers body reads.
+            """
+            self.helpers.append((name, params, registers, body, result))
+            self.sources.update(params)
+
+        def configure(self, **parameters):
+            """
+            Set code generation parameters (the keys of tunable) and
+            compile the kernel again.
+            """
+            for name, value in parameters.items():
+                if name not in self.tunable:
+                    raise ValueError(
+                        "{} is not a tunable parameter".format(name))
+                setattr(self, name, value)
+            self.configured = True
+            self.kernel = None
+            self.compile()
+
         def compile(self):
             if self.kernel is None:
+                load_parameters(self)
                 params = set(self.sources) | set(self.sinks)
                 seen_decls = set()
                 seen_params = set()
@@ -99,65 +615,476 @@ if backend in {"ocl", "opencl", "OCL"}:
                             filtered.add(param)
                 self.params = list(filtered)
                 self.params.sort(key=lambda x: x.name)
-                params = []
                 sinks = set(sink.name for sink in self.sinks)
-                for param in self.params:
-                    if param.name in sinks:
-                        str = "global float* {}".format(param.name)
-                    else:
-                        str = "global const float* {}".format(param.name)
-                    params.append(str)
-                params_str = ", ".join(params)
+                params_str = ", ".join(declare_param(param, sinks)
+                                       for param in self.params)
+                helpers = render_helpers(self.helpers, declare_param)
+                body = optimize(self.body)
+                num_work_items = self.launch_parameters[0]
+                width = self.vector_width
+                vector_body = None
+                if width > 1 and not self.helpers:
+                    vector_body = vectorize(body, width)
+                if vector_body is None:
+                    width = 1
                 decls = ";\n\t\t\t".join(decls) + ";\n"
-                kernel_name = get_unique_kernel_name()
-                kernel = Template("""
-    __kernel void $name($params) {
-        int index = get_global_id(0);
-        if (index < $num_work_items) {
+                if width == 1:
+                    units = num_work_items
+                    unit = Template("""if (index < $num_work_items) {
             $decls
 $body
-        }
+        }""").substitute(num_work_items=num_work_items, decls=decls,
+                         body=body)
+                else:
+                    # Unit index loads and stores vector index (the
+                    # elements from index * width), one more unit
+                    # processes the elements left over one at a time
+                    units = vectors = num_work_items // width
+                    tail = ""
+                    if num_work_items % width:
+                        units += 1
+                        tail = Template(""" else if (index == $vectors) {
+            $decls
+            for (index = $start; index < $num_work_items; index++) {
+$body
+            }
+        }""").substitute(vectors=vectors, start=vectors * width,
+                         num_work_items=num_work_items, decls=decls,
+                         body=body)
+                    unit = Template("""if (index < $vectors) {
+            $decls
+$body
+        }$tail""").substitute(
+                        vectors=vectors, body=vector_body, tail=tail,
+                        decls=decls.replace("float ",
+                                            "float{} ".format(width)))
+                local_size = self.local_size or 32
+                coarsening = max(min(self.coarsening, units), 1)
+                global_size = (units + coarsening - 1) // coarsening
+                if global_size % local_size:
+                    padded = (global_size + (local_size - 1)) & \
+                        (~(local_size - 1))
+                else:
+                    padded = global_size
+                if coarsening == 1:
+                    first = "get_global_id(0)"
+                elif self.coarsening_order == "strided":
+                    # Consecutive work items access consecutive units
+                    first = "get_global_id(0) + _hm_unit * {}".format(padded)
+                else:
+                    first = "get_global_id(0) * {} + _hm_unit".format(
+                        coarsening)
+                # Name kernels after their contents so identical kernels
+                # share a cache entry
+                kernel_name = "hm_" + make_key(
+                    params_str, helpers, unit, first, coarsening)[:16]
+                kernel = Template("""$helpers
+    __kernel void $name($params) {
+      for (int _hm_unit = 0; _hm_unit < $coarsening; _hm_unit++) {
+        int index = $first;
+        $unit
+      }
     }
-        """).substitute(name=kernel_name, params=params_str, body=self.body, decls=decls,
-                        num_work_items=self.launch_parameters[0])
+        """).substitute(name=kernel_name, params=params_str,
+                        helpers=helpers, coarsening=coarsening, first=first,
+                        unit=unit)
                 # print([p.name for p in self.params])
                 print(kernel)
                 self.kernel_str = kernel
-                kernel = cl.clCreateProgramWithSource(
-                    context, kernel).build()[kernel_name]
-                kernel.argtypes = tuple(cl.cl_mem for _ in self.params)
+                kernel = build_program(kernel)[kernel_name]
+                kernel.argtypes = get_argtypes(self.params)
+                self.global_size = (padded, )
+                self.local_work_size = None
+                if self.local_size is not None:
+                    self.local_work_size = (self.local_size, )
+                self.bound = [None for _ in self.params]
+                self.held = [None for _ in self.params]
                 self.kernel = kernel
 
+        def set_args(self, args):
+            """
+            Bind the buffers of args (hmarrays, or the values of scalars
+            and filters passed at run time, in the order of self.params)
+            to the kernel, arguments are only set again when a different
+            object is passed.
+            """
+            if self.tune_pending:
+                self.tune_pending = False
+                autotune.tune(self, args)
+            bound = self.bound
+            for index, arg in enumerate(args):
+                if arg is not bound[index]:
+                    value, self.held[index] = get_argument(
+                        self.params[index], arg)
+                    self.kernel.setarg(index, value)
+                    bound[index] = arg
+
+        def enqueue(self, wait_for=None):
+            """
+            Launch the kernel with the arguments last bound by set_args.
+            """
+            queue, wait_for = queue_scheduler.get_queue(wait_for)
+            evt = cl.clEnqueueNDRangeKernel(queue, self.kernel,
+                                            self.global_size,
+                                            self.local_work_size,
+                                            wait_for=wait_for)
+            queue_scheduler.submitted(queue, evt)
+            return [evt]
+
         def launch(self, symbol_table, wait_for=None):
-            args = []
-            for param in self.params:
-                val = symbol_table[param.name]
-                if hasattr(val, 'ocl_buf'):
-                    args.append(val.ocl_buf)
-            global_size = self.launch_parameters[0]
-            local_size = 32
-            if global_size % local_size:
-                padded = (global_size + (local_size - 1)) & (~(local_size - 1))
-            else:
-                padded = global_size
-            evt = self.kernel(*args).on(queues[random.randint(0, len(queues) - 1)],
-                                        (padded,), wait_for=wait_for)
+            self.set_args([symbol_table[param.name]
+                           for param in self.params])
+            return self.enqueue(wait_for)
+
+        def tuning_key(self):
+            return get_tuning_key(self, device_identity)
+
+    class ReduceKernel(Kernel):
+        """
+        Kernel reducing the elements operation.element computes to the
+        single element of its sink, see ReduceLevel.  Every work group
+        reduces a share of the elements in local memory to a partial
+        result, a second kernel of one work group reduces the partial
+        results.
+        """
+        tunable = {
+            "local_size": tuple(
+                size for size in (64, 128, 256)
+                if size <= devices[-1].max_work_group_size),
+        }
+
+        def __init__(self, operation, operands, keywords, count):
+            super(ReduceKernel, self).__init__((count, ))
+            self.operation = operation
+            self.operands = operands
+            self.keywords = keywords
+            self.local_size = self.tunable["local_size"][-1]
+            self.last_event = None
+
+        def tuning_key(self):
+            # The reduction is not part of the body
+            element = self.operation.element(self.operands, self.keywords)
+            return make_key(super(ReduceKernel, self).tuning_key(),
+                            self.operation.reduction, element)
+
+        def compile(self):
+            if self.kernel is None:
+                load_parameters(self)
+                self.params = get_kernel_params(self)
+                sinks = set(sink.name for sink in self.sinks)
+                params = [declare_param(param, sinks)
+                          for param in self.params]
+                initial, element, take, combine, result = \
+                    get_reduction(self)
+                count = self.launch_parameters[0]
+                local_size = self.local_size
+                groups = max(min((count + local_size - 1) // local_size,
+                                 local_size), 1)
+                kernel = Template("""$helpers
+    #define HM_COMBINE(v, i, e, j) $combine
+    #define HM_REDUCE_LOCAL(values, indices) \\
+      for (int offset = $local_size / 2; offset > 0; offset /= 2) { \\
+        if (id < offset) { \\
+          HM_COMBINE(values[id], indices[id], values[id + offset], \\
+                     indices[id + offset]); \\
+        } \\
+        barrier(CLK_LOCAL_MEM_FENCE); \\
+      }
+    __kernel void hm_reduce_partial($params, global float* partial_values,
+                                    global int* partial_indices) {
+      local float values[$local_size];
+      local int indices[$local_size];
+      int id = get_local_id(0);
+      float _hm_value = $initial;
+      int _hm_index = INT_MAX;
+      for (int index = get_global_id(0); index < $count;
+           index += get_global_size(0)) {
+        float _hm_element = $element;
+        $take
+      }
+      values[id] = _hm_value;
+      indices[id] = _hm_index;
+      barrier(CLK_LOCAL_MEM_FENCE);
+      HM_REDUCE_LOCAL(values, indices)
+      if (id == 0) {
+        partial_values[get_group_id(0)] = values[0];
+        partial_indices[get_group_id(0)] = indices[0];
+      }
+    }
+    __kernel void hm_reduce_final(global const float* partial_values,
+                                  global const int* partial_indices,
+                                  global float* out) {
+      local float values[$local_size];
+      local int indices[$local_size];
+      int id = get_local_id(0);
+      float _hm_value = $initial;
+      int _hm_index = INT_MAX;
+      for (int index = id; index < $groups; index += $local_size) {
+        HM_COMBINE(_hm_value, _hm_index, partial_values[index],
+                   partial_indices[index]);
+      }
+      values[id] = _hm_value;
+      indices[id] = _hm_index;
+      barrier(CLK_LOCAL_MEM_FENCE);
+      HM_REDUCE_LOCAL(values, indices)
+      if (id == 0) {
+        out[0] = $result;
+      }
+    }
+    """).substitute(
+                    helpers=render_helpers(self.helpers, declare_param),
+                    combine=combine.format(v="v", i="i", e="e", j="j"),
+                    params=", ".join(params), initial=initial,
+                    element=simplify(element), take=take, count=count,
+                    local_size=local_size, groups=groups,
+                    result=result.format(v="values[0]", i="indices[0]"))
+                self.kernel_str = kernel
+                program = build_program(kernel)
+                self.partial = program["hm_reduce_partial"]
+                self.final = program["hm_reduce_final"]
+                self.partial.argtypes = get_argtypes(self.params) + (
+                    cl.cl_mem, cl.cl_mem)
+                partial_values = hm.zeros((groups, ))
+                partial_indices = hm.zeros((groups, ), np.int32)
+                num_params = len(self.params)
+                self.partial.setarg(num_params, partial_values.ocl_buf)
+                self.partial.setarg(num_params + 1, partial_indices.ocl_buf)
+                self.final.setarg(0, partial_values.ocl_buf)
+                self.final.setarg(1, partial_indices.ocl_buf)
+                self.partials = partial_values, partial_indices
+                self.global_size = (groups * local_size, )
+                self.local_work_size = (local_size, )
+                self.bound = [None for _ in self.params]
+                self.held = [None for _ in self.params]
+                self.kernel = self.partial
+
+        def set_args(self, args):
+            if self.tune_pending:
+                self.tune_pending = False
+                autotune.tune(self, args)
+            sinks = set(sink.name for sink in self.sinks)
+            bound = self.bound
+            for index, arg in enumerate(args):
+                if arg is not bound[index]:
+                    value, self.held[index] = get_argument(
+                        self.params[index], arg)
+                    self.partial.setarg(index, value)
+                    if self.params[index].name in sinks:
+                        self.final.setarg(2, value)
+                    bound[index] = arg
+
+        def enqueue(self, wait_for=None):
+            """
+            Launch both kernels, after the previous launch so the partial
+            results are not overwritten while they are read.
+            """
+            wait_for = list(wait_for or [])
+            if self.last_event is not None:
+                wait_for.append(self.last_event)
+            queue, wait_for = queue_scheduler.get_queue(wait_for)
+            evt = cl.clEnqueueNDRangeKernel(queue, self.partial,
+                                            self.global_size,
+                                            self.local_work_size,
+                                            wait_for=wait_for)
+            evt = cl.clEnqueueNDRangeKernel(queue, self.final,
+                                            self.local_work_size,
+                                            self.local_work_size,
+                                            wait_for=[evt])
+            queue_scheduler.submitted(queue, evt)
+            self.last_event = evt
             return [evt]
+
+    class StencilKernel(Kernel):
+        """
+        Kernel of element and StencilLevel operations over a 2D array of
+        shape (rows, columns).  Work groups of tile_shape (columns, rows)
+        work items first load the tile of every stenciled source they
+        read, and the halo around it, into local memory, taps then read
+        the tile.  Only the work groups whose halo crosses an edge of the
+        array clamp the coordinates they load.
+        """
+        tunable = {
+            "tile_shape": tuple(
+                shape for shape in ((8, 8), (16, 8), (16, 16), (32, 8),
+                                    (64, 4))
+                if shape[0] * shape[1] <= devices[-1].max_work_group_size),
+        }
+
+        def __init__(self, launch_parameters, shape):
+            super(StencilKernel, self).__init__(launch_parameters)
+            self.shape = tuple(shape)
+            self.stencils = {}
+            shapes = self.tunable["tile_shape"]
+            self.tile_shape = (16, 16) if (16, 16) in shapes else shapes[0]
+
+        def add_stencil(self, source, radius):
+            """
+            Read the neighbours of source within radius (rows, columns)
+            from a tile in local memory.
+            """
+            add_stencil(self, source, radius)
+
+        def compile(self):
+            if self.kernel is None:
+                load_parameters(self)
+                self.params = get_kernel_params(self)
+                sinks = set(sink.name for sink in self.sinks)
+                params = [declare_param(param, sinks)
+                          for param in self.params]
+                height, width = self.shape
+                tile_w, tile_h = self.tile_shape
+                tiles = []
+                for name, (source, (rows, columns)) in \
+                        sorted(self.stencils.items()):
+                    pitch = tile_w + 2 * columns
+                    tiles.append(self.tile_template.substitute(
+                        name=name, rows=rows, columns=columns, pitch=pitch,
+                        size=pitch * (tile_h + 2 * rows), tile_w=tile_w,
+                        tile_h=tile_h, height=height, width=width,
+                        group_size=tile_w * tile_h,
+                        load=simplify(source.gather("index"))))
+
+                def read(source, radius):
+                    rows, columns = radius
+                    return ("_hm_tile_{}[(_hm_ly + {} + (dy)) * {} + "
+                            "_hm_lx + {} + (dx)]").format(
+                                source.name, rows, tile_w + 2 * columns,
+                                columns)
+
+                helpers = render_helpers(self.helpers, declare_param)
+                # Name kernels after their contents so identical kernels
+                # share a cache entry
+                kernel_name = "hm_" + make_key(
+                    params, helpers, tiles, self.body, self.shape)[:16]
+                kernel = Template("""$helpers
+$taps
+    __kernel void $name($params) {
+      const int _hm_lx = get_local_id(0);
+      const int _hm_ly = get_local_id(1);
+      const int _hm_lid = _hm_ly * $tile_w + _hm_lx;
+      $tiles
+      barrier(CLK_LOCAL_MEM_FENCE);
+      if (get_global_id(0) < $width && get_global_id(1) < $height) {
+        int index = get_global_id(1) * $width + get_global_id(0);
+        $decls
+$body
+      }
+    }
+        """).substitute(name=kernel_name, params=", ".join(params),
+                        helpers=helpers, taps=define_taps(self, read),
+                        tile_w=tile_w, tiles="".join(tiles), width=width,
+                        height=height, decls=get_register_decls(self),
+                        body=optimize(self.body))
+                self.kernel_str = kernel
+                kernel = build_program(kernel)[kernel_name]
+                kernel.argtypes = get_argtypes(self.params)
+                self.global_size = (
+                    (width + tile_w - 1) // tile_w * tile_w,
+                    (height + tile_h - 1) // tile_h * tile_h)
+                self.local_work_size = (tile_w, tile_h)
+                self.bound = [None for _ in self.params]
+                self.held = [None for _ in self.params]
+                self.kernel = kernel
+
+        # Loads the tile of source name starting rows rows above and
+        # columns columns left of the work group's elements, every work
+        # item loads elements group_size apart
+        tile_template = Template("""
+      local float _hm_tile_$name[$size];
+      {
+        const int x0 = get_group_id(0) * $tile_w - $columns;
+        const int y0 = get_group_id(1) * $tile_h - $rows;
+        if (x0 >= 0 && y0 >= 0 && x0 + $pitch <= $width &&
+            y0 + $tile_h + 2 * $rows <= $height) {
+          for (int t = _hm_lid; t < $size; t += $group_size) {
+            int ty = t / $pitch;
+            int index = (y0 + ty) * $width + x0 + t - ty * $pitch;
+            _hm_tile_$name[t] = $load;
+          }
+        } else {
+          for (int t = _hm_lid; t < $size; t += $group_size) {
+            int ty = t / $pitch;
+            int index = clamp(y0 + ty, 0, $height - 1) * $width +
+                        clamp(x0 + t - ty * $pitch, 0, $width - 1);
+            _hm_tile_$name[t] = $load;
+          }
+        }
+      }""")
+
+        def tuning_key(self):
+            return make_key(super(StencilKernel, self).tuning_key(),
+                            self.shape)
 elif backend in {"omp", "openmp"}:
+    def declare_param(param, sinks=()):
+        """
+        Return the declaration of param as a function parameter, scalars
+        passed at run time (see Param.constant) are a float.
+        """
+        if param.level == 'scalar':
+            return "float " + param.name
+        return "float* " + param.name
+
+    def get_argument(param, arg):
+        """
+        Return the ctypes value of function argument param for arg and the
+        array holding it: filters that are not float32 are copied, the
+        copy must live as long as it is bound.
+        """
+        if param.level == 'scalar':
+            return ct.c_float(arg), arg
+        if param.level == 'constant':
+            arg = np.ascontiguousarray(arg, np.float32)
+        return arg.ctypes.data_as(ct.c_void_p), arg
 
     class Kernel(object):
+        # The iterations of a loop are already split into one contiguous
+        # range per thread, there is nothing to coarsen
+        tunable = {
+            "vector_width": (1, 4, 8, 16),
+        }
+
         def __init__(self, launch_parameters):
             self.launch_parameters = launch_parameters
             self.body = ""
             self.sources = set()
             self.sinks = set()
             self.kernel = None
+            self.arrays = []
+            self.args = []
+            self.helpers = []
+            self.vector_width = vector_width
+            self.configured = False
+            self.tune_pending = False
 
         def append_body(self, string):
             self.body += string + "\n"
 
+        def add_helper(self, name, params, registers, body, result):
+            """
+            Define a function of the element index, called by gathering
+            operations in the body.  It declares registers, runs body and
+            returns result, params are the buffers body reads.
+            """
+            self.helpers.append((name, params, registers, body, result))
+            self.sources.update(params)
+
+        def configure(self, **parameters):
+            """
+            Set code generation parameters (the keys of tunable) and
+            compile the kernel again.
+            """
+            for name, value in parameters.items():
+                if name not in self.tunable:
+                    raise ValueError(
+                        "{} is not a tunable parameter".format(name))
+                setattr(self, name, value)
+            self.configured = True
+            self.kernel = None
+            self.compile()
+
         def compile(self):
             if self.kernel is None:
+                load_parameters(self)
                 params = set(self.sources) | set(self.sinks)
                 seen_decls = set()
                 seen_params = set()
@@ -173,38 +1100,296 @@ elif backend in {"omp", "openmp"}:
                             seen_params.add(param.name)
                             filtered.add(param)
                 self.params = list(filtered)
-                params = []
-                for param in self.params:
-                    _str = "float* {}".format(param.name)
-                    params.append(_str)
-                params_str = ", ".join(params)
+                params_str = ", ".join(declare_param(param)
+                                       for param in self.params)
                 decls = ";\n\t\t\t".join(decls) + ";\n"
+                pragmas = {"fn": "parallel for"}
+                if self.vector_width > 1:
+                    pragmas["fn"] = "parallel for simd simdlen({})".format(
+                        self.vector_width)
+                    # Called instead of fn when every array is aligned
+                    pragmas["fn_aligned"] = "{} aligned({}: {})".format(
+                        pragmas["fn"],
+                        ", ".join(param.name for param in self.params
+                                  if param.level != 'scalar'),
+                        hm.alignment)
+                function = Template("""
+     void $name($params) {
+        #pragma omp $pragma
+        for (int index = 0; index < $num_work_items; index++) {
+            $decls
+            $body
+        }
+    }
+                """)
+                functions = "".join(function.substitute(
+                    name=name, pragma=pragmas[name], params=params_str,
+                    body=optimize(self.body), decls=decls,
+                    num_work_items=self.launch_parameters[0])
+                    for name in sorted(pragmas))
                 kernel = Template("""
      #include <math.h>
      #include <float.h>
      #define max(a,b) ((a) > (b) ? a : b)
      #define min(a,b) ((a) < (b) ? a : b)
+     $helpers
+     $functions
+        """).substitute(functions=functions,
+                        helpers=render_helpers(self.helpers, declare_param,
+                                               "static"))
+                lib = hm_compile_and_load(kernel)
+                # Identical kernels share a library, each gets its own
+                # function pointer
+                self.funcs = dict((name, lib[name]) for name in pragmas)
+                for func in self.funcs.values():
+                    func.restype = None
+                self.func = self.funcs["fn"]
+                self.arrays = [None for _ in self.params]
+                self.args = [None for _ in self.params]
+                self.held = [None for _ in self.params]
+                self.kernel = self.func
+
+        def set_args(self, args):
+            """
+            Bind args (hmarrays, or the values of scalars and filters
+            passed at run time, in the order of self.params) to the
+            kernel, arguments are only taken again when a different object
+            is passed.  Simd kernels assume aligned pointers only when all
+            of them are.
+            """
+            if self.tune_pending:
+                self.tune_pending = False
+                autotune.tune(self, args)
+            arrays = self.arrays
+            changed = False
+            for index, arg in enumerate(args):
+                if arg is not arrays[index]:
+                    self.args[index], self.held[index] = get_argument(
+                        self.params[index], arg)
+                    arrays[index] = arg
+                    changed = True
+            if changed and "fn_aligned" in self.funcs:
+                if all(arg.value % hm.alignment == 0
+                       for arg, param in zip(self.args, self.params)
+                       if param.level != 'scalar'):
+                    self.func = self.funcs["fn_aligned"]
+                else:
+                    self.func = self.funcs["fn"]
+
+        def enqueue(self, wait_for=None):
+            self.func(*self.args)
+
+        def launch(self, symbol_table, wait_for):
+            self.set_args([symbol_table[param.name]
+                           for param in self.params])
+            self.enqueue(wait_for)
+
+        def tuning_key(self):
+            compiler = os.environ.get("CC", "CC")
+            return get_tuning_key(self, make_key(
+                get_compiler_identity(compiler), compiler_flags,
+                multiprocessing.cpu_count()))
+
+    class ReduceKernel(Kernel):
+        """
+        Kernel reducing the elements operation.element computes to the
+        single element of its sink, see ReduceLevel.  Each thread reduces
+        a share of the elements, an omp reduction (or for argmax a
+        critical section) combines the results of the threads.
+        """
+        tunable = {}
+        operators = {"sum": "+", "norm": "+", "max": "max", "min": "min"}
+
+        def __init__(self, operation, operands, keywords, count):
+            super(ReduceKernel, self).__init__((count, ))
+            self.operation = operation
+            self.operands = operands
+            self.keywords = keywords
+
+        def tuning_key(self):
+            # The reduction is not part of the body
+            element = self.operation.element(self.operands, self.keywords)
+            return make_key(super(ReduceKernel, self).tuning_key(),
+                            self.operation.reduction, element)
+
+        def compile(self):
+            if self.kernel is None:
+                load_parameters(self)
+                self.params = get_kernel_params(self)
+                initial, element, take, combine, result = \
+                    get_reduction(self)
+                operator = self.operators.get(self.operation.reduction)
+                if operator is not None:
+                    loop = Template("""
+        #pragma omp parallel for reduction($operator: _hm_value)
+        for (int index = 0; index < $count; index++) {
+          float _hm_element = $element;
+          $take
+        }""")
+                else:
+                    loop = Template("""
+        #pragma omp parallel
+        {
+          float _hm_thread_value = $initial;
+          int _hm_thread_index = INT_MAX;
+          #pragma omp for nowait
+          for (int index = 0; index < $count; index++) {
+            float _hm_element = $element;
+            $thread_take
+          }
+          #pragma omp critical
+          $thread_combine
+        }""")
+                loop = loop.substitute(
+                    operator=operator, count=self.launch_parameters[0],
+                    element=simplify(element), take=take, initial=initial,
+                    thread_take=take.replace("_hm_value", "_hm_thread_value")
+                    .replace("_hm_index", "_hm_thread_index"),
+                    thread_combine=combine.format(
+                        v="_hm_value", i="_hm_index", e="_hm_thread_value",
+                        j="_hm_thread_index"))
+                sink = [sink.name for sink in self.sinks][0]
+                kernel = Template("""
+     #include <math.h>
+     #include <limits.h>
+     $helpers
      void fn($params) {
-        #pragma omp parallel for
-        for (int index = 0; index < $num_work_items; index++) {
-            $decls
-            $body
+        float _hm_value = $initial;
+        int _hm_index = INT_MAX;
+        $loop
+        $sink[0] = $result;
+    }
+        """).substitute(
+                    helpers=render_helpers(self.helpers, declare_param,
+                                           "static"),
+                    params=", ".join(declare_param(param)
+                                     for param in self.params),
+                    initial=initial, loop=loop, sink=sink,
+                    result=result.format(v="_hm_value", i="_hm_index"))
+                lib = hm_compile_and_load(kernel)
+                self.func = lib["fn"]
+                self.func.restype = None
+                self.funcs = {"fn": self.func}
+                self.arrays = [None for _ in self.params]
+                self.args = [None for _ in self.params]
+                self.held = [None for _ in self.params]
+                self.kernel = self.func
+
+    class StencilKernel(Kernel):
+        """
+        Kernel of element and StencilLevel operations over a 2D array of
+        shape (rows, columns).  Threads share blocks of tile_shape
+        (columns, rows) elements, small enough for the rows a stencil
+        reads to stay in cache.  Elements whose taps are all inside the
+        array are computed without clamping coordinates.
+        """
+        tunable = {
+            "tile_shape": ((64, 16), (256, 16), (1024, 8), (4096, 4)),
+        }
+
+        def __init__(self, launch_parameters, shape):
+            super(StencilKernel, self).__init__(launch_parameters)
+            self.shape = tuple(shape)
+            self.stencils = {}
+            self.tile_shape = (256, 16)
+
+        def add_stencil(self, source, radius):
+            """
+            Read the neighbours of source within radius (rows, columns)
+            of each element.
+            """
+            add_stencil(self, source, radius)
+
+        def compile(self):
+            if self.kernel is None:
+                load_parameters(self)
+                self.params = get_kernel_params(self)
+                height, width = self.shape
+                tile_w, tile_h = self.tile_shape
+                # Elements at least rows rows and columns columns from the
+                # edges are interior
+                rows = max(radius[0] for _, radius in self.stencils.values())
+                columns = max(radius[1]
+                              for _, radius in self.stencils.values())
+
+                def read_interior(source, radius):
+                    return source.gather(
+                        "index + (dy) * {} + (dx)".format(width))
+
+                def read_edge(source, radius):
+                    return source.gather(
+                        "min(max(_hm_y + (dy), 0), {}) * {} + "
+                        "min(max(_hm_x + (dx), 0), {})".format(
+                            height - 1, width, width - 1))
+
+                body = optimize(self.body)
+                decls = get_register_decls(self)
+                kernel = Template("""
+     #include <math.h>
+     #include <float.h>
+     #define max(a,b) ((a) > (b) ? a : b)
+     #define min(a,b) ((a) < (b) ? a : b)
+     $helpers
+     void fn($params) {
+        #pragma omp parallel for collapse(2) schedule(static)
+        for (int _hm_by = 0; _hm_by < $height; _hm_by += $tile_h) {
+          for (int _hm_bx = 0; _hm_bx < $width; _hm_bx += $tile_w) {
+            const int _hm_y_end = min(_hm_by + $tile_h, $height);
+            const int _hm_x_end = min(_hm_bx + $tile_w, $width);
+            for (int _hm_y = _hm_by; _hm_y < _hm_y_end; _hm_y++) {
+              // Columns [_hm_begin, _hm_end) of the row are interior
+              int _hm_begin = _hm_x_end;
+              int _hm_end = _hm_x_end;
+              if (_hm_y >= $rows && _hm_y < $height - $rows) {
+                _hm_begin = min(max(_hm_bx, $columns), _hm_x_end);
+                _hm_end = max(min(_hm_x_end, $width - $columns), _hm_begin);
+              }
+$interior_taps
+              for (int _hm_x = _hm_begin; _hm_x < _hm_end; _hm_x++) {
+                int index = _hm_y * $width + _hm_x;
+                $decls
+$body
+              }
+$undefine_taps
+$edge_taps
+              for (int _hm_x = _hm_bx; _hm_x < _hm_x_end; _hm_x++) {
+                if (_hm_x == _hm_begin) {
+                  _hm_x = _hm_end;
+                  if (_hm_x == _hm_x_end) {
+                    break;
+                  }
+                }
+                int index = _hm_y * $width + _hm_x;
+                $decls
+$body
+              }
+$undefine_taps
+            }
+          }
         }
     }
-        """).substitute(params=params_str, body=self.body, decls=decls,
-                        num_work_items=self.launch_parameters[0])
+        """).substitute(
+                    helpers=render_helpers(self.helpers, declare_param,
+                                           "static"),
+                    params=", ".join(declare_param(param)
+                                     for param in self.params),
+                    height=height, width=width, tile_w=tile_w, tile_h=tile_h,
+                    rows=rows, columns=columns, decls=decls, body=body,
+                    interior_taps=define_taps(self, read_interior),
+                    edge_taps=define_taps(self, read_edge),
+                    undefine_taps=undefine_taps(self))
                 lib = hm_compile_and_load(kernel)
-                self.func = lib.fn
+                self.func = lib["fn"]
                 self.func.restype = None
+                self.funcs = {"fn": self.func}
+                self.arrays = [None for _ in self.params]
+                self.args = [None for _ in self.params]
+                self.held = [None for _ in self.params]
+                self.kernel = self.func
 
-        def launch(self, symbol_table, wait_for):
-            args = []
-            for param in self.params:
-                val = symbol_table[param.name]
-                args.append(val)
-            self.func.argtypes = (
-                np.ctypeslib.ndpointer(p.dtype, p.ndim, p.shape) for p in args)
-            self.func(*args)
+        def tuning_key(self):
+            return make_key(super(StencilKernel, self).tuning_key(),
+                            self.shape)
 else:
     raise NotImplementedError(
         "Hindemith has not implemented a backend called " + backend)
@@ -2,8 +2,7 @@ import ctypes as ct
 import pycl as cl
 import os
 
-from hindemith.cl import queues, context
-import random
+from hindemith.cl import queues, context, queue_scheduler
 
 try:
     from sys import platform as _platform
@@ -35,6 +34,9 @@ def make_event_array(events):
         events = [events]
     valid_events = [e for e in events if e]
     numevents = len(valid_events)
+    if numevents == 0:
+        # OpenCL requires a null wait list when there is nothing to wait on
+        return 0, None
     event_array = (cl.cl_event * numevents)()
     for i, e in enumerate(valid_events):
         event_array[i] = e
@@ -43,8 +45,14 @@ def make_event_array(events):
 
 def sgemm(transA, transB, alpha, A, A_offset, lda, B, B_offset, ldb, beta, C,
           C_offset, ldc, m, n, k, _queue=None, wait_for=None):
+    # Called outside a composed block, order against the events recorded
+    # on the arrays
+    track_events = wait_for is None
+    if track_events:
+        wait_for = A.get_wait_events(False) + B.get_wait_events(False) + \
+            C.get_wait_events(True)
     if _queue is None:
-        _queue = queues[random.randint(0, len(queues) - 1)]
+        _queue, wait_for = queue_scheduler.get_queue(wait_for)
     cblas_row_major = ct.c_int(0)
     transA = ct.c_int(1 if transA else 0)
     transB = ct.c_int(1 if transB else 0)
@@ -56,10 +64,7 @@ def sgemm(transA, transB, alpha, A, A_offset, lda, B, B_offset, ldb, beta, C,
     k = ct.c_size_t(int(k))
     alpha = ct.c_float(alpha)
     beta = ct.c_float(beta)
-    if wait_for is None:
-        num_wait = 0
-    else:
-        num_wait, wait_for = make_event_array(wait_for)
+    num_wait, wait_for = make_event_array(wait_for)
     done_evt = cl.cl_event()
     err = _clblaslib.clblasSgemm(cblas_row_major, transA, transB, m, n, k,
                                  alpha, A.ocl_buf, ct.c_size_t(A_offset),
@@ -70,6 +75,11 @@ def sgemm(transA, transB, alpha, A, A_offset, lda, B, B_offset, ldb, beta, C,
                                  ct.byref(done_evt))
     if err:
         raise Exception("clBLAS sgemm returned error code {}".format(err))
+    queue_scheduler.submitted(_queue, done_evt)
+    if track_events:
+        A.record_read([done_evt])
+        B.record_read([done_evt])
+        C.record_write([done_evt])
     return done_evt
 
 
@@ -84,11 +94,11 @@ def sgemv(transA, M, N, alpha, bufA, offA, lda, bufX, offX, incx, beta, bufY,
     N = ct.c_size_t(int(N))
     alpha = ct.c_float(alpha)
     beta = ct.c_float(beta)
-    if wait_for is None:
-        num_wait = 0
-    else:
-        num_wait = 1
-        wait_for = ct.byref(wait_for)
+    track_events = wait_for is None
+    if track_events:
+        wait_for = bufA.get_wait_events(False) + \
+            bufX.get_wait_events(False) + bufY.get_wait_events(True)
+    num_wait, wait_for = make_event_array(wait_for)
     done_evt = cl.cl_event()
     err = _clblaslib.clblasSgemv(cblas_row_major, transA, M, N,
                                  alpha, bufA.ocl_buf, ct.c_size_t(offA), lda,
@@ -99,6 +109,10 @@ def sgemv(transA, M, N, alpha, bufA, offA, lda, bufX, offX, incx, beta, bufY,
                                  ct.byref(done_evt))
     if err:
         raise Exception("clBLAS sgemv returned error code {}".format(err))
+    if track_events:
+        bufA.record_read([done_evt])
+        bufX.record_read([done_evt])
+        bufY.record_write([done_evt])
     return done_evt
 
 
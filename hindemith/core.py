@@ -2,16 +2,33 @@ import ast
 import inspect
 import sys
 import textwrap
+from collections import OrderedDict
+from functools import partial
+from operator import is_, lt, le, gt, ge, add, sub, mul, truediv, \
+    floordiv, mod, pow
+import numpy as np
 import hindemith as hm
-from hindemith.operations.core import HMOperation, DeviceLevel
-from hindemith.cl import Kernel
+from hindemith.operations.core import HMOperation, DeviceLevel, \
+    ReduceLevel, StencilLevel
+from hindemith.cl import Kernel, StencilKernel, compile_kernels
+from hindemith.cache import make_key
 from hindemith.types import hmarray
+from hindemith.memory import Placeholder, MemoryPlan
+from hindemith import peephole
 from hindemith.operations.array import ArrayAdd, ArraySub, ArrayMul, ArrayDiv, \
-    ArrayScalarAdd, ArrayScalarSub, ArrayScalarDiv, ArrayScalarMul
+    ArrayScalarAdd, ArrayScalarSub, ArrayScalarDiv, ArrayScalarMul, Reciprocal
+from hindemith.operations.convolve import Convolve2D
 import os
 backend = os.getenv("HM_BACKEND", "ocl")
 if backend in {"ocl", "opencl", "OCL"}:
     import pycl as cl
+# Iterations between evaluations of the test ending a loop run by a
+# LoopPlan, each evaluation reads a scalar back to the host
+check_interval = int(os.getenv("HM_CHECK_INTERVAL", 1))
+# Default of compose(runtime_constants=...), pass scalars and filters that
+# operations can read at run time to kernels as arguments
+default_runtime_constants = os.getenv(
+    "HM_RUNTIME_CONSTANTS", "0") not in {"0", "false", "False", "off"}
 try:
     from graphviz import Digraph
     from profilehooks import profile
@@ -76,11 +93,505 @@ class NonComposableBlock(Block):
     pass
 
 
+def get_dynamic_names(body, constants):
+    """
+    Return the names assigned by plain Python statements in body, their
+    values are only known when the composed function runs.  Names bound to
+    a literal (such as the temporaries introduced by UnpackBinOps) are
+    recorded in constants instead.
+    """
+    names = set()
+    for block in body:
+        if isinstance(block, ComposableBlock):
+            continue
+        for statement in block:
+            if isinstance(statement, ast.Assign) and \
+                    len(statement.targets) == 1 and \
+                    isinstance(statement.targets[0], ast.Name) and \
+                    isinstance(statement.value, ast.Num):
+                name = statement.targets[0].id
+                if constants.setdefault(name, statement.value.n) != \
+                        statement.value.n:
+                    names.add(name)
+                continue
+            for node in ast.walk(statement):
+                if isinstance(node, ast.Name) and \
+                        isinstance(node.ctx, ast.Store):
+                    names.add(node.id)
+            if isinstance(statement, (ast.For, ast.While)):
+                names |= get_dynamic_names(statement.body, constants)
+    return names
+
+
+def get_live_ranges(body, names, get_operation, ranges=None, escaping=None,
+                    position=0):
+    """
+    Number the steps of body (as returned by Compose.process_hm_ops) in
+    execution order and return the first and last step each of names is
+    live at, the names referenced by Python statements and the next free
+    position.  Names live at the same step never share memory.
+
+    A step is a DeviceLevel operation, a run of other operations (which
+    may be fused into one kernel) or a block of Python statements.  An
+    ElementLevel producer may be inlined into the operations (and
+    reductions) gathering its result, so its sources stay live until the
+    result is gathered.
+    A name live into a loop body is carried between iterations and is
+    live for the whole loop.  Python statements can hold on to an array
+    beyond the composed call (returning it for example), so the names
+    they reference are reported as escaping instead.
+    """
+    if ranges is None:
+        ranges, escaping = {}, set()
+
+    def extend(name, first, last):
+        if name in ranges:
+            first = min(first, ranges[name][0])
+            last = max(last, ranges[name][1])
+        ranges[name] = (first, last)
+
+    for block in body:
+        if isinstance(block, ComposableBlock):
+            funcs = [get_operation(statement) for statement in block]
+            device = [issubclass(func, DeviceLevel) for func in funcs]
+            positions = []
+            for index in range(len(block)):
+                if index > 0 and (device[index] or device[index - 1]):
+                    position += 1
+                positions.append(position)
+            # Last step at which each name is gathered
+            gathered = {}
+            for index in reversed(range(len(block))):
+                statement, step = block[index], positions[index]
+                _sinks = [node.id for node in ast.walk(statement.targets[0])
+                          if isinstance(node, ast.Name)]
+                _sources = [arg.id if isinstance(arg, ast.Name) else None
+                            for arg in statement.value.args]
+                last = step
+                if not device[index] and len(_sinks) == 1:
+                    last = max(last, gathered.get(_sinks[0], step))
+                for i, name in enumerate(_sources):
+                    if name is None:
+                        continue
+                    if (not device[index] or
+                            issubclass(funcs[index], ReduceLevel)) and \
+                            (i in funcs[index].gather_sources or last > step):
+                        gathered[name] = max(gathered.get(name, last), last)
+                    if name in names:
+                        extend(name, step, last)
+                for name in _sinks:
+                    if name in names:
+                        extend(name, step, step)
+            position += 1
+            continue
+        for statement in block:
+            if isinstance(statement, (ast.For, ast.While)):
+                start = position
+                _, _, position = get_live_ranges(
+                    statement.body, names, get_operation, ranges, escaping,
+                    position)
+                for name in statement.body[0].live_ins & names:
+                    extend(name, start, position - 1)
+                if isinstance(statement, ast.For):
+                    nodes = [statement.target, statement.iter]
+                else:
+                    nodes = [statement.test]
+                nodes += statement.orelse
+            else:
+                nodes = [statement]
+            for node in nodes:
+                for child in ast.walk(node):
+                    if isinstance(child, ast.Name) and child.id in names:
+                        extend(child.id, position, position)
+                        escaping.add(child.id)
+        position += 1
+    return ranges, escaping, position
+
+
+def get_renames(statement):
+    """
+    Return the (targets, values) names of a statement assigning names to
+    names (such as u, v = u_new, v_new), or None for any other statement.
+    """
+    if not isinstance(statement, ast.Assign) or len(statement.targets) != 1:
+        return None
+    names = []
+    for node in (statement.targets[0], statement.value):
+        if isinstance(node, ast.Name):
+            names.append([node.id])
+        elif isinstance(node, ast.Tuple) and \
+                all(isinstance(elt, ast.Name) for elt in node.elts):
+            names.append([elt.id for elt in node.elts])
+        else:
+            return None
+    if len(names[0]) != len(names[1]):
+        return None
+    return names[0], names[1]
+
+
+def get_names(node):
+    """
+    Return the set of names referenced in node.
+    """
+    return set(child.id for child in ast.walk(node)
+               if isinstance(child, ast.Name))
+
+
+def get_break_test(statement):
+    """
+    Return the test of an `if test: break` statement, or None.
+    """
+    if isinstance(statement, ast.If) and not statement.orelse and \
+            len(statement.body) == 1 and \
+            isinstance(statement.body[0], ast.Break):
+        return statement.test
+    return None
+
+
+def get_dependencies(kernels, storage=None):
+    """
+    Build the dataflow graph of the kernels (and launchers) of a block.
+    Kernel i depends on an earlier kernel j if j writes a buffer i reads
+    (RAW), reads a buffer i writes (WAR) or writes a buffer i writes (WAW).
+    Edges implied by a path through another dependency are dropped so each
+    wait list is minimal.
+
+    :param dict storage: Maps names sharing memory (see
+        MemoryPlan.storage) to a common name
+    :return: For each kernel, the sorted indices of the kernels it waits on
+    """
+    storage = storage or {}
+    reads = [set(storage.get(source.name, source.name)
+                 for source in kernel.sources) for kernel in kernels]
+    writes = [set(storage.get(sink.name, sink.name) for sink in kernel.sinks)
+              for kernel in kernels]
+    ancestors = []
+    dependencies = []
+    for i in range(len(kernels)):
+        direct = set()
+        for j in range(i):
+            if writes[j] & (reads[i] | writes[i]) or reads[j] & writes[i]:
+                direct.add(j)
+        implied = set()
+        for j in direct:
+            implied |= ancestors[j]
+        ancestors.append(direct | implied)
+        dependencies.append(sorted(direct - implied))
+    return dependencies
+
+
+def get_buffer_accesses(kernels, storage=None):
+    """
+    Describe how the kernels of a block use buffers that outlive it.
+
+    :param dict storage: Maps names sharing memory (see
+        MemoryPlan.storage) to a common name, their arrays share events
+        and are tracked as one buffer
+    :return: (external, accesses).  external[i] lists (name, is_write) for
+        the buffers kernel i accesses that no earlier kernel of the block
+        wrote, kernel i waits on the events recorded on those arrays.
+        accesses lists (name, last_writer, readers) for every buffer, the
+        kernel events to record on the array once the block is launched.
+    """
+    storage = storage or {}
+    external = []
+    last_writer = {}
+    readers = {}
+    for i, kernel in enumerate(kernels):
+        reads = set(storage.get(source.name, source.name)
+                    for source in kernel.sources
+                    if source.level != 'register')
+        writes = set(storage.get(sink.name, sink.name)
+                     for sink in kernel.sinks if sink.level != 'register')
+        external.append([(name, name in writes)
+                         for name in sorted(reads | writes)
+                         if name not in last_writer])
+        for name in reads:
+            readers.setdefault(name, []).append(i)
+        for name in writes:
+            last_writer[name] = i
+            readers[name] = []
+    accesses = [(name, last_writer.get(name), readers[name])
+                for name in sorted(readers)]
+    return external, accesses
+
+
+class LaunchPlan(object):
+    """
+    Flat record of the launches of a block, made on its first call.  Each
+    step holds the launch function of a kernel (or DeviceLevel launcher),
+    the steps it waits on and the slots of the arrays whose events it
+    waits on, so later calls replay the block without walking it, looking
+    arguments up per kernel or recomputing launch sizes.
+
+    After recording, the generated code calls launch directly.  Its
+    positional arguments (arg_names) occupy the first slots, every other
+    array the block uses is bound once from the symbol table.  Kernels
+    are only rebound when an argument was swapped since the previous
+    call, otherwise a call does no dictionary lookups at all.
+
+    Kernels wait on their predecessors in the block and on the events
+    recorded on the arrays they access, the completion events of the block
+    are then recorded on the arrays for later blocks, sync_host and
+    sync_ocl.
+    """
+    def __init__(self, kernels, dependencies, externals, accesses,
+                 symbol_table, arg_names, ret_names):
+        self.symbol_table = symbol_table
+        self.arg_names = arg_names
+        names = list(arg_names)
+        params = [param.name for kernel in kernels
+                  if isinstance(kernel, Kernel) for param in kernel.params]
+        for name in [name for name, _, _ in accesses] + params + ret_names:
+            if name not in names:
+                names.append(name)
+        slots = dict((name, index) for index, name in enumerate(names))
+        self.fixed = [symbol_table[name] for name in names[len(arg_names):]]
+        args = tuple(symbol_table[name] for name in arg_names)
+        arrays = set(name for name in names
+                     if isinstance(symbol_table[name], hmarray))
+        self.bindings = []
+        self.steps = []
+        self.has_launchers = False
+        for kernel, deps, external in zip(kernels, dependencies, externals):
+            if isinstance(kernel, Kernel):
+                self.bindings.append(
+                    (kernel, [slots[param.name] for param in kernel.params]))
+                launch = kernel.enqueue
+            else:
+                launch = partial(kernel.launch, symbol_table)
+                self.has_launchers = True
+            self.steps.append((launch, deps, [
+                (slots[name], write) for name, write in external
+                if name in arrays]))
+        self.records = [(slots[name], last_writer, readers)
+                        for name, last_writer, readers in accesses
+                        if name in arrays]
+        self.ret_slots = [slots[name] for name in ret_names]
+        self.track_events = backend in {"ocl", "opencl", "OCL"}
+        self.bind(args)
+
+    def bind(self, args):
+        """
+        Bind the arrays of a call to the kernel parameters.
+        """
+        values = list(args) + self.fixed
+        for kernel, slots in self.bindings:
+            kernel.set_args([values[slot] for slot in slots])
+        if self.has_launchers:
+            # Launchers look their arrays up by name
+            for name, arg in zip(self.arg_names, args):
+                self.symbol_table[name] = arg
+        self.args = args
+        self.values = values
+        ret = tuple(values[slot] for slot in self.ret_slots)
+        self.ret = ret[0] if len(ret) == 1 else ret
+
+    def launch(self, *args):
+        if not all(map(is_, args, self.args)):
+            self.bind(args)
+        if not self.track_events:
+            for launch, _, _ in self.steps:
+                launch([])
+            return self.ret
+        values = self.values
+        events = []
+        for launch, deps, external in self.steps:
+            wait_for = []
+            for dep in deps:
+                wait_for.extend(events[dep])
+            for slot, write in external:
+                wait_for.extend(values[slot].get_wait_events(write))
+            events.append(launch(wait_for) or [])
+        for slot, last_writer, readers in self.records:
+            read_events = [evt for index in readers for evt in events[index]]
+            if last_writer is None:
+                values[slot].record_read(read_events)
+            else:
+                values[slot].record_write(events[last_writer], read_events)
+        return self.ret
+
+
+class LoopPlan(object):
+    """
+    Runs a loop whose body only launches blocks and rebinds arrays (such
+    as u, v = u_new, v_new), without executing the body as Python
+    statements.  The body is stepped through with the bindings of its
+    names kept in a dictionary until the bindings at the start of an
+    iteration repeat.  The launches of one period, with their arguments
+    resolved, are then replayed for the remaining iterations.
+
+    A sink that is rebound to another name (u_new above) alternates
+    between its array and a second one (ping-pong) instead of being
+    overwritten while the next iteration still reads it under its new
+    name.
+
+    A loop with a test (a while loop, or a for loop ending with
+    `if test: break`) compares a scalar, usually the result of a
+    reduction such as MaxAbsDiff, with a constant.  Only that scalar is
+    read back, every check_interval iterations, so the loop may run up to
+    check_interval - 1 iterations past the one that passed the test.
+
+    :param list steps: (func_name, arg_names, targets) for each statement
+        of the body, func_name is None for rebinding statements, which
+        assign the arrays bound to arg_names to targets
+    :param int trip_count: Maximum number of iterations, None for no limit
+    :param list inputs: Names the body reads before assigning them, passed
+        as positional arguments
+    :param list outputs: Names the body assigns, returned in this order
+    :param set partners: Sinks that ping-pong between two arrays
+    :param tuple test: (name, compare, threshold, stop), the loop stops
+        once compare(name, threshold) is stop.  A test that stops when it
+        fails (a while loop) is also checked before the first iteration.
+    """
+    def __init__(self, steps, trip_count, inputs, outputs, partners,
+                 symbol_table, test=None, check_interval=1):
+        self.steps = steps
+        self.trip_count = trip_count
+        self.inputs = inputs
+        self.outputs = outputs
+        self.partners = partners
+        self.symbol_table = symbol_table
+        self.test = test
+        self.check_interval = max(check_interval, 1)
+        self.names = inputs + [name for name in outputs
+                               if name not in inputs]
+        self.pairs = {}
+        self.iterations = None
+
+    def select_buffer(self, env, name):
+        """
+        Bind name to the array of its pair no other name is bound to.
+        """
+        if name not in self.pairs:
+            array = env[name]
+            self.pairs[name] = (array, hm.zeros(array.shape, array.dtype))
+        others = [value for other, value in env.items() if other != name]
+        for array in self.pairs[name]:
+            if not any(array is value for value in others):
+                env[name] = array
+                return
+
+    def step(self, env, launches):
+        """
+        Run one iteration of the body, recording its launches.
+        """
+        for func_name, arg_names, targets in self.steps:
+            if func_name is None:
+                values = [env[name] for name in arg_names]
+            else:
+                for name in targets:
+                    if name in self.partners:
+                        self.select_buffer(env, name)
+                args = tuple(env[name] for name in arg_names)
+                ret = self.symbol_table[func_name](*args)
+                # The first call records the launch plan of the block
+                launches.append((self.symbol_table[func_name], args))
+                values = [ret] if len(targets) == 1 else list(ret)
+            env.update(zip(targets, values))
+
+    def is_done(self, env):
+        """
+        Evaluate the test, reading its scalar back from the device.
+        """
+        name, compare, threshold, stop = self.test
+        value = env[name]
+        if isinstance(value, hmarray):
+            value.sync_host()
+            value = value[0]
+        return bool(compare(value, threshold)) == stop
+
+    def __call__(self, *args):
+        env = dict(zip(self.inputs, args))
+        for name in self.partners:
+            if name not in env:
+                env[name] = self.symbol_table[name]
+        history = []
+        period = None
+        iteration = 0
+        while self.trip_count is None or iteration < self.trip_count:
+            if self.test is not None and \
+                    iteration % self.check_interval == 0 and \
+                    (iteration or not self.test[3]):
+                if period is not None:
+                    env.update(zip(self.names, period[phase][0]))
+                if self.is_done(env):
+                    break
+            iteration += 1
+            if period is None:
+                state = [env.get(name) for name in self.names]
+                for start, (previous, _) in enumerate(history):
+                    if all(map(is_, state, previous)):
+                        period = history[start:]
+                        phase = 0
+                        break
+                else:
+                    launches = []
+                    self.step(env, launches)
+                    history.append((state, launches))
+                    continue
+            for launch, launch_args in period[phase][1]:
+                launch(*launch_args)
+            phase = (phase + 1) % len(period)
+        if period is not None:
+            env.update(zip(self.names, period[phase][0]))
+        self.iterations = iteration
+        ret = tuple(env[name] for name in self.outputs)
+        return ret[0] if len(ret) == 1 else ret
+
+
+class PingPong(object):
+    """
+    The two arrays a sink rebound in a loop that runs as Python statements
+    alternates between, like the partners of a LoopPlan.  Called with the
+    locals of the composed function before the block writing the sink,
+    it returns the array no other name is bound to.
+    """
+    def __init__(self, name, symbol_table):
+        self.name = name
+        self.symbol_table = symbol_table
+        self.pair = None
+
+    def __call__(self, env):
+        if self.pair is None:
+            array = self.symbol_table[self.name]
+            self.pair = (array, hm.zeros(array.shape, array.dtype))
+        others = [value for other, value in env.items()
+                  if other != self.name]
+        for array in self.pair:
+            if not any(array is value for value in others):
+                return array
+        return self.pair[0]
+
+
+def read_host(value):
+    """
+    Return value, an array is read back from the device first so a loop
+    test running as a Python statement sees its current contents.
+    """
+    if isinstance(value, hmarray):
+        value.sync_host()
+    return value
+
+
+class ReadHost(ast.NodeTransformer):
+    """
+    Wrap the names a test reads in calls to read_host.
+    """
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            return node
+        return ast.Call(ast.Name("_hm_read_host", ast.Load()), [node], [],
+                        None, None)
+
+
 class Param(object):
     def __init__(self, node):
         self.name = node.id
         self.node = node
         self.level = 'buffer'
+        # (function, args) computing the elements of an inlined producer
+        self.loader = None
 
     def get_element(self):
         if self.level == 'register':
@@ -88,6 +599,41 @@ class Param(object):
         else:
             return "{}[index]".format(self.name)
 
+    def gather(self, index):
+        """
+        Return the element at index, a C expression, for operations that
+        read elements other than their own.
+        """
+        if self.loader is not None:
+            name, args = self.loader
+            return "{}({})".format(name, ", ".join(args + [index]))
+        return "{}[{}]".format(self.name, index)
+
+    def constant(self, symbol_table, index=None):
+        """
+        Return the value of a constant source, or its element at flat
+        index, as a C expression: a literal, or a read of the kernel
+        argument the value is passed in when it is passed at run time
+        (level 'scalar' or 'constant', see HMOperation.runtime_sources).
+        """
+        if self.level == 'scalar':
+            return self.name
+        if self.level == 'constant':
+            return "{}[{}]".format(self.name, index)
+        value = symbol_table[self.name]
+        if index is None:
+            return str(value)
+        return "{}f".format(np.asarray(value).flat[index])
+
+    def neighbour(self, rows, columns):
+        """
+        Return the element rows rows and columns columns away from the
+        element of the work item, a C expression, for StencilLevel
+        operations.  The kernel defines how it is read, see
+        StencilKernel.
+        """
+        return "HM_TAP_{}({}, {})".format(self.name, rows, columns)
+
 
 class Source(Param):
     pass
@@ -97,18 +643,199 @@ class Sink(Param):
     pass
 
 
+def get_params(tree):
+    """
+    Return the parameter names of the function defined by tree
+    """
+    if sys.version_info < (3, 0):
+        return [arg.id for arg in tree.body[0].args.args]
+    return [arg.arg for arg in tree.body[0].args.args]
+
+
+def get_runtime_level(value):
+    """
+    Return the level of a Param whose value is passed to kernels at run
+    time: 'scalar' for numbers, 'constant' for arrays (filters), or None
+    if value cannot be passed.
+    """
+    if isinstance(value, np.ndarray):
+        return 'constant'
+    if isinstance(value, (int, float, np.number)) and \
+            not isinstance(value, bool):
+        return 'scalar'
+    return None
+
+
+def get_arg_key(arg, constant=False, runtime=False):
+    """
+    Return a hashable description of arg for selecting a specialized plan.
+    Arrays are described by type, shape and dtype, only the contents of
+    arrays baked into generated code (constant) are hashed, every call
+    pays for it.  Other values are described by value, values passed to
+    kernels at run time only by type (and shape and dtype).
+    """
+    level = get_runtime_level(arg) if runtime else None
+    if level == 'scalar':
+        return (type(arg), )
+    if level == 'constant':
+        return (type(arg), arg.shape, arg.dtype.str)
+    if isinstance(arg, np.ndarray):
+        if constant:
+            return (type(arg), make_key(arg.shape, arg.dtype.str,
+                                        np.ascontiguousarray(arg).tobytes()))
+        return (type(arg), arg.shape, arg.dtype.str)
+    if isinstance(arg, (list, tuple)):
+        return (type(arg), tuple(get_arg_key(a, constant) for a in arg))
+    try:
+        hash(arg)
+    except TypeError:
+        return (type(arg), id(arg))
+    return (type(arg), arg)
+
+
+class PlanCache(object):
+    """
+    LRU cache of Compose instances, each specialized for the shapes,
+    dtypes and scalar values of the arguments it was compiled with.
+    """
+    def __init__(self, func, symbol_table, fusion, max_size=16,
+                 runtime_constants=False):
+        self.func = func
+        self.symbol_table = symbol_table
+        self.fusion = fusion
+        self.runtime_constants = runtime_constants
+        self.max_size = max_size
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.last_key = None
+        tree = get_ast(func)
+        self.params = get_params(tree)
+        self.constant_params = self.get_constant_params(tree)
+        self.runtime_params = set()
+        if runtime_constants:
+            self.runtime_params = self.get_runtime_params(tree)
+
+    def get_constant_params(self, tree):
+        """
+        Return the names of parameters whose values are baked into
+        generated code by an operation (see HMOperation.constant_sources)
+        """
+        constant_params = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call):
+                continue
+            try:
+                func = eval_in_table(node.func, self.symbol_table)
+            except (KeyError, AttributeError, NotImplementedError):
+                continue
+            if not inspect.isclass(func) or \
+                    not issubclass(func, HMOperation):
+                continue
+            for index in func.constant_sources:
+                if self.runtime_constants and index in func.runtime_sources:
+                    continue
+                if index < len(node.args) and \
+                        isinstance(node.args[index], ast.Name) and \
+                        node.args[index].id in self.params:
+                    constant_params.add(node.args[index].id)
+        return constant_params
+
+    def get_runtime_params(self, tree):
+        """
+        Return the names of parameters that are only read as runtime
+        sources of operations (see HMOperation.runtime_sources) or as the
+        right operand of arithmetic, which becomes an ArrayScalarOp when
+        the left operand is an array.  Their values are passed to the
+        kernels when they run, so plans do not depend on them.
+        """
+        runtime_reads = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.BinOp) and \
+                    isinstance(node.op, (ast.Add, ast.Sub, ast.Mult,
+                                         ast.Div)):
+                runtime_reads.add(node.right)
+            elif isinstance(node, ast.Call):
+                try:
+                    func = eval_in_table(node.func, self.symbol_table)
+                except (KeyError, AttributeError, NotImplementedError):
+                    continue
+                if inspect.isclass(func) and issubclass(func, HMOperation):
+                    runtime_reads.update(node.args[index]
+                                         for index in func.runtime_sources
+                                         if index < len(node.args))
+        runtime_params = set()
+        other_uses = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Name) or node.id not in self.params:
+                continue
+            if isinstance(node.ctx, ast.Load) and node in runtime_reads:
+                runtime_params.add(node.id)
+            elif isinstance(node.ctx, (ast.Load, ast.Store)):
+                other_uses.add(node.id)
+        return runtime_params - other_uses
+
+    def get_key(self, args, kwargs):
+        key = tuple(get_arg_key(arg, name in self.constant_params,
+                                name in self.runtime_params)
+                    for name, arg in zip(self.params, args))
+        for name in sorted(kwargs):
+            key += ((name, get_arg_key(kwargs[name],
+                                       name in self.constant_params,
+                                       name in self.runtime_params)), )
+        return key
+
+    def get(self, args, kwargs):
+        """
+        Return the plan specialized for args, compiling a new one on a miss
+        """
+        key = self.get_key(args, kwargs)
+        if key == self.last_key:
+            # Already the most recently used plan
+            self.hits += 1
+            return self.plans[key]
+        try:
+            composed = self.plans.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            composed = Compose(self.func, self.symbol_table, self.fusion,
+                               self.runtime_constants)
+            while len(self.plans) >= max(self.max_size, 1):
+                self.plans.popitem(last=False)
+        self.plans[key] = composed
+        self.last_key = key
+        return composed
+
+    def clear(self):
+        self.plans.clear()
+        self.last_key = None
+
+
 class Compose(object):
     unique_id = -1
 
-    def __init__(self, func, symbol_table, fusion):
-        self.symbol_table = symbol_table
+    def __init__(self, func, symbol_table, fusion, runtime_constants=False):
+        # Each specialization owns its symbol table, temporaries allocated
+        # for one set of shapes must not leak into another
+        self.symbol_table = dict(symbol_table)
         self.symbol_table.update(globals())
         self.tree = get_ast(func)
+        self.params = get_params(self.tree)
         self.compiled = None
         self.fusion = fusion
+        self.runtime_constants = runtime_constants
         self.kernels = []
+        self.builders = []
+        self.dynamic_names = set()
+        self.constants = {}
+        self.launch_plans = []
+        self.unplanned = 0
+        self.memory_plan = None
+        self.loop_plans = []
+        self.loop_sinks = set()
 
-    def process_hm_ops(self, statements):
+    def process_hm_ops(self, statements, live_outs=()):
         processed = []
         for statement in statements:
             if self.is_hindemith_operation(statement):
@@ -118,14 +845,20 @@ class Compose(object):
             else:
                 if isinstance(statement, ast.For):
                     statement.body = self.process_hm_ops(statement.body)
+                elif isinstance(statement, ast.While):
+                    # The test reads the values the body leaves behind
+                    statement.body = self.process_hm_ops(
+                        statement.body, get_names(statement.test))
                 if len(processed) < 1 or not isinstance(processed[-1], NonComposableBlock):
                     processed.append(NonComposableBlock())
                 processed[-1].append(statement)
+        if processed:
+            processed[-1].live_outs |= set(live_outs)
         for index, block in enumerate(reversed(processed)):
             analyzer = Analyzer()
             for statement in block:
                 analyzer.visit(statement)
-                if isinstance(statement, ast.For):
+                if isinstance(statement, (ast.For, ast.While)):
                     block.live_ins |= statement.body[0].live_ins
                     block.live_outs |= statement.body[-1].live_outs
             block.live_outs |= analyzer.return_values
@@ -141,17 +874,255 @@ class Compose(object):
                 processed.append(self.gen_hm_func(block))
             else:
                 for statement in block:
-                    if isinstance(statement, ast.For):
-                        statement.body = self.gen_blocks(statement.body)
-                processed.extend(block)
+                    if isinstance(statement, (ast.For, ast.While)):
+                        if self.is_plannable_loop(statement):
+                            processed.extend(self.gen_loop(statement))
+                            continue
+                        self.gen_python_loop(statement)
+                    processed.append(statement)
         return processed
 
+    def gen_python_loop(self, loop):
+        """
+        Generate the body of a loop that does not run as a LoopPlan and
+        stays a Python loop.  As in a LoopPlan, sinks rebound to other
+        names (b = d) alternate between two arrays instead of being
+        overwritten while another name still refers to them, and the
+        arrays read by the loop test (and by `if test: break`) are read
+        back from the device before it is evaluated.
+        """
+        sinks, renamed, read_first, assigned = set(), set(), set(), set()
+        for block in loop.body:
+            for statement in block:
+                if isinstance(statement, ast.Assign):
+                    read_first |= get_names(statement.value) - assigned
+                    assigned |= get_names(statement.targets[0])
+                else:
+                    read_first |= get_names(statement) - assigned
+                if isinstance(block, ComposableBlock):
+                    sinks |= get_names(statement.targets[0])
+                elif get_renames(statement) is not None:
+                    renamed.update(get_renames(statement)[1])
+        # Names holding a value from before the iteration keep it
+        partners = (sinks & renamed) - read_first - set(self.params)
+        # Blocks take the partners as arguments to switch their buffers
+        self.loop_sinks |= partners
+        self.symbol_table["_hm_read_host"] = read_host
+        body = []
+        for block in loop.body:
+            if not isinstance(block, ComposableBlock):
+                for statement in self.gen_blocks([block]):
+                    if get_break_test(statement) is not None:
+                        statement.test = ReadHost().visit(statement.test)
+                    body.append(statement)
+                continue
+            call = self.gen_hm_func(block)
+            for name in sorted(get_names(call.targets[0]) & partners):
+                self.unique_id += 1
+                select = "_ping_pong{}".format(self.unique_id)
+                self.symbol_table[select] = PingPong(name,
+                                                     self.symbol_table)
+                body.append(ast.Assign(
+                    [ast.Name(name, ast.Store())],
+                    ast.Call(ast.Name(select, ast.Load()),
+                             [ast.Call(ast.Name("locals", ast.Load()), [],
+                                       [], None, None)], [], None, None)))
+            body.append(call)
+        loop.body = body
+        if isinstance(loop, ast.While):
+            loop.test = ReadHost().visit(loop.test)
+
+    def get_constant(self, node):
+        """
+        Return the value of a number or of a name bound to a number before
+        the composed function runs, or None.
+        """
+        if isinstance(node, ast.Num):
+            return node.n
+        if isinstance(node, ast.Name) and \
+                node.id not in self.dynamic_names and \
+                node.id in self.symbol_table:
+            value = self.symbol_table[node.id]
+            if isinstance(value, (int, float)) and \
+                    not isinstance(value, bool):
+                return value
+        return None
+
+    def get_trip_count(self, loop):
+        """
+        Return the number of iterations of a for loop over a range with
+        constant bounds, or None.  The loop must not use its target.
+        """
+        if not isinstance(loop.target, ast.Name) or \
+                not isinstance(loop.iter, ast.Call) or \
+                not isinstance(loop.iter.func, ast.Name) or \
+                loop.iter.func.id not in {'range', 'xrange'} or \
+                loop.iter.keywords or not loop.iter.args:
+            return None
+        bounds = [self.get_constant(arg) for arg in loop.iter.args]
+        if not all(isinstance(bound, int) for bound in bounds):
+            return None
+        for block in loop.body:
+            for statement in block:
+                if loop.target.id in get_names(statement):
+                    return None
+        return len(range(*bounds))
+
+    def get_loop_test(self, test):
+        """
+        Return (name, compare, threshold) for a test comparing a name with
+        a constant (change > epsilon) that LoopPlan can evaluate, or None.
+        """
+        compares = {ast.Lt: lt, ast.LtE: le, ast.Gt: gt, ast.GtE: ge}
+        if not isinstance(test, ast.Compare) or len(test.ops) != 1 or \
+                type(test.ops[0]) not in compares or \
+                not isinstance(test.left, ast.Name):
+            return None
+        threshold = self.get_constant(test.comparators[0])
+        if threshold is None:
+            return None
+        return test.left.id, compares[type(test.ops[0])], threshold
+
+    def is_plannable_loop(self, loop):
+        """
+        Whether a loop can run as a LoopPlan.  Its body may only contain
+        Hindemith operations, statements rebinding names to other names and
+        constants (the literals UnpackBinOps assigns to temporaries), a for
+        loop must iterate over a range with constant bounds and may
+        end with an `if test: break`, the test of a while loop and of the
+        break compare the scalar result of an operation with a constant.
+        """
+        if loop.orelse:
+            return False
+        if isinstance(loop, ast.For):
+            if not self.get_trip_count(loop):
+                return False
+        elif self.get_loop_test(loop.test) is None:
+            return False
+        for block in loop.body:
+            if isinstance(block, ComposableBlock):
+                continue
+            for statement in block:
+                if get_renames(statement) is not None or \
+                        self.is_constant_assign(statement):
+                    continue
+                if isinstance(loop, ast.For) and \
+                        statement is loop.body[-1][-1] and \
+                        get_break_test(statement) is not None and \
+                        self.get_loop_test(get_break_test(statement)):
+                    continue
+                return False
+        return True
+
+    def is_constant_assign(self, statement):
+        """
+        Whether statement assigns a number to a name that is never bound
+        to another value.
+        """
+        return isinstance(statement, ast.Assign) and \
+            len(statement.targets) == 1 and \
+            isinstance(statement.targets[0], ast.Name) and \
+            isinstance(statement.value, ast.Num) and \
+            statement.targets[0].id not in self.dynamic_names
+
+    def gen_loop(self, loop):
+        """
+        Replace a loop accepted by is_plannable_loop with a call to a
+        LoopPlan running all its iterations, preceded by the constants the
+        loop assigns.
+        """
+        constants = []
+        for block in loop.body:
+            if not isinstance(block, ComposableBlock):
+                constants.extend(statement for statement in block
+                                 if self.is_constant_assign(statement))
+                block[:] = [statement for statement in block
+                            if not self.is_constant_assign(statement)]
+        loop.body = [block for block in loop.body if block]
+        if isinstance(loop, ast.For):
+            trip_count = self.get_trip_count(loop)
+            test = get_break_test(loop.body[-1][-1])
+            if test is not None:
+                # The break is not a step of the body
+                loop.body[-1].pop()
+                if not loop.body[-1]:
+                    loop.body.pop()
+                test = self.get_loop_test(test) + (True, )
+        else:
+            trip_count = None
+            test = self.get_loop_test(loop.test) + (False, )
+        renamed = set()
+        for block in loop.body:
+            if not isinstance(block, ComposableBlock):
+                for statement in block:
+                    renamed.update(get_renames(statement)[1])
+        # Blocks take the sinks that are rebound as arguments, so the
+        # plan can switch them between buffers
+        self.loop_sinks |= renamed
+        steps = []
+        for block in loop.body:
+            if isinstance(block, ComposableBlock):
+                call = self.gen_hm_func(block)
+                target = call.targets[0]
+                targets = [elt.id for elt in target.elts] \
+                    if isinstance(target, ast.Tuple) else [target.id]
+                steps.append((call.value.func.id,
+                              [arg.id for arg in call.value.args], targets))
+            else:
+                for statement in block:
+                    targets, values = get_renames(statement)
+                    steps.append((None, values, targets))
+        inputs = []
+        outputs = []
+        if isinstance(loop, ast.While):
+            # Tested before the first iteration
+            inputs.append(test[0])
+        for func_name, arg_names, targets in steps:
+            for name in arg_names:
+                if name not in outputs and name not in inputs and \
+                        (name not in targets or name in self.params):
+                    inputs.append(name)
+            outputs.extend(name for name in targets if name not in outputs)
+        partners = set(name for func_name, _, targets in steps
+                       if func_name is not None for name in targets
+                       if name in renamed and name not in inputs)
+
+        self.unique_id += 1
+        func_name = "_loop{}".format(self.unique_id)
+        plan = LoopPlan(steps, trip_count, inputs, outputs, partners,
+                        self.symbol_table, test, check_interval)
+        self.loop_plans.append(plan)
+        self.symbol_table[func_name] = plan
+        func = ast.Call(ast.Name(func_name, ast.Load()),
+                        [ast.Name(name, ast.Load()) for name in inputs],
+                        [], None, None)
+        if len(outputs) == 1:
+            target = ast.Name(outputs[0], ast.Store())
+        else:
+            target = ast.Tuple([ast.Name(name, ast.Store())
+                                for name in outputs], ast.Store())
+        return constants + [ast.Assign([target], func)]
+
     def compile(self):
         tree = self.tree
         tree = UnpackBinOps().visit(tree)
-        tree = ReplaceArrayOps(self.symbol_table).visit(tree)
+        tree = ValueNumbering(self.symbol_table).visit(tree)
+        if not self.runtime_constants:
+            # Filters passed at run time are not known to be rank 1
+            tree = SeparateFilters(self.symbol_table).visit(tree)
+        replace_array_ops = ReplaceArrayOps(self.symbol_table)
+        tree = replace_array_ops.visit(tree)
+        tree = HoistInvariants(self.symbol_table,
+                               replace_array_ops.placeholders,
+                               peephole.fast_math).visit(tree)
         func_def = tree.body[0]
         new_body = self.process_hm_ops(func_def.body)
+        # Intermediates are allocated once the planner has assigned them
+        # their buffers
+        self.memory_plan = self.get_memory_plan(
+            new_body, replace_array_ops.placeholders)
+        self.symbol_table.update(self.memory_plan.allocate())
+        self.dynamic_names = get_dynamic_names(new_body, self.constants)
         processed = self.gen_blocks(new_body)
 
         func_def.body = processed
@@ -164,10 +1135,104 @@ class Compose(object):
         self.func_name = func_def.name
         self.compiled = self.symbol_table[func_def.name]
 
+    def get_memory_plan(self, body, placeholders):
+        """
+        Plan the memory of the intermediates of the composed function,
+        intermediates that are never live at the same time share a buffer.
+        """
+        ranges, escaping, _ = get_live_ranges(
+            body, set(placeholders),
+            lambda op: self.eval_in_symbol_table(op.value.func))
+        for name in escaping:
+            del ranges[name]
+        return MemoryPlan(placeholders, ranges,
+                          self.get_register_names(body) - escaping)
+
+    def get_register_names(self, body):
+        """
+        Return the names that are only ever assigned as sinks fusion can
+        promote to registers (see get_register_sinks) and are expected to
+        stay there.  Sources of DeviceLevel launchers (other than
+        reductions, which inline their producers) and values read before
+        the block writes them are known to need memory, fuse decides for
+        the rest once the kernels are grouped.
+        """
+        registers = set()
+        buffers = set()
+        for block in body:
+            if isinstance(block, ComposableBlock):
+                block_registers = self.get_register_sinks(block)
+                registers |= block_registers
+                written = set()
+                for op in block:
+                    _sinks, _sources = self.get_sinks_and_sources(op)
+                    for source in _sources:
+                        if source.name not in written or \
+                                not self.is_not_device_level(op) and \
+                                not self.is_reduction(op):
+                            buffers.add(source.name)
+                    written.update(sink.name for sink in _sinks)
+                    buffers.update(sink.name for sink in _sinks
+                                   if sink.name not in block_registers)
+            else:
+                for statement in block:
+                    if isinstance(statement, (ast.For, ast.While)):
+                        registers |= self.get_register_names(statement.body)
+        return registers - buffers
+
+    def get_register_sinks(self, block):
+        """
+        Return the names of the sinks of block that fusion can keep in
+        registers, those not live after the block.  Outputs of DeviceLevel
+        launchers always live in a buffer.
+        """
+        if not self.fusion:
+            return set()
+        registers = set()
+        device_sinks = set()
+        for op in block:
+            _sinks, _ = self.get_sinks_and_sources(op)
+            if self.is_not_device_level(op):
+                registers.update(sink.name for sink in _sinks)
+            else:
+                device_sinks.update(sink.name for sink in _sinks)
+        return registers - device_sinks - block.live_outs
+
+    def bind(self, args, kwargs):
+        for name, arg in zip(self.params, args):
+            self.symbol_table[name] = arg
+        self.symbol_table.update(kwargs)
+
     def __call__(self, *args, **kwargs):
+        # Once every block has recorded its launch plan the arguments
+        # reach the kernels positionally, the symbol table is only needed
+        # to build blocks
+        if self.unplanned or not self.compiled:
+            self.bind(args, kwargs)
+            if not self.compiled:
+                self.compile()
+        return self.compiled(*args, **kwargs)
+
+    def precompile(self, *args, **kwargs):
+        """
+        Run the compile pipeline for example arguments and build the
+        kernels and launchers of every block without launching them.
+        Blocks that depend on values computed by Python statements in the
+        composed function are still built on their first launch.
+        """
+        self.bind(args, kwargs)
         if not self.compiled:
             self.compile()
-        return self.compiled(*args, **kwargs)
+        for name, value in self.constants.items():
+            if name not in self.dynamic_names:
+                self.symbol_table[name] = value
+        # Compile the kernels of all blocks together so their builds overlap
+        kernels = []
+        for build in self.builders:
+            kernels.extend(build(compile=False))
+        compile_kernels(kernels)
+        for build in self.builders:
+            build.compiled = True
 
     def gen_hm_func(self, block):
         sources = []
@@ -193,10 +1258,14 @@ class Compose(object):
         # dot.render('tmp.gv')
 
         kernels = []
+        dependencies = []
+        externals = []
+        buffer_accesses = []
         filtered_sinks = []
         if self.fusion:
+            registers = self.get_register_sinks(block)
             for sink in sinks:
-                if sink.name not in block.live_outs:
+                if sink.name in registers:
                     sink.level = 'register'
                 else:
                     filtered_sinks.append(sink)
@@ -220,88 +1289,307 @@ class Compose(object):
             filtered_sinks = sinks
             filtered_sources = sources
 
-        def fn(*args, **kwargs):
-            for source, arg in zip(filtered_sources, args):
-                self.symbol_table[source.name] = arg
+        def build(compile=True):
             if len(kernels) == 0:
-                for op, params in zip(block, block_params):
-                    _sinks, _sources = params
-                    # if len(kernels) < 1 or \
-                    #    kernels[-1].launch_paramaters != launch_params:
-                    #    kernels.append(Kernel(launch_params))
-                    # else:
-                    #     raise NotImplementedError()
-                    if self.is_not_device_level(op):
-                        launch_params = self.get_launch_params(
-                            op, _sources, _sinks)
-                        if len(kernels) == 0 or \
-                                not isinstance(kernels[-1], Kernel) or \
-                                kernels[-1].launch_parameters[0] != launch_params[0] \
-                                or len(launch_params) > 1 and launch_params[1]:
-                            kernels.append(Kernel(launch_params))
-                        kernels[-1].append_body(
-                            self.get_emit(op, _sources, _sinks)
-                        )
-                        for source in _sources:
-                            if isinstance(self.symbol_table[source.name], hmarray):
-                                kernels[-1].sources.add(source)
-                        for sink in _sinks:
-                            if isinstance(self.symbol_table[sink.name], hmarray):
-                                kernels[-1].sinks.add(sink)
-                    else:
-                        kernels.append(self.get_launcher(op, _sources, _sinks))
-                for kernel in kernels:
-                    kernel.compile()
-                    self.kernels.append(kernel)
-            kernel_map = {}
-            for kernel in kernels:
-                evts = []
-                for source in kernel.sources:
-                    if source.name in kernel_map:
-                        evts.extend(kernel_map[source.name])
-                evts = kernel.launch(self.symbol_table, evts)
-                for sink in kernel.sinks:
-                    kernel_map[sink.name] = evts
-
-            if backend in {"ocl", "opencl", "OCL"}:
-                cl.clWaitForEvents(*evts)
-            ret = tuple(self.symbol_table[sink.name] for sink in filtered_sinks)
-            if len(ret) == 1:
-                return ret[0]
-            return ret
+                build_kernels()
+                storage = self.memory_plan.storage
+                dependencies.extend(get_dependencies(kernels, storage))
+                external, accesses = get_buffer_accesses(kernels, storage)
+                externals.extend(external)
+                buffer_accesses.extend(accesses)
+            if compile and not build.compiled:
+                compile_kernels(kernels)
+                build.compiled = True
+            return kernels
+        build.compiled = False
+
+        def build_kernels():
+            kernels.extend(self.fuse(block, block_params))
+            self.kernels.extend(kernels)
+
+        # Sinks that are parameters of the composed function are passed
+        # to the block along with its sources
+        arg_names = [source.name for source in filtered_sources]
+        for sink in filtered_sinks:
+            if (sink.name in self.params or sink.name in self.loop_sinks) \
+                    and sink.name not in arg_names:
+                arg_names.append(sink.name)
+        ret_names = [sink.name for sink in filtered_sinks]
+
+        def fn(*args):
+            for name, arg in zip(arg_names, args):
+                self.symbol_table[name] = arg
+            build()
+            plan = LaunchPlan(kernels, dependencies, externals,
+                              buffer_accesses, self.symbol_table, arg_names,
+                              ret_names)
+            self.launch_plans.append(plan)
+            self.unplanned -= 1
+            # Later calls go straight to the recorded plan
+            self.symbol_table[func_name] = plan.launch
+            return plan.launch(*args)
+
+        names = set(source.name for source in sources) | \
+            set(sink.name for sink in sinks)
+        if not names & self.dynamic_names:
+            self.builders.append(build)
 
         self.unique_id += 1
-        name = "_f{}".format(self.unique_id)
-        self.symbol_table[name] = fn
+        self.unplanned += 1
+        func_name = "_f{}".format(self.unique_id)
+        self.symbol_table[func_name] = fn
         func = ast.Call(
-            ast.Name(name, ast.Load()),
-            [ast.Name(source.name, ast.Load()) for source in filtered_sources],
+            ast.Name(func_name, ast.Load()),
+            [ast.Name(name, ast.Load()) for name in arg_names],
             # [],
             [],
             None,
             None,
         )
-        if len(sinks) > 1:
+        # Sinks promoted to registers are not returned by the block
+        if len(filtered_sinks) != 1:
             targets = [ast.Tuple([sink.node for sink in filtered_sinks], ast.Store())]
         else:
-            targets = [sinks[0].node]
+            targets = [filtered_sinks[0].node]
         return ast.Assign(targets, func)
         # return ast.Expr(func)
 
+    def fuse(self, block, block_params):
+        """
+        Group the operations of a block into kernels, DeviceLevel
+        operations get a launcher of their own.
+
+        Operations with the same launch size share a kernel and pass
+        values through registers.  An operation gathering a source (see
+        HMOperation.gather_sources) reads elements other than its own, so
+        it never shares a kernel with the producer of that source or with
+        a later writer of it.  When fusing, a chain of ElementLevel
+        operations whose result is only gathered is inlined instead: the
+        chain is emitted as a function of the element index that is
+        called at each gather site, and it gets no kernel of its own.
+        A kernel containing StencilLevel operations is a StencilKernel
+        over the 2D shape they read, stencils of other shapes start a new
+        kernel.
+        """
+        num_ops = len(block)
+        funcs = [self.eval_in_symbol_table(op.value.func) for op in block]
+        device = [issubclass(func, DeviceLevel) for func in funcs]
+        reads = [set(source.name for source in _sources)
+                 for _, _sources in block_params]
+        writes = [set(sink.name for sink in _sinks)
+                  for _sinks, _ in block_params]
+        gathered = [set(_sources[index].name for index in func.gather_sources
+                        if index < len(_sources))
+                    for func, (_, _sources) in zip(funcs, block_params)]
+        # Scalars and filters passed to the kernels when they run
+        if self.runtime_constants:
+            for func, (_, _sources) in zip(funcs, block_params):
+                for index in func.runtime_sources:
+                    if index < len(_sources):
+                        level = get_runtime_level(
+                            self.symbol_table[_sources[index].name])
+                        _sources[index].level = \
+                            level or _sources[index].level
+        launch_params = [
+            None if device[i] else self.get_launch_params(
+                op, block_params[i][1], block_params[i][0])
+            for i, op in enumerate(block)]
+        readers = dict((name, [i for i in range(num_ops) if name in reads[i]])
+                       for name in set().union(*reads))
+
+        # Operations inlined into the gathering operations that read them
+        inlined = set()
+        if self.fusion:
+            for i in range(num_ops):
+                _sinks, _ = block_params[i]
+                if device[i] or gathered[i] or len(_sinks) != 1 or \
+                        len(launch_params[i]) > 1 and launch_params[i][1]:
+                    continue
+                name = _sinks[0].name
+                if name in block.live_outs or name in reads[i] or \
+                        sum(name in names for names in writes) != 1 or \
+                        not readers.get(name) or readers[name][0] < i:
+                    continue
+                # The inputs must not change before the gather sites
+                if any(writes[k] & reads[i] for k in range(i + 1, num_ops)):
+                    continue
+                inlined.add(i)
+            changed = True
+            while changed:
+                changed = False
+                for i in sorted(inlined):
+                    name = block_params[i][0][0].name
+                    if any(k not in inlined and name not in gathered[k]
+                           for k in readers[name]):
+                        inlined.discard(i)
+                        changed = True
+        producers = dict((block_params[i][0][0].name, i) for i in inlined)
+
+        def get_chain(name):
+            producer = producers[name]
+            chain = []
+            for source in block_params[producer][1]:
+                if source.name in producers:
+                    chain.extend(op for op in get_chain(source.name)
+                                 if op not in chain)
+            return chain + [producer]
+
+        chains = {}
+        for name in producers:
+            chain = get_chain(name)
+            params = []
+            for i in chain:
+                for source in block_params[i][1]:
+                    if source.name not in producers and \
+                            source.name not in [p.name for p in params] and \
+                            self.is_kernel_param(source):
+                        params.append(source)
+            chains[name] = (chain, params)
+
+        # Buffers read at elements other than a work item's own
+        far_reads = []
+        for i in range(num_ops):
+            names = set()
+            for name in gathered[i]:
+                if name in chains:
+                    names.update(p.name for p in chains[name][1])
+                else:
+                    names.add(name)
+            far_reads.append(names)
+
+        # Kernels with stencils are launched over the 2D arrays they read
+        stencil_shapes = [
+            self.symbol_table[block_params[i][0][0].name].shape
+            if issubclass(funcs[i], StencilLevel) else None
+            for i in range(num_ops)]
+
+        groups = []
+        for i in range(num_ops):
+            if i in inlined:
+                continue
+            if device[i]:
+                groups.append((None, [i]))
+                continue
+            params = launch_params[i]
+            if not groups or groups[-1][0] is None or \
+                    groups[-1][0][0] != params[0] or \
+                    len(params) > 1 and params[1] or \
+                    far_reads[i] & group_writes or \
+                    writes[i] & group_far_reads or \
+                    group_shape not in (None, stencil_shapes[i]) and \
+                    stencil_shapes[i] is not None:
+                groups.append((params, []))
+                group_writes = set()
+                group_far_reads = set()
+                group_shape = None
+            groups[-1][1].append(i)
+            group_writes |= writes[i]
+            group_far_reads |= far_reads[i]
+            group_shape = group_shape or stencil_shapes[i]
+
+        # Values passed between kernels (or launchers) need a buffer
+        group_of = {}
+        for index, (_, ops) in enumerate(groups):
+            for i in ops:
+                group_of[i] = index
+        writer = {}
+        buffers = set()
+        for i in sorted(group_of):
+            buffers |= far_reads[i]
+            for name in reads[i]:
+                if name in writer and group_of[writer[name]] != group_of[i]:
+                    buffers.add(name)
+                elif name not in writer:
+                    # Values from before the block
+                    buffers.add(name)
+            for name in writes[i]:
+                writer[name] = i
+        for _sinks, _sources in block_params:
+            for param in _sinks + _sources:
+                if param.name in buffers and param.name not in producers \
+                        and param.level == 'register':
+                    param.level = 'buffer'
+                if param.level == 'buffer' and \
+                        isinstance(self.symbol_table[param.name], Placeholder):
+                    # A register temporary that needs memory after all
+                    self.symbol_table[param.name] = \
+                        self.memory_plan.materialize(param.name)
+
+        def add_params(kernel, i, helpers):
+            _sinks, _sources = block_params[i]
+            for source in _sources:
+                if source.name in chains:
+                    name = "hm_load_" + source.name
+                    chain, helper_params = chains[source.name]
+                    if name not in helpers:
+                        helpers.add(name)
+                        kernel.add_helper(
+                            name, helper_params,
+                            [block_params[k][0][0].name for k in chain],
+                            "\n".join(self.get_emit(block[k],
+                                                    block_params[k][1],
+                                                    block_params[k][0])
+                                      for k in chain),
+                            source.name)
+                    source.loader = (name, [p.name for p in helper_params])
+                elif self.is_kernel_param(source):
+                    kernel.sources.add(source)
+            for sink in _sinks:
+                if isinstance(self.symbol_table[sink.name],
+                              (hmarray, Placeholder)):
+                    kernel.sinks.add(sink)
+
+        kernels = []
+        for params, ops in groups:
+            if params is None:
+                _sinks, _sources = block_params[ops[0]]
+                launcher = self.get_launcher(block[ops[0]], _sources, _sinks)
+                if issubclass(funcs[ops[0]], ReduceLevel):
+                    # Reductions compute their elements in a kernel too,
+                    # producers are inlined into it
+                    add_params(launcher, ops[0], set())
+                kernels.append(launcher)
+                continue
+            shapes = [stencil_shapes[i] for i in ops
+                      if stencil_shapes[i] is not None]
+            if shapes:
+                kernel = StencilKernel(params, shapes[0])
+            else:
+                kernel = Kernel(params)
+            helpers = set()
+            for i in ops:
+                _sinks, _sources = block_params[i]
+                add_params(kernel, i, helpers)
+                if stencil_shapes[i] is not None:
+                    radius = self.get_radius(block[i], _sources)
+                    for index in funcs[i].gather_sources:
+                        kernel.add_stencil(_sources[index], radius)
+                emit = self.get_emit(block[i], _sources, _sinks)
+                if gathered[i]:
+                    # Gathering operations declare locals of their own
+                    emit = "{\n" + emit + "\n}"
+                kernel.append_body(emit)
+            kernels.append(kernel)
+        return kernels
+
     def is_not_device_level(self, op):
         func = self.eval_in_symbol_table(op.value.func)
         return not issubclass(func, DeviceLevel)
 
+    def is_kernel_param(self, source):
+        """
+        Whether the kernels reading source take it as an argument, arrays
+        and values passed at run time do.
+        """
+        return source.level in {'scalar', 'constant'} or \
+            isinstance(self.symbol_table[source.name], (hmarray, Placeholder))
+
+    def is_reduction(self, op):
+        func = self.eval_in_symbol_table(op.value.func)
+        return issubclass(func, ReduceLevel)
+
     def get_keywords(self, operation):
-        keywords = {}
-        for keyword in operation.value.keywords:
-            value = keyword.value
-            if isinstance(value, ast.Tuple):
-                keywords[keyword.arg] = [
-                    self.eval_in_symbol_table(elt) for elt in value.elts]
-            else:
-                keywords[keyword.arg] = self.eval_in_symbol_table(value)
-        return keywords
+        return get_keywords(operation.value, self.symbol_table)
 
     def get_sinks_and_sources(self, operation):
         if isinstance(operation.targets[0], ast.Name):
@@ -324,6 +1612,11 @@ class Compose(object):
         keywords = self.get_keywords(operation)
         return func.get_launcher(sources, sinks, keywords, self.symbol_table)
 
+    def get_radius(self, operation, sources):
+        func = self.eval_in_symbol_table(operation.value.func)
+        keywords = self.get_keywords(operation)
+        return func.get_radius(sources, keywords, self.symbol_table)
+
     def get_launch_params(self, operation, sources, sinks):
         func = self.eval_in_symbol_table(operation.value.func)
         sources = [self.symbol_table[src.name] for src in sources]
@@ -331,14 +1624,7 @@ class Compose(object):
         return func.get_launch_parameters(sources, sinks)
 
     def eval_in_symbol_table(self, val):
-        if isinstance(val, ast.Num):
-            return val.n
-        elif isinstance(val, ast.Name):
-            return self.symbol_table[val.id]
-        elif isinstance(val, ast.Attribute):
-            return getattr(self.eval_in_symbol_table(val.value), val.attr)
-        else:
-            raise NotImplementedError()
+        return eval_in_table(val, self.symbol_table)
 
     def is_hindemith_operation(self, statement):
         if not isinstance(statement, ast.Assign):
@@ -358,25 +1644,73 @@ class Compose(object):
                 f.write(kernel.kernel_str)
 
 
-def compose(fn=None, fusion=True):
+def eval_in_table(val, symbol_table):
+    if isinstance(val, ast.Num):
+        return val.n
+    elif isinstance(val, ast.Name):
+        return symbol_table[val.id]
+    elif isinstance(val, ast.Attribute):
+        return getattr(eval_in_table(val.value, symbol_table), val.attr)
+    else:
+        raise NotImplementedError()
+
+
+def get_keywords(call, symbol_table):
+    """
+    Return the keyword arguments of an operation call evaluated in
+    symbol_table.
+    """
+    keywords = {}
+    for keyword in call.keywords:
+        value = keyword.value
+        if isinstance(value, ast.Tuple):
+            keywords[keyword.arg] = [
+                eval_in_table(elt, symbol_table) for elt in value.elts]
+        else:
+            keywords[keyword.arg] = eval_in_table(value, symbol_table)
+    return keywords
+
+
+def compose(fn=None, fusion=True, max_plans=16, runtime_constants=None):
+    """
+    Compile fn into a composition of Hindemith operations.  A separate
+    plan is compiled for every combination of argument shapes, dtypes and
+    scalar values fn is called with, the max_plans most recently used are
+    kept.  With runtime_constants (by default HM_RUNTIME_CONSTANTS),
+    scalars and filters operations can read at run time (see
+    HMOperation.runtime_sources) are passed to the kernels as arguments:
+    parameters only used that way do not select a plan, so new values
+    reuse the compiled kernels, at the cost of the arithmetic a compiler
+    could fold with literal values.  wrapped.precompile(*example_args)
+    builds the plan for example_args ahead of the first call.  Cache
+    statistics are available as wrapped.plans.hits and
+    wrapped.plans.misses.
+    """
     def composer(fn):
-        tree = get_ast(fn)
         symbol_table = {}
         frame = inspect.stack()[1][0]
         while frame is not None:
             symbol_table.update(frame.f_locals)
             symbol_table.update(frame.f_globals)
             frame = frame.f_back
-        composed = Compose(fn, symbol_table, fusion)
+        if runtime_constants is None:
+            runtime = default_runtime_constants
+        else:
+            runtime = runtime_constants
+        plans = PlanCache(fn, symbol_table, fusion, max_plans, runtime)
 
         def wrapped(*args, **kwargs):
-            for index, arg in enumerate(tree.body[0].args.args):
-                if sys.version_info < (3, 0):
-                    symbol_table[arg.id] = args[index]
-                else:
-                    symbol_table[arg.arg] = args[index]
+            composed = plans.get(args, kwargs)
+            wrapped.composed = composed
             return composed(*args, **kwargs)
-        wrapped.composed = composed
+
+        def precompile(*args, **kwargs):
+            composed = plans.get(args, kwargs)
+            wrapped.composed = composed
+            composed.precompile(*args, **kwargs)
+        wrapped.precompile = precompile
+        wrapped.plans = plans
+        wrapped.composed = None
         return wrapped
     if fn is not None:
         return composer(fn)
@@ -426,19 +1760,28 @@ class UnpackBinOps(ast.NodeTransformer):
         result.append(node)
         return result
 
-    def visit_If(self, node):
-        # Ignore If statements
-        return node
-
-    def visit_For(self, node):
+    def visit_body(self, body):
         new_body = []
-        for statement in node.body:
+        for statement in body:
             result = self.visit(statement)
             if isinstance(result, list):
                 new_body.extend(result)
             else:
                 new_body.append(result)
-        node.body = new_body
+        return new_body
+
+    def visit_If(self, node):
+        # The test is left to Python (or a LoopPlan)
+        node.body = self.visit_body(node.body)
+        node.orelse = self.visit_body(node.orelse)
+        return node
+
+    def visit_For(self, node):
+        node.body = self.visit_body(node.body)
+        return node
+
+    def visit_While(self, node):
+        node.body = self.visit_body(node.body)
         return node
 
     def visit_Call(self, node):
@@ -486,6 +1829,241 @@ class UnpackBinOps(ast.NodeTransformer):
         return result
 
 
+class ValueNumbering(ast.NodeTransformer):
+    """
+    Common subexpression elimination and constant folding, runs between
+    UnpackBinOps and ReplaceArrayOps.
+
+    Every statement of the form name = a op b or name = Operation(...) is
+    numbered by its operation and the versions of its operands (a name
+    gets a new version whenever it is assigned, and when entering or
+    leaving a loop that assigns it).  A statement computing a number
+    already held by an earlier name is removed and later reads of its
+    target read the earlier name instead.  Both names must be assigned
+    exactly once in the function, so they hold the same value wherever
+    the removed one was read.
+
+    Arithmetic on numbers and on names bound to numbers (alpha ** 2) is
+    evaluated.  Constants assigned once are moved into the symbol table,
+    the composed function reads them from there, so they do not split
+    the blocks of operations around them.
+    """
+    operators = {ast.Add: add, ast.Sub: sub, ast.Mult: mul, ast.Div: truediv,
+                 ast.FloorDiv: floordiv, ast.Mod: mod, ast.Pow: pow}
+    commutative = (ast.Add, ast.Mult)
+
+    def __init__(self, symbol_table):
+        super(ValueNumbering, self).__init__()
+        self.symbol_table = symbol_table
+        self.assignments = {}
+        self.params = set()
+        self.constants = {}
+        self.versions = {}
+        self.renames = {}
+
+    def visit_FunctionDef(self, node):
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and \
+                    isinstance(child.ctx, ast.Store):
+                self.assignments[child.id] = \
+                    self.assignments.get(child.id, 0) + 1
+        self.params = set(get_params(ast.Module([node])))
+        node.body = self.number(node.body, {})
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and \
+                    isinstance(child.ctx, ast.Load):
+                while child.id in self.renames:
+                    child.id = self.renames[child.id]
+        return node
+
+    def get_constant(self, node):
+        """
+        Return the number node evaluates to, or None.
+        """
+        if isinstance(node, ast.Num):
+            return node.n
+        if not isinstance(node, ast.Name):
+            return None
+        if node.id in self.constants:
+            return self.constants[node.id]
+        if node.id not in self.assignments and node.id not in self.params:
+            value = self.symbol_table.get(node.id)
+            if isinstance(value, (int, float)) and \
+                    not isinstance(value, bool):
+                return value
+        return None
+
+    def fold(self, node):
+        """
+        Return the number a BinOp of numbers evaluates to, or None.
+        """
+        left = self.get_constant(node.left)
+        right = self.get_constant(node.right)
+        if left is None or right is None or \
+                type(node.op) not in self.operators:
+            return None
+        if isinstance(node.op, ast.Div) and isinstance(left, int) and \
+                isinstance(right, int):
+            # Integer division depends on the __future__ imports of fn
+            return None
+        try:
+            return self.operators[type(node.op)](left, right)
+        except (ArithmeticError, ValueError):
+            return None
+
+    def get_operand(self, node):
+        constant = self.get_constant(node)
+        if constant is not None:
+            return ('constant', constant)
+        if isinstance(node, ast.Name):
+            return (node.id, self.versions.get(node.id, 0))
+        return None
+
+    def get_key(self, node):
+        """
+        Return a hashable description of the value node computes, or None
+        if it is not a pure operation on names.
+        """
+        if isinstance(node, ast.BinOp):
+            operands = [self.get_operand(node.left),
+                        self.get_operand(node.right)]
+            if None in operands:
+                return None
+            if isinstance(node.op, self.commutative):
+                operands.sort(key=repr)
+            return (type(node.op), ) + tuple(operands)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            func = self.symbol_table.get(node.func.id)
+            if not inspect.isclass(func) or \
+                    not issubclass(func, HMOperation) or \
+                    getattr(node, 'starargs', None) or \
+                    getattr(node, 'kwargs', None):
+                return None
+            operands = [self.get_operand(arg) for arg in node.args]
+            keywords = []
+            for keyword in node.keywords:
+                keywords.append((keyword.arg, self.get_operand(keyword.value)
+                                 or ast.dump(keyword.value)))
+            if None in operands:
+                return None
+            return (func, ) + tuple(operands) + tuple(keywords)
+        return None
+
+    def bump(self, names):
+        for name in names:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    def get_stores(self, nodes):
+        return set(child.id for node in nodes for child in ast.walk(node)
+                   if isinstance(child, ast.Name) and
+                   isinstance(child.ctx, ast.Store))
+
+    def number(self, body, available):
+        """
+        Number the statements of body, available maps the keys of values
+        computed earlier to (name, version of name).
+        """
+        available = dict(available)
+        processed = []
+        for statement in body:
+            if isinstance(statement, (ast.For, ast.While, ast.If)):
+                assigned = self.get_stores(statement.body + statement.orelse)
+                if isinstance(statement, ast.For):
+                    assigned |= self.get_stores([statement.target])
+                if not isinstance(statement, ast.If):
+                    # Values carried from the previous iteration
+                    self.bump(assigned)
+                statement.body = self.number(statement.body, available)
+                statement.orelse = self.number(statement.orelse, available)
+                self.bump(assigned)
+                processed.append(statement)
+                continue
+            if not isinstance(statement, ast.Assign) or \
+                    len(statement.targets) != 1 or \
+                    not isinstance(statement.targets[0], ast.Name):
+                self.bump(self.get_stores([statement]))
+                processed.append(statement)
+                continue
+            target = statement.targets[0].id
+            once = self.assignments[target] == 1 and \
+                target not in self.params
+            if isinstance(statement.value, ast.BinOp):
+                value = self.fold(statement.value)
+                if value is not None:
+                    statement.value = ast.Num(value)
+            if isinstance(statement.value, ast.Num) and once:
+                self.constants[target] = statement.value.n
+                self.symbol_table[target] = statement.value.n
+                continue
+            key = self.get_key(statement.value)
+            if key in available and once:
+                name, version = available[key]
+                read = set()
+                for previous in processed:
+                    read |= get_names(previous)
+                if self.versions.get(name, 0) == version and \
+                        self.assignments[name] == 1 and target not in read:
+                    self.renames[target] = name
+                    continue
+            self.bump([target])
+            if key is not None and target not in get_names(statement.value):
+                available[key] = (target, self.versions[target])
+            processed.append(statement)
+        return processed
+
+
+class SeparateFilters(ast.NodeTransformer):
+    """
+    Replaces a Convolve2D by a rank 1 filter with a Convolve2D of the
+    source by the row factor of the filter into an intermediate, followed
+    by a Convolve2D of the intermediate by the column factor (see
+    Convolve2D.separate).  Runs before ReplaceArrayOps, which allocates
+    the intermediates.  Filters assigned in the function are not known
+    at compile time and are left alone.
+    """
+    unique_id = -1
+
+    def __init__(self, symbol_table):
+        super(SeparateFilters, self).__init__()
+        self.symbol_table = symbol_table
+        self.assigned = set()
+
+    def gen_tmp(self):
+        self.unique_id += 1
+        return "_hm_separable_{}".format(self.unique_id)
+
+    def visit_FunctionDef(self, node):
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and \
+                    isinstance(child.ctx, ast.Store):
+                self.assigned.add(child.id)
+        self.generic_visit(node)
+        return node
+
+    def visit_Assign(self, node):
+        call = node.value
+        if not isinstance(call, ast.Call) or \
+                not isinstance(call.func, ast.Name) or \
+                self.symbol_table.get(call.func.id) is not Convolve2D or \
+                len(call.args) != 2 or \
+                not all(isinstance(arg, ast.Name) for arg in call.args) or \
+                call.args[1].id in self.assigned:
+            return node
+        factors = Convolve2D.separate(self.symbol_table.get(call.args[1].id))
+        if factors is None:
+            return node
+        name = self.gen_tmp()
+        column, row = name + "_column", name + "_row"
+        self.symbol_table[column], self.symbol_table[row] = factors
+        rows = ast.Assign(
+            [ast.Name(name, ast.Store())],
+            ast.Call(ast.Name(call.func.id, ast.Load()),
+                     [call.args[0], ast.Name(row, ast.Load())],
+                     call.keywords, None, None))
+        call.args = [ast.Name(name, ast.Load()), ast.Name(column, ast.Load())]
+        return [rows, node]
+
+
 class ReplaceArrayOps(ast.NodeTransformer):
     array_op_map = {
         ast.Add: 'ArrayAdd',
@@ -504,28 +2082,41 @@ class ReplaceArrayOps(ast.NodeTransformer):
     def __init__(self, symbol_table):
         super(ReplaceArrayOps, self).__init__()
         self.symbol_table = symbol_table
+        self.placeholders = {}
 
     def visit_Assign(self, node):
         node.value = self.visit(node.value)
-        if not isinstance(node.targets[0], ast.Name) or node.targets[0].id in self.symbol_table:
-            return node
-        if isinstance(node.value, ast.BinOp) and len(node.targets) == 1:
-            if isinstance(node.value, ast.Call):
-                # TODO: Operations should specify an output generator
-                self.symbol_table[node.targets[0].id] = hm.zeros(
-                    self.symbol_table[node.value.args[0].id].shape)
+        target = node.targets[0]
+        if isinstance(target, ast.Name):
+            names = [target.id]
+        elif isinstance(target, ast.Tuple) and \
+                all(isinstance(elt, ast.Name) for elt in target.elts):
+            names = [elt.id for elt in target.elts]
         else:
-            if isinstance(node.value, ast.Call) and \
-                    inspect.isclass(self.symbol_table[node.value.func.id]) and \
-                    issubclass(self.symbol_table[node.value.func.id], HMOperation):
-                # TODO: Operations should specify an output generator
-                self.symbol_table[node.targets[0].id] = hm.zeros(
-                    self.symbol_table[node.value.args[0].id].shape)
+            return node
+        if all(name in self.symbol_table for name in names) or \
+                not isinstance(node.value, ast.Call) or \
+                not isinstance(node.value.func, ast.Name):
+            return node
+        func = self.symbol_table.get(node.value.func.id)
+        if not inspect.isclass(func) or not issubclass(func, HMOperation):
+            return node
+        # Values assigned by Python statements are not known yet
+        sources = [self.symbol_table.get(arg.id)
+                   if isinstance(arg, ast.Name) else None
+                   for arg in node.value.args]
+        keywords = get_keywords(node.value, self.symbol_table)
+        outputs = func.infer_outputs(sources, len(names), keywords)
+        for name, (shape, dtype) in zip(names, outputs):
+            if name not in self.symbol_table:
+                self.placeholders[name] = Placeholder(shape, dtype)
+                self.symbol_table[name] = self.placeholders[name]
         return node
 
     def visit_BinOp(self, node):
-        if isinstance(self.symbol_table[node.left.id], hmarray):
-            if isinstance(self.symbol_table[node.right.id], hmarray):
+        if isinstance(self.symbol_table[node.left.id], (hmarray, Placeholder)):
+            if isinstance(self.symbol_table[node.right.id],
+                          (hmarray, Placeholder)):
                 node = ast.Call(ast.Name(self.array_op_map[node.op.__class__],
                                          ast.Load()),
                                 [node.left, node.right], [], None, None)
@@ -534,3 +2125,128 @@ class ReplaceArrayOps(ast.NodeTransformer):
                                          ast.Load()),
                                 [node.left, node.right], [], None, None)
         return node
+
+
+class HoistInvariants(ast.NodeTransformer):
+    """
+    Loop-invariant code motion, runs after ReplaceArrayOps.  An operation
+    in a loop body whose sources are not assigned by the loop computes the
+    same value every iteration, it is moved in front of the loop (inner
+    loops first, so an operation can leave a nest of loops).
+
+    Only operations assigning intermediates are moved: their targets are
+    assigned by nothing else in the function and not read by the loop
+    before them.  With reciprocals, ArrayDiv by an invariant array becomes
+    ArrayMul by its Reciprocal computed in front of the loop, which rounds
+    differently and is only done under HM_FAST_MATH.
+    """
+    unique_id = -1
+
+    def __init__(self, symbol_table, placeholders, reciprocals=False):
+        super(HoistInvariants, self).__init__()
+        self.symbol_table = symbol_table
+        self.placeholders = placeholders
+        self.reciprocals = reciprocals
+        self.assignments = {}
+
+    def gen_tmp(self):
+        self.unique_id += 1
+        return "_hm_invariant_{}".format(self.unique_id)
+
+    def visit_FunctionDef(self, node):
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and \
+                    isinstance(child.ctx, ast.Store):
+                self.assignments[child.id] = \
+                    self.assignments.get(child.id, 0) + 1
+        self.generic_visit(node)
+        return node
+
+    def visit_For(self, node):
+        return self.hoist(node, [node.target, node.iter])
+
+    def visit_While(self, node):
+        return self.hoist(node, [node.test])
+
+    def get_operation(self, statement):
+        """
+        Return the HMOperation called by statement, or None.
+        """
+        if not isinstance(statement, ast.Assign) or \
+                len(statement.targets) != 1 or \
+                not isinstance(statement.value, ast.Call) or \
+                not isinstance(statement.value.func, ast.Name):
+            return None
+        func = self.symbol_table.get(statement.value.func.id)
+        if inspect.isclass(func) and issubclass(func, HMOperation):
+            return func
+        return None
+
+    def is_invariant(self, statement, assigned, read):
+        """
+        Whether statement is an operation that can be moved out of a loop
+        assigning the names assigned, after statements reading read.
+        """
+        if isinstance(statement, ast.Assign) and \
+                isinstance(statement.value, ast.Num):
+            # A literal UnpackBinOps assigned to a temporary
+            targets = get_names(statement.targets[0])
+            return len(targets) == 1 and not targets & read and \
+                self.assignments.get(targets.pop()) == 1
+        if self.get_operation(statement) is None:
+            return False
+        targets = get_names(statement.targets[0])
+        return not get_names(statement.value) & assigned and \
+            not targets & read and \
+            all(self.assignments.get(name) == 1 and
+                name in self.placeholders for name in targets)
+
+    def hoist(self, loop, header):
+        self.generic_visit(loop)
+        assigned = set()
+        for statement in loop.body:
+            for child in ast.walk(statement):
+                if isinstance(child, ast.Name) and \
+                        isinstance(child.ctx, ast.Store):
+                    assigned.add(child.id)
+        if isinstance(loop, ast.For):
+            assigned |= get_names(loop.target)
+        hoisted = []
+        moved = True
+        while moved:
+            moved = False
+            read = set()
+            for node in header:
+                read |= get_names(node)
+            for statement in loop.body:
+                if self.is_invariant(statement, assigned, read):
+                    loop.body.remove(statement)
+                    hoisted.append(statement)
+                    assigned -= get_names(statement.targets[0])
+                    moved = True
+                    break
+                read |= get_names(statement)
+        if self.reciprocals:
+            reciprocals = {}
+            for statement in loop.body:
+                if self.get_operation(statement) is not ArrayDiv:
+                    continue
+                divisor = statement.value.args[1]
+                if divisor.id in assigned:
+                    continue
+                if divisor.id not in reciprocals:
+                    name = self.gen_tmp()
+                    reciprocals[divisor.id] = name
+                    hoisted.append(ast.Assign(
+                        [ast.Name(name, ast.Store())],
+                        ast.Call(ast.Name('Reciprocal', ast.Load()),
+                                 [ast.Name(divisor.id, ast.Load())], [],
+                                 None, None)))
+                    divisor_value = self.symbol_table[divisor.id]
+                    self.placeholders[name] = Placeholder(
+                        divisor_value.shape, divisor_value.dtype)
+                    self.symbol_table[name] = self.placeholders[name]
+                statement.value.func = ast.Name('ArrayMul', ast.Load())
+                statement.value.args[1] = ast.Name(reciprocals[divisor.id],
+                                                   ast.Load())
+        return hoisted + [loop]
@@ -0,0 +1,158 @@
+"""
+Memory planning for the intermediates of composed functions.
+
+Every array a composed function assigns without it being passed in is an
+intermediate, it used to get a buffer of its own for the lifetime of the
+function.  Intermediates whose live ranges do not overlap can share one
+buffer instead: the planner assigns them to a small pool of buffers,
+each as large as the largest intermediate assigned to it, and binds each
+intermediate to an alias of its pool buffer (hmarray.alias).
+"""
+import numpy as np
+import hindemith as hm
+
+
+class Placeholder(object):
+    """
+    Shape and dtype of an intermediate that has not been allocated yet.
+    """
+    def __init__(self, shape, dtype=np.float32):
+        self.shape = tuple(int(dim) for dim in shape)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __repr__(self):
+        return "Placeholder({}, {})".format(self.shape, self.dtype)
+
+
+class MemoryPlan(object):
+    """
+    Assignment of intermediates to pool buffers.
+
+    :param dict placeholders: Placeholder of each intermediate
+    :param dict ranges: (first, last) position each intermediate is live
+        at, intermediates live at a common position never share a buffer.
+        Intermediates without a range are allocated on their own.
+    :param set registers: Intermediates fusion may keep in registers, they
+        are only allocated (by materialize) if a kernel needs them in
+        memory
+    """
+    def __init__(self, placeholders, ranges, registers=()):
+        self.placeholders = placeholders
+        self.registers = set(registers)
+        self.ranges = dict((name, live) for name, live in ranges.items()
+                           if name not in self.registers)
+        ranges = self.ranges
+        self.sizes = []
+        self.assignment = {}
+        self.unplanned = sorted(name for name in placeholders
+                                if name not in ranges and
+                                name not in self.registers)
+        self.materialized = []
+        ends = []
+        # Linear scan in order of first use, larger intermediates first so
+        # they claim the buffers the smaller ones then fit into
+        for name in sorted(ranges, key=lambda name: (
+                ranges[name][0], -placeholders[name].nbytes, name)):
+            first, last = ranges[name]
+            nbytes = placeholders[name].nbytes
+            free = [i for i, end in enumerate(ends) if end < first]
+            fits = [i for i in free if self.sizes[i] >= nbytes]
+            if fits:
+                index = min(fits, key=lambda i: self.sizes[i])
+            elif free:
+                index = max(free, key=lambda i: self.sizes[i])
+                self.sizes[index] = nbytes
+            else:
+                index = len(self.sizes)
+                self.sizes.append(nbytes)
+                ends.append(last)
+            ends[index] = last
+            self.assignment[name] = index
+        # Names sharing a buffer map to the first of them, kernels ordered
+        # by name must order accesses to any of them
+        self.storage = {}
+        for name, index in self.assignment.items():
+            shared = [other for other, i in self.assignment.items()
+                      if i == index]
+            if len(shared) > 1:
+                self.storage[name] = min(shared)
+
+    @property
+    def unplanned_bytes(self):
+        """
+        Bytes needed when every intermediate has a buffer of its own.
+        """
+        return sum(placeholder.nbytes
+                   for placeholder in self.placeholders.values())
+
+    @property
+    def planned_bytes(self):
+        """
+        Bytes needed by the pool and the intermediates left out of it.
+        """
+        return sum(self.sizes) + sum(
+            self.placeholders[name].nbytes
+            for name in self.unplanned + self.materialized)
+
+    @property
+    def register_bytes(self):
+        """
+        Bytes of the intermediates kept in registers, which are not
+        allocated at all.
+        """
+        return sum(self.placeholders[name].nbytes for name in self.registers
+                   if name not in self.materialized)
+
+    @property
+    def live_bytes(self):
+        """
+        Largest number of bytes of planned intermediates live at the same
+        position, no plan can use less.
+        """
+        live = {}
+        for name, (first, last) in self.ranges.items():
+            for position in range(first, last + 1):
+                live[position] = live.get(position, 0) + \
+                    self.placeholders[name].nbytes
+        return max(live.values()) if live else 0
+
+    def allocate(self):
+        """
+        Allocate the pool and return the array bound to each intermediate.
+        """
+        pool = [hm.zeros((nbytes, ), np.uint8) for nbytes in self.sizes]
+        arrays = {}
+        for name, index in self.assignment.items():
+            placeholder = self.placeholders[name]
+            arrays[name] = pool[index].alias(placeholder.shape,
+                                             placeholder.dtype)
+        for name in self.unplanned:
+            placeholder = self.placeholders[name]
+            arrays[name] = hm.zeros(placeholder.shape, placeholder.dtype)
+        return arrays
+
+    def materialize(self, name):
+        """
+        Allocate a register intermediate that a kernel needs in memory.
+        """
+        placeholder = self.placeholders[name]
+        self.materialized.append(name)
+        return hm.zeros(placeholder.shape, placeholder.dtype)
+
+    def report(self):
+        """
+        Return a summary of the memory used by intermediates before and
+        after planning.
+        """
+        return ("{} intermediates: {:.2f} MB before planning, {:.2f} MB "
+                "after in {} pool buffers ({:.2f} MB live at most), {} left "
+                "unplanned, {} kept in registers ({:.2f} MB)").format(
+                    len(self.placeholders), self.unplanned_bytes / 2.0 ** 20,
+                    self.planned_bytes / 2.0 ** 20, len(self.sizes),
+                    self.live_bytes / 2.0 ** 20, len(self.unplanned),
+                    len(self.registers) - len(self.materialized),
+                    self.register_bytes / 2.0 ** 20)
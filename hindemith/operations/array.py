@@ -40,12 +40,15 @@ class ArrayScalarOp(ElementwiseArrayOp):
     """
     b = Add(a, 1)
     """
+    constant_sources = (1, )
+    runtime_sources = (1, )
+
     @classmethod
     def emit(cls, sources, sinks, keywords, symbol_table):
         return Template(
             "$target = $operand1 $op $operand2;"
         ).substitute(target=sinks[0].get_element(), op=cls.op, operand1=sources[0].get_element(),
-                     operand2=symbol_table[sources[1].name])
+                     operand2=sources[1].constant(symbol_table))
 
 
 class ArrayScalarAdd(ArrayScalarOp, ArrayAdd):
@@ -85,3 +88,11 @@ class Square(ElementwiseArrayMap):
         return Template(
             "$target = pow($operand, 2);"
         ).substitute(target=sinks[0].get_element(), operand=sources[0].get_element())
+
+
+class Reciprocal(ElementwiseArrayMap):
+    @classmethod
+    def emit(cls, sources, sinks, keywords, symbol_table):
+        return Template(
+            "$target = 1.0f / $operand;"
+        ).substitute(target=sinks[0].get_element(), operand=sources[0].get_element())
@@ -7,9 +7,22 @@ import ast
 
 backend = os.getenv("HM_BACKEND", "ocl")
 
+
+class Concat(DeviceLevel):
+    """
+    top = ConcatForward(*bottoms), concatenates bottoms along the channel
+    dimension
+    """
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        shape = list(sources[0].shape)
+        shape[1] = sum(source.shape[1] for source in sources)
+        return [(tuple(shape), sources[0].dtype)]
+
+
 if backend in {"ocl", "opencl", "OCL"}:
-    from hindemith.cl import context, queues
-    class ConcatForward(DeviceLevel):
+    from hindemith.cl import context, queues, build_program
+    class ConcatForward(Concat):
         @classmethod
         def get_launcher(cls, sources, sinks, keyword, symbol_table):
             bottoms = sources
@@ -20,7 +33,7 @@ if backend in {"ocl", "opencl", "OCL"}:
         top[index + top_offset] = bottom[index + bot_offset];
     }
             """).substitute()
-            program = cl.clCreateProgramWithSource(context, concat_kern).build()
+            program = build_program(concat_kern)
             kernel = program['concat']
             kernel.argtypes = (cl.cl_mem, cl.cl_mem, cl.cl_int, cl.cl_int)
 
@@ -52,7 +65,7 @@ if backend in {"ocl", "opencl", "OCL"}:
             return Launcher(sources, sinks)
 
 elif backend in {"omp", "openmp"}:
-    class ConcatForward(DeviceLevel):
+    class ConcatForward(Concat):
         @classmethod
         def get_launcher(cls, sources, sinks, keyword, symbol_table):
             bottoms = sources
@@ -9,7 +9,8 @@ import ast
 backend = os.getenv("HM_BACKEND", "ocl")
 if backend in {"ocl", "opencl", "OCL"}:
     from hindemith.clibs.clblas import sgemm, sgemv
-    from hindemith.cl import context, queues, hm_compile_and_load
+    from hindemith.cl import context, queues, hm_compile_and_load, \
+        build_program
 else:
     from hindemith.cl import hm_compile_and_load
 
@@ -68,6 +69,17 @@ class ConvForward(DeviceLevel):
     top = ConvForward(bottom, weights, bias, kernel_size=(11, 11),
                       stride=(1, 1), padding=(0, 0))
     """
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        num, _, height, width = sources[0].shape
+        kernel_h, kernel_w = keywords['kernel_size']
+        pad_h, pad_w = keywords['padding']
+        stride_h, stride_w = keywords['stride']
+        height_out = (height + 2 * pad_h - kernel_h) // stride_h + 1
+        width_out = (width + 2 * pad_w - kernel_w) // stride_w + 1
+        shape = (num, sources[1].shape[0], height_out, width_out)
+        return [(shape, sources[0].dtype)]
+
     if backend in {"ocl", "opencl", "OCL"}:
         @classmethod
         def get_launcher(cls, sources, sinks, keywords, symbol_table):
@@ -126,9 +138,7 @@ class ConvForward(DeviceLevel):
                     height=height, height_col=height_col,
                     width_col=width_col)
 
-            im2col = cl.clCreateProgramWithSource(
-                context, im2col
-            ).build()['im2col']
+            im2col = build_program(im2col)['im2col']
             im2col.argtypes = (cl.cl_mem, cl.cl_mem, cl.cl_int)
 
             if im2col_global_size % 64:
@@ -140,6 +150,9 @@ class ConvForward(DeviceLevel):
                 def __init__(self, sources, sinks):
                     self.sources = sources
                     self.sinks = sinks
+                    # Last events reading each col buffer, calls are not
+                    # synchronized with each other
+                    self.col_evts = [[] for _ in range(len(queues))]
 
                 def compile(self):
                     pass
@@ -167,16 +180,23 @@ class ConvForward(DeviceLevel):
                                         top_offset, n, m, n, 1, queues[i % len(queues)], wait_for=evt)
                             evts.append(evt)
                     else:
+                        # Each col buffer is reused every len(queues) items,
+                        # im2col must wait for the sgemm reading it (implied
+                        # on an in-order queue, not on an out-of-order one)
+                        col_evts = self.col_evts
                         for i in range(bottom.shape[0]):
+                            slot = i % len(queues)
                             evt = im2col(bottom.ocl_buf,
-                                        col_datas[i % len(queues)].ocl_buf,
+                                        col_datas[slot].ocl_buf,
                                         i * bot_offset
-                                        ).on(queues[i % len(queues)], (padded, ),
-                                            wait_for=wait_for)
+                                        ).on(queues[slot], (padded, ),
+                                             wait_for=list(wait_for or []) +
+                                             col_evts[slot])
                             evt = sgemm(False, False, 1.0, weights, 0, k,
-                                        col_datas[i % len(queues)],
+                                        col_datas[slot],
                                         0, n, 0.0, top, i * top_offset, n, m, n,
-                                        k, queues[i % len(queues)], wait_for=evt)
+                                        k, queues[slot], wait_for=evt)
+                            col_evts[slot] = [evt]
                             evt = sgemm(False, False, 1.0, bias, 0, 1,
                                         bias_multiplier, 0, n, 1.0, top, i *
                                         top_offset, n, m, n, 1, queues[i % len(queues)], wait_for=evt)
@@ -271,6 +291,12 @@ class ConvBackward(DeviceLevel):
         ConvBackward(bottom, top_diff, weights,
                      kernel_size=(11, 11), stride=(1, 1), padding=(0, 0))
     """
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        bottom, _, weights = sources
+        return [(bottom.shape, bottom.dtype), (weights.shape, weights.dtype),
+                ((weights.shape[0], ), weights.dtype)]
+
     @classmethod
     def get_launcher(cls, sources, sinks, keywords, symbol_table):
         kernel_h, kernel_w = keywords['kernel_size']
@@ -349,7 +375,7 @@ __kernel void im2col(global const float* data_im, global float* data_col,
                 height=height, height_col=height_col,
                 width_col=width_col, col2im_global_size=col2im_global_size)
 
-        program = cl.clCreateProgramWithSource(context, kernels).build()
+        program = build_program(kernels)
         im2col = program['im2col']
         im2col.argtypes = (cl.cl_mem, cl.cl_mem, cl.cl_int)
         col2im = program['col2im']
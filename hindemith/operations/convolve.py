@@ -1,56 +1,70 @@
 __author__ = 'leonardtruong'
 
-from hindemith.operations.core import ElementLevel
+from hindemith.operations.core import StencilLevel
 import numpy as np
-from string import Template
+import os
 
+# Rank 1 filters are applied as a convolution by a row followed by a
+# convolution by a column, see Convolve2D.separate.  A filter is rank 1 if
+# its second singular value is at most separable_tolerance times its
+# first.  Set HM_SEPARABLE=0 to always apply filters as given.
+separable = os.getenv("HM_SEPARABLE", "1") not in {"0", "false", "False",
+                                                   "off"}
+separable_tolerance = float(os.getenv("HM_SEPARABLE_TOLERANCE", "1e-6"))
 
-class Convolve2D(ElementLevel):
+
+class Convolve2D(StencilLevel):
     """
     output = Convolve(input, filter)
     """
+    constant_sources = (1, )
+    gather_sources = (0, )
+    runtime_sources = (1, )
+
     @classmethod
-    def get_launch_parameters(cls, sources, sinks):
-        num_work_items = np.prod(sinks[0].shape)
-        return (num_work_items, )
+    def separate(cls, weights):
+        """
+        Return a column and a row filter (of shapes (kernel_h, 1) and
+        (1, kernel_w)) whose product is weights if weights is a rank 1
+        filter, or None.  Convolving by the row and then by the column
+        gives the same output (clamping rows and columns independently)
+        in kernel_h + kernel_w taps instead of kernel_h * kernel_w.
+        """
+        if not separable or not isinstance(weights, np.ndarray) or \
+                weights.ndim != 2 or min(weights.shape) < 2:
+            return None
+        u, s, vt = np.linalg.svd(weights.astype(np.float64))
+        if s[0] == 0 or s[1] > separable_tolerance * s[0] or \
+                sum(weights.shape) >= weights.size:
+            return None
+        scale = np.sqrt(s[0])
+        return u[:, :1] * scale, vt[:1, :] * scale
 
     @classmethod
-    def emit(cls, sources, sinks, keywords, symbol_table):
-        height, width = symbol_table[sources[0].name].shape
+    def get_radius(cls, sources, keywords, symbol_table):
         kernel_h, kernel_w = symbol_table[sources[1].name].shape
+        return (kernel_h // 2, kernel_w // 2)
+
+    @classmethod
+    def emit(cls, sources, sinks, keywords, symbol_table):
+        weights = symbol_table[sources[1].name]
+        kernel_h, kernel_w = weights.shape
         kernel_str = """
         {
-        int x = index % $width;
-        int y = index / $width;
         float accum = 0.0;
         """
         for i in range(kernel_h):
-            y_off = i - (kernel_h // 2)
-            if y_off < 0:
-                y_index = "max(y + {}, 0)".format(y_off)
-            elif y_off > 0:
-                y_index = "min(y + {}, $height - 1)".format(y_off)
-            else:
-                y_index = "y"
-
             for j in range(kernel_w):
-                weight = symbol_table[sources[1].name][i, j]
-                if weight == 0:
+                # Weights passed at run time can change to anything
+                if weights[i, j] == 0 and sources[1].level != 'constant':
                     continue
-                x_off = j - (kernel_w // 2)
-                if x_off < 0:
-                    x_index = "max(x + {}, 0)".format(x_off)
-                elif x_off > 0:
-                    x_index = "min(x + {}, $width - 1)".format(x_off)
-                else:
-                    x_index = "x"
                 kernel_str += """
-                accum += {0}f * $input[{1} * $width + {2}];
-                """.format(weight, y_index, x_index)
+                accum += {0} * {1};
+                """.format(sources[1].constant(symbol_table,
+                                               i * kernel_w + j),
+                           sources[0].neighbour(i - (kernel_h // 2),
+                                                j - (kernel_w // 2)))
         kernel_str += """
-            $output = accum;
-        }"""
-        return Template(
-            kernel_str
-        ).substitute(output=sinks[0].get_element(), input=sources[0].name,
-                     height=height, width=width, kernel_h=kernel_h, kernel_w=kernel_w)
+            {} = accum;
+        }}""".format(sinks[0].get_element())
+        return kernel_str
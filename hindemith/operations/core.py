@@ -1,6 +1,7 @@
 import numpy as np
 from string import Template
 from hindemith.types import hmarray
+from hindemith.cl import ReduceKernel
 from ctree.frontend import get_ast
 from ctree.transformations import PyBasicConversions
 import ctree.c.nodes as C
@@ -15,7 +16,43 @@ class HMUndefinedMethodError(NotImplementedError):
 
 
 class HMOperation(object):
-    pass
+    """
+    Base class of all Hindemith operations.
+
+    :attr tuple constant_sources: Indices of sources whose values (not just
+        shapes) are baked into the generated code, calls with different
+        values for these sources are compiled separately.
+    :attr tuple gather_sources: Indices of sources read at elements other
+        than the one a work item writes.  Their elements must be read
+        through Param.gather, so the fuser can inline the producer of the
+        source at each gather site.
+    :attr tuple runtime_sources: Indices of constant_sources (scalars or
+        small filters) the operation reads through Param.constant.  In
+        functions composed with runtime_constants their values are passed
+        to kernels as arguments instead, calls with different values
+        share a plan and its compiled kernels.
+    """
+    constant_sources = ()
+    gather_sources = ()
+    runtime_sources = ()
+
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        """
+        Return the shape and dtype of each sink, used to allocate sinks
+        the composed function does not receive as arguments.  By default
+        every sink is shaped like the first source.
+
+        :param list sources: Source values, arrays or Placeholders for
+            arrays that are not allocated yet, None for values that are
+            not known at compile time
+        :param int num_sinks: Number of sinks assigned
+        :param dict keywords: Keyword arguments of the operation
+
+        :returns: List of (shape, dtype) tuples, one per sink
+        :rtype: list
+        """
+        return [(sources[0].shape, sources[0].dtype)] * num_sinks
 
 
 class DeviceLevel(HMOperation):
@@ -27,6 +64,40 @@ class DeviceLevel(HMOperation):
         raise HMUndefinedMethodError(cls, "get_launcher")
 
 
+class ReduceLevel(DeviceLevel):
+    """
+    An operation reducing an element computed from its sources for every
+    index to a single value, its only sink (of shape (1, )).
+
+    :attr str reduction: How elements are combined, one of "sum", "max",
+        "min", "argmax" (the first index of the largest element, as a
+        float) or "norm" (the Euclidean norm).
+
+    Sources are read through Param.gather, list them in gather_sources so
+    ElementLevel producers of the sources are fused into the reduction.
+    """
+    reduction = None
+
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        return [((1, ), np.float32)]
+
+    @classmethod
+    def element(cls, sources, keywords):
+        """
+        Return the C expression of the element reduced at index, by
+        default the element of the first source.
+
+        :param list sources: List of sources as Params
+        """
+        return sources[0].gather("index")
+
+    @classmethod
+    def get_launcher(cls, sources, sinks, keywords, symbol_table):
+        count = int(np.prod(symbol_table[sources[0].name].shape))
+        return ReduceKernel(cls, sources, keywords, count)
+
+
 class BlockLevel(HMOperation):
     """
     An OpenCL Kernel
@@ -90,6 +161,37 @@ class ElementLevel(HMOperation):
         raise HMUndefinedMethodError(cls, "emit")
 
 
+class StencilLevel(ElementLevel):
+    """
+    An ElementLevel operation on 2D arrays whose element (y, x) reads the
+    elements of its gather_sources within a fixed radius of (y, x).
+    Neighbours are read through Param.neighbour, which clamps coordinates
+    to the edges of the source, sinks must be shaped like the gathered
+    sources.
+
+    Kernels containing a stencil are launched over 2D tiles: on OpenCL
+    every work group loads its tile of each gathered source and the halo
+    around it into local memory once, on OpenMP the elements are visited
+    in cache-sized blocks.  Coordinates are only clamped in the tiles and
+    blocks at the edges of the array.
+    """
+    @classmethod
+    def get_launch_parameters(cls, sources, sinks):
+        num_work_items = np.prod(sinks[0].shape)
+        return (num_work_items, )
+
+    @classmethod
+    def get_radius(cls, sources, keywords, symbol_table):
+        """
+        Return the largest distance in rows and in columns between an
+        element and the neighbours it reads.
+
+        :returns: (rows, columns)
+        :rtype: tuple(int)
+        """
+        raise HMUndefinedMethodError(cls, "get_radius")
+
+
 class MapTransformer(ast.NodeTransformer):
     def __init__(self, mapping, target):
         super(MapTransformer, self).__init__()
@@ -5,8 +5,11 @@ from string import Template
 
 class Dropout(ElementLevel):
     """
-    top = Dropout(bottom, mask)
+    top = Dropout(bottom, mask, scale), scale is 1.0 / (1.0 - threshold)
     """
+    constant_sources = (2, )
+    runtime_sources = (2, )
+
     @classmethod
     def get_launch_parameters(cls, sources, sinks):
         num_work_items = np.prod(sources[0].shape)
@@ -14,10 +17,9 @@ class Dropout(ElementLevel):
 
     @classmethod
     def emit(cls, sources, sinks, keywords, symbol_table):
-        threshold = keywords['threshold']
-        scale = 1.0 / (1.0 - threshold)
         return Template(
-            "$target[get_global_id(0)] = $operand[get_global_id(0)] *"
-            "$mask[get_global_id(0)] * (float) $scale;"
-        ).substitute(target=sinks[0], operand=sources[0], mask=sources[1],
-                     scale=scale)
+            "$target = $operand * $mask * (float) $scale;"
+        ).substitute(target=sinks[0].get_element(),
+                     operand=sources[0].get_element(),
+                     mask=sources[1].get_element(),
+                     scale=sources[2].constant(symbol_table))
@@ -11,6 +11,14 @@ if backend in {"ocl", "opencl", "OCL"}:
     from hindemith.clibs.clblas import sgemm
 
 class InnerProductForward(DeviceLevel):
+    """
+    top = InnerProductForward(bottom, weights, bias)
+    """
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        bottom, weights = sources[:2]
+        return [((bottom.shape[0], weights.shape[0]), bottom.dtype)]
+
     if backend in {"ocl", "opencl", "OCL"}:
         @classmethod
         def get_launcher(cls, sources, sinks, keywords, symbol_table):
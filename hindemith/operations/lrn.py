@@ -1,11 +1,13 @@
 from hindemith.operations.core import DeviceLevel, ElementLevel
 from string import Template
 import numpy as np
+import ctypes as ct
 import os
 import ast
 backend = os.getenv("HM_BACKEND", "ocl")
 if backend in {"ocl", "opencl", "OCL"}:
-    from hindemith.cl import context, queue, hm_compile_and_load
+    from hindemith.cl import context, queue, hm_compile_and_load, \
+        build_program
     import pycl as cl
 else:
     from hindemith.cl import hm_compile_and_load
@@ -24,11 +26,17 @@ if backend in {"ocl", "opencl", "OCL"}:
             alpha = keywords['alpha']
             k = keywords['k']
             beta = keywords['beta']
+            # Passed to the kernels as arguments, so LRN layers differing
+            # only in these share a compiled program
+            alpha_over_size = float(alpha) / local_size
+            negative_beta = -float(beta)
+            k = float(k)
             compute_global = (num * channels * height * width, )
             fill_global = (num * height * width, )
             kernel = Template("""
     // @begin=cl@
-    __kernel void LRNFillScale(global const float* in, global float* scale) {
+    __kernel void LRNFillScale(global const float* in, global float* scale,
+                               const float k, const float alpha_over_size) {
       if (get_global_id(0) < $fill_global) {
         int index = get_global_id(0);
         int w = index % $width;
@@ -55,7 +63,7 @@ if backend in {"ocl", "opencl", "OCL"}:
             accum_scale -= in[(head - $local_size) * step] * \
                 in[(head - $local_size) * step];
           }
-          scale[(head - post_pad) * step] = $k + accum_scale * $alpha_over_size;
+          scale[(head - post_pad) * step] = k + accum_scale * alpha_over_size;
           ++head;
         }
         // subtract only
@@ -64,33 +72,32 @@ if backend in {"ocl", "opencl", "OCL"}:
             accum_scale -= in[(head - $local_size) * step] * \
                 in[(head - $local_size) * step];
           }
-          scale[(head - post_pad) * step] = $k + accum_scale * $alpha_over_size;
+          scale[(head - post_pad) * step] = k + accum_scale * alpha_over_size;
           ++head;
         }
       }
     }
     __kernel void LRNComputeOutput(global const float* in,
                                    global const float* scale,
-                                   global float* out) {
+                                   global float* out,
+                                   const float negative_beta) {
       if (get_global_id(0) < $compute_global) {
         int index = get_global_id(0);
-        out[index] = in[index] * pow(scale[index], (float)$negative_beta);
+        out[index] = in[index] * pow(scale[index], negative_beta);
       }
     }
     // @end=cl@
     """).substitute(width=width, height=height, channels=channels,
-                    local_size=local_size,
-                    alpha_over_size=float(alpha) / local_size,
-                    k=k, negative_beta=-beta, fill_global=fill_global[0],
+                    local_size=local_size, fill_global=fill_global[0],
                     compute_global=compute_global[0])
-            program = cl.clCreateProgramWithSource(
-                context, kernel
-            ).build()
+            program = build_program(kernel)
             fill_kern = program['LRNFillScale']
-            fill_kern.argtypes = (cl.cl_mem, cl.cl_mem)
+            fill_kern.argtypes = (cl.cl_mem, cl.cl_mem, cl.cl_float,
+                                  cl.cl_float)
 
             compute_kern = program['LRNComputeOutput']
-            compute_kern.argtypes = (cl.cl_mem, cl.cl_mem, cl.cl_mem)
+            compute_kern.argtypes = (cl.cl_mem, cl.cl_mem, cl.cl_mem,
+                                     cl.cl_float)
 
             class LrnLauncher(object):
                 def __init__(self, sources, sinks):
@@ -108,13 +115,16 @@ if backend in {"ocl", "opencl", "OCL"}:
                         padded = (fill_global[0] + 15) & (~15)
                     else:
                         padded = fill_global[0]
-                    evt = fill_kern(bottom.ocl_buf, scale.ocl_buf).on(queue, (padded,), wait_for=wait_for)
+                    evt = fill_kern(bottom.ocl_buf, scale.ocl_buf, k,
+                                    alpha_over_size).on(
+                        queue, (padded,), wait_for=wait_for)
                     if compute_global[0] % 16:
                         padded = (compute_global[0] + 15) & (~15)
                     else:
                         padded = compute_global[0]
                     evt = compute_kern(bottom.ocl_buf, scale.ocl_buf,
-                                       top.ocl_buf).on(queue, (padded,), wait_for=evt)
+                                       top.ocl_buf, negative_beta).on(
+                        queue, (padded,), wait_for=evt)
                     return [evt]
             return LrnLauncher(sources, sinks)
 elif backend in {"omp", "openmp"}:
@@ -130,11 +140,17 @@ elif backend in {"omp", "openmp"}:
             alpha = keywords['alpha']
             k = keywords['k']
             beta = keywords['beta']
+            # Passed to the kernels as arguments, so LRN layers differing
+            # only in these share a compiled program
+            alpha_over_size = float(alpha) / local_size
+            negative_beta = -float(beta)
+            k = float(k)
             compute_global = (num * channels * height * width, )
             fill_global = (num * height * width, )
             kernel = Template("""
     #include <math.h>
-    void LRNFillScale(float* in_global, float* scale_global) {
+    void LRNFillScale(float* in_global, float* scale_global, float k,
+                      float alpha_over_size) {
       for (int index = 0; index < $fill_global; index++) {
         int w = index % $width;
         int h = (index / $width) % $height;
@@ -160,7 +176,7 @@ elif backend in {"omp", "openmp"}:
             accum_scale -= in[(head - $local_size) * step] * \
                 in[(head - $local_size) * step];
           }
-          scale[(head - post_pad) * step] = $k + accum_scale * $alpha_over_size;
+          scale[(head - post_pad) * step] = k + accum_scale * alpha_over_size;
           ++head;
         }
         // subtract only
@@ -169,20 +185,19 @@ elif backend in {"omp", "openmp"}:
             accum_scale -= in[(head - $local_size) * step] * \
                 in[(head - $local_size) * step];
           }
-          scale[(head - post_pad) * step] = $k + accum_scale * $alpha_over_size;
+          scale[(head - post_pad) * step] = k + accum_scale * alpha_over_size;
           ++head;
         }
       }
     }
-    void LRNComputeOutput(float* in, float* scale, float* out) {
+    void LRNComputeOutput(float* in, float* scale, float* out,
+                          float negative_beta) {
       for (int index = 0; index < $compute_global; index++) {
-        out[index] = in[index] * pow(scale[index], (float)$negative_beta);
+        out[index] = in[index] * pow(scale[index], negative_beta);
       }
     }
     """).substitute(width=width, height=height, channels=channels,
-                    local_size=local_size,
-                    alpha_over_size=float(alpha) / local_size,
-                    k=k, negative_beta=-beta, fill_global=fill_global[0],
+                    local_size=local_size, fill_global=fill_global[0],
                     compute_global=compute_global[0])
             lib = hm_compile_and_load(kernel)
             fill_kern = lib.LRNFillScale
@@ -203,12 +218,12 @@ elif backend in {"omp", "openmp"}:
                     scale = symbol_table[sinks[1].name]
                     fill_kern.argtypes = tuple(
                         np.ctypeslib.ndpointer(p.dtype, p.ndim, p.shape)
-                        for p in [bottom, scale])
+                        for p in [bottom, scale]) + (ct.c_float, ct.c_float)
                     compute_kern.argtypes = tuple(
                         np.ctypeslib.ndpointer(p.dtype, p.ndim, p.shape)
-                        for p in [bottom, scale, top])
-                    fill_kern(bottom, scale)
-                    compute_kern(bottom, scale, top)
+                        for p in [bottom, scale, top]) + (ct.c_float, )
+                    fill_kern(bottom, scale, k, alpha_over_size)
+                    compute_kern(bottom, scale, top, negative_beta)
             return LrnLauncher(sources, sinks)
 
 
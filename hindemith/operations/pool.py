@@ -3,10 +3,30 @@ import numpy as np
 from string import Template
 
 
+def get_pooled_shape(shape, keywords):
+    """
+    Return the shape of the result of pooling an array of shape.
+    """
+    num, channels, height, width = shape
+    pad_h, pad_w = keywords['padding']
+    stride_h, stride_w = keywords['stride']
+    kernel_h, kernel_w = keywords['kernel_size']
+    pooled_height = ((height + 2 * pad_h - kernel_h) // stride_h) + 1
+    pooled_width = ((width + 2 * pad_w - kernel_w) // stride_w) + 1
+    return (num, channels, pooled_height, pooled_width)
+
+
 class PoolForward(BlockLevel):
     """
     top, mask = PoolForward(bottom)
     """
+    gather_sources = (0, )
+
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        shape = get_pooled_shape(sources[0].shape, keywords)
+        return [(shape, sources[0].dtype)] * num_sinks
+
     @classmethod
     def get_launch_parameters(cls, sources, sinks):
         num_work_items = np.prod(sinks[0].shape)
@@ -46,15 +66,18 @@ class PoolForward(BlockLevel):
     int offset = (n * $channels + c) * $height * $width;
     for (int h = hstart; h < hend; ++h) {
       for (int w = wstart; w < wend; ++w) {
-        if ($bottom[offset + h * $width + w] > maxval) {
+        float val = $bottom;
+        if (val > maxval) {
           maxidx = h * $width + w;
-          maxval = $bottom[offset + h * $width + w];
+          maxval = val;
         }
       }
     }
     $top = maxval;
     $mask = maxidx;
-""").substitute(top=sinks[0].get_element(), mask=sinks[1].get_element(), bottom=sources[0].name,
+""").substitute(top=sinks[0].get_element(), mask=sinks[1].get_element(),
+                bottom=sources[0].gather(
+                    "offset + h * {} + w".format(width)),
                 pooled_h=pooled_height, pooled_w=pooled_width,
                 channels=channels, stride=stride_h, pad=pad_h,
                 kernel_h=kernel_h, kernel_w=kernel_w,
@@ -65,6 +88,13 @@ class AvePoolForward(BlockLevel):
     """
     top = AvePoolForward(bottom)
     """
+    gather_sources = (0, )
+
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        shape = get_pooled_shape(sources[0].shape, keywords)
+        return [(shape, sources[0].dtype)] * num_sinks
+
     @classmethod
     def get_launch_parameters(cls, sources, sinks):
         num_work_items = np.prod(sinks[0].shape)
@@ -103,11 +133,13 @@ class AvePoolForward(BlockLevel):
     int offset = (n * $channels + c) * $height * $width;
     for (int h = hstart; h < hend; ++h) {
       for (int w = wstart; w < wend; ++w) {
-        aveval += $bottom[offset + h * $width + w];
+        aveval += $bottom;
       }
     }
     $top = aveval / pool_size;
-""").substitute(top=sinks[0].get_element(), bottom=sources[0].name,
+""").substitute(top=sinks[0].get_element(),
+                bottom=sources[0].gather(
+                    "offset + h * {} + w".format(width)),
                 pooled_h=pooled_height, pooled_w=pooled_width,
                 channels=channels, stride=stride_h, pad=pad_h,
                 kernel_h=kernel_h, kernel_w=kernel_w,
@@ -121,6 +153,14 @@ class PoolBackward(BlockLevel):
                                padding=(0, 0),
                                stride=(2, 2))
     """
+    gather_sources = (0, 1)
+
+    @classmethod
+    def infer_outputs(cls, sources, num_sinks, keywords):
+        raise NotImplementedError(
+            "PoolBackward cannot infer the shape of bottom_diff from the "
+            "pooled shape, pass bottom_diff to the composed function")
+
     @classmethod
     def get_launch_parameters(cls, sources, sinks):
         num_work_items = np.prod(sinks[0].shape)
@@ -149,13 +189,17 @@ class PoolBackward(BlockLevel):
     int offset = (n * $channels + c) * $pooled_height * $pooled_width;
     for (int ph = phstart; ph < phend; ++ph) {
       for (int pw = pwstart; pw < pwend; ++pw) {
-        if ($mask[offset + ph * $pooled_width + pw] == h * $width + w) {
-          gradient += $top_diff[offset + ph * $pooled_width + pw];
+        if ($mask == h * $width + w) {
+          gradient += $top_diff;
         }
       }
     }
     $bottom_diff = gradient;
-""").substitute(bottom_diff=sinks[0].get_element(), mask=sources[1].name, top_diff=sources[0].name,
+""").substitute(bottom_diff=sinks[0].get_element(),
+                mask=sources[1].gather(
+                    "offset + ph * {} + pw".format(pooled_width)),
+                top_diff=sources[0].gather(
+                    "offset + ph * {} + pw".format(pooled_width)),
                 pooled_height=pooled_height, pooled_width=pooled_width,
                 channels=channels, stride_h=stride_h,
                 stride_w=stride_w, pad_h=pad_h, pad_w=pad_w,
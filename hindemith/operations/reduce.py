@@ -0,0 +1,57 @@
+from hindemith.operations.core import ReduceLevel
+
+
+class Sum(ReduceLevel):
+    """
+    total = Sum(a), total[0] is the sum of the elements of a.
+    """
+    reduction = "sum"
+    gather_sources = (0, )
+
+
+class Max(ReduceLevel):
+    """
+    largest = Max(a), largest[0] is the largest element of a.
+    """
+    reduction = "max"
+    gather_sources = (0, )
+
+
+class Min(ReduceLevel):
+    """
+    smallest = Min(a), smallest[0] is the smallest element of a.
+    """
+    reduction = "min"
+    gather_sources = (0, )
+
+
+class ArgMax(ReduceLevel):
+    """
+    index = ArgMax(a), index[0] is the flat index of the first largest
+    element of a (a float, exact below 2 ** 24 elements).
+    """
+    reduction = "argmax"
+    gather_sources = (0, )
+
+
+class Norm(ReduceLevel):
+    """
+    norm = Norm(a), norm[0] is the Euclidean norm of the elements of a.
+    """
+    reduction = "norm"
+    gather_sources = (0, )
+
+
+class MaxAbsDiff(ReduceLevel):
+    """
+    change = MaxAbsDiff(a, b), change[0] is the largest absolute difference
+    between the elements of a and b.  Only this one element has to be
+    read back to test for convergence.
+    """
+    reduction = "max"
+    gather_sources = (0, 1)
+
+    @classmethod
+    def element(cls, sources, keywords):
+        return "fabs({} - {})".format(sources[0].gather("index"),
+                                      sources[1].gather("index"))
@@ -7,7 +7,7 @@ from hindemith.cl import hm_compile_and_load
 
 backend = os.getenv("HM_BACKEND", "ocl")
 if backend in {"ocl", "opencl", "OCL"}:
-    from hindemith.cl import context, queue
+    from hindemith.cl import context, queue, build_program
     import pycl as cl
 
 
@@ -89,7 +89,7 @@ if backend in {"ocl", "opencl", "OCL"}:
                     channels=channels, spatial_dim=spatial_dim,
                     dim=np.prod(bottom.shape[1:]))
 
-            program = cl.clCreateProgramWithSource(context, kernels).build()
+            program = build_program(kernels)
             copy_kern = program['kernel_copy']
             copy_kern.argtypes = (cl.cl_mem, cl.cl_mem)
             max_kern = program['kernel_channel_max']
@@ -106,7 +106,9 @@ if backend in {"ocl", "opencl", "OCL"}:
             class SoftmaxLauncher(object):
                 def __init__(self, sources, sinks):
                     self.sources = sources
-                    self.sinks = sources
+                    self.sinks = sinks
+                    # scale is scratch shared by every call
+                    self.scale_evts = []
 
                 def compile(self):
                     pass
@@ -124,7 +126,8 @@ if backend in {"ocl", "opencl", "OCL"}:
                     else:
                         padded_num_times_spatial = num_times_spatial
                     evt = copy_kern(bottom.ocl_buf, top.ocl_buf).on(
-                        queue, (padded_count,), wait_for=wait_for)
+                        queue, (padded_count,),
+                        wait_for=list(wait_for) + self.scale_evts)
                     evt = max_kern(top.ocl_buf, scale.ocl_buf).on(
                         queue, (padded_num_times_spatial, ), wait_for=evt)
                     evt = sub_kern(scale.ocl_buf, top.ocl_buf).on(
@@ -135,6 +138,7 @@ if backend in {"ocl", "opencl", "OCL"}:
                         queue, (padded_num_times_spatial, ), wait_for=evt)
                     evt = div_kern(scale.ocl_buf, top.ocl_buf).on(
                         queue, (padded_count, ), wait_for=evt)
+                    self.scale_evts = [evt]
                     return [evt]
 
             return SoftmaxLauncher(sources, sinks)
@@ -1,6 +1,6 @@
 from hindemith.operations.core import DeviceLevel
 from hindemith.types import hmarray
-from hindemith.cl import queue, context
+from hindemith.cl import queue, context, build_program
 from string import Template
 import numpy as np
 import pycl as cl
@@ -98,7 +98,7 @@ __kernel void SoftmaxLossForward(global const float* prob_data,
                 channels=channels, spatial_dim=spatial_dim,
                 dim=np.prod(bottom.shape[1:]))
 
-        program = cl.clCreateProgramWithSource(context, kernels).build()
+        program = build_program(kernels)
         copy_kern = program['kernel_copy']
         copy_kern.argtypes = (cl.cl_mem, cl.cl_mem)
         max_kern = program['kernel_channel_max']
@@ -177,7 +177,7 @@ __kernel void SoftmaxLossBackwardGPU(global const float* label,
                  dim=np.prod(bottom_diff.shape[1:]),
                  global_size=num*spatial_dim)
 
-        program = cl.clCreateProgramWithSource(context, kernels).build()
+        program = build_program(kernels)
         copy = program['kernel_copy']
         copy.argtypes = (cl.cl_mem, cl.cl_mem)
         scale = program['kernel_scale']
@@ -0,0 +1,179 @@
+"""
+Peephole rewrites of the C code emitted for kernel bodies.
+
+Operations emit code one element at a time and without knowing what they
+are fused with, which leaves expensive operations a compiler for OpenCL
+C is not always allowed (or able) to simplify:
+
+* pow(x, n) with a small integer n becomes a chain of multiplies.
+* Division by a floating point literal becomes a multiply by its
+  reciprocal.  That is exact for powers of two, any other literal
+  rounds differently and is only rewritten under HM_FAST_MATH.
+* Divisions and remainders of the element index by a constant (the
+  decomposition of index into coordinates) that appear more than once in
+  a kernel body are computed once, at the start of the body.
+
+Set HM_PEEPHOLE=0 to emit kernels unchanged.
+"""
+import os
+import re
+
+enabled = os.getenv("HM_PEEPHOLE", "1") not in {"0", "false", "False",
+                                                "off"}
+# Allow rewrites that change rounding, such as dividing by multiplying
+# with a reciprocal
+fast_math = os.getenv("HM_FAST_MATH", "0") not in {"0", "false", "False",
+                                                  "off"}
+
+# Largest exponent pow is unrolled for
+max_pow = 4
+
+simple_operand = re.compile(r"^[A-Za-z_]\w*(\[[^\[\]]*\])?$")
+float_divisor = re.compile(
+    r"/\s*(\d+\.\d*(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)(f?)(?![\w.])")
+# A division or remainder of the index (or of a hoisted decomposition)
+# by an integer
+index_math = re.compile(r"\b(index|_hm_index_\d+)\s*([/%])\s*(\d+)\b")
+
+
+def split_call(code, start):
+    """
+    Return the arguments of the call whose opening parenthesis is at
+    start and the position after its closing parenthesis.
+    """
+    depth = 0
+    args = []
+    arg_start = start + 1
+    for position in range(start, len(code)):
+        char = code[position]
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+            if depth == 0:
+                args.append(code[arg_start:position].strip())
+                return args, position + 1
+        elif char == "," and depth == 1:
+            args.append(code[arg_start:position].strip())
+            arg_start = position + 1
+    return None, None
+
+
+def get_exponent(arg):
+    try:
+        exponent = float(arg.rstrip("f"))
+    except ValueError:
+        return None
+    if exponent != int(exponent) or not 1 <= exponent <= max_pow:
+        return None
+    return int(exponent)
+
+
+def unroll_pow(code):
+    """
+    Replace pow(x, n) of a variable or array element x and a small
+    integer n with multiplies.
+    """
+    result = []
+    position = 0
+    for match in re.finditer(r"\bpow\s*\(", code):
+        if match.start() < position:
+            continue
+        args, end = split_call(code, match.end() - 1)
+        if args is None or len(args) != 2 or \
+                not simple_operand.match(args[0]):
+            continue
+        exponent = get_exponent(args[1])
+        if exponent is None:
+            continue
+        result.append(code[position:match.start()])
+        result.append("(" + " * ".join([args[0]] * exponent) + ")")
+        position = end
+    result.append(code[position:])
+    return "".join(result)
+
+
+def is_power_of_two(value):
+    mantissa = abs(value)
+    while mantissa >= 2.0:
+        mantissa /= 2.0
+    while 0 < mantissa < 1.0:
+        mantissa *= 2.0
+    return mantissa == 1.0
+
+
+def divide_by_reciprocal(code):
+    """
+    Replace division by a floating point literal with multiplication by
+    its reciprocal, when that does not change the result or fast_math is
+    set.
+    """
+    def replace(match):
+        divisor = float(match.group(1))
+        if divisor == 0 or not (fast_math or is_power_of_two(divisor)):
+            return match.group(0)
+        return "* {!r}{}".format(1.0 / divisor, match.group(2))
+    return float_divisor.sub(replace, code)
+
+
+def find_index_math(body):
+    """
+    Return (start, end, expression) for the index decompositions in body
+    that are operands of their own, not the right operand of a
+    multiplication, division or member access (a * index / 4 divides
+    a * index).
+    """
+    found = []
+    for match in index_math.finditer(body):
+        before = body[:match.start()].rstrip()
+        if before and (before[-1] in "*/%.)]" or
+                       before[-1].isalnum() or before[-1] == "_"):
+            continue
+        found.append((match.start(), match.end(), match.groups()))
+    return found
+
+
+def hoist_index_math(body):
+    """
+    Compute the index decompositions body repeats once, in declarations
+    put in front of it.
+    """
+    decls = []
+    names = {}
+    while True:
+        found = find_index_math(body)
+        counts = {}
+        for _, _, expression in found:
+            counts[expression] = counts.get(expression, 0) + 1
+        repeated = [expression for expression, count in counts.items()
+                    if count > 1]
+        if not repeated:
+            break
+        for expression in sorted(repeated):
+            names[expression] = "_hm_index_{}".format(len(names))
+            decls.append("const int {} = {} {} {};".format(
+                names[expression], *expression))
+        for start, end, expression in reversed(found):
+            if expression in names:
+                body = body[:start] + names[expression] + body[end:]
+    if not decls:
+        return body
+    return "\n".join(decls) + "\n" + body
+
+
+def simplify(code):
+    """
+    Rewrite the expressions of code.
+    """
+    if not enabled:
+        return code
+    return divide_by_reciprocal(unroll_pow(code))
+
+
+def optimize(body):
+    """
+    Rewrite the body of a kernel, see the module docstring.
+    """
+    if not enabled:
+        return body
+    return hoist_index_math(simplify(body))
@@ -1,14 +1,38 @@
 import numpy as np
 import pycl as cl
 import os
+import threading
 backend = os.getenv("HM_BACKEND", "ocl")
 
 if backend in {"ocl", "opencl", "OCL"}:
-    from hindemith.cl import context, queue
+    from hindemith.cl import context, queue, QueueScheduler
+
+
+class EventTracker(object):
+    """
+    Events of the commands accessing a device buffer, shared by all the
+    arrays aliasing it (see hmarray.alias).
+    """
+    def __init__(self):
+        self.write_events = []
+        self.read_events = []
+
+
+# Set while hmarray.alias builds a view, its buffer is shared instead of
+# allocated and copied by __array_finalize__
+aliasing = threading.local()
 
 
 class hmarray(np.ndarray):
-    """Subclass of ndarray that has an OpenCL buffer associated with it"""
+    """
+    Subclass of ndarray that has an OpenCL buffer associated with it.
+
+    Device commands run asynchronously, the array tracks the events of the
+    last commands writing its buffer (write_events) and of the commands
+    reading it since (read_events).  Later commands, sync_host and
+    sync_ocl wait on these instead of the host blocking after every
+    launch.
+    """
     def __new__(subtype, shape, dtype=np.float32, buffer=None, offset=0,
                 strides=None, order=None, info=None):
         obj = np.ndarray.__new__(subtype, shape, dtype, buffer,
@@ -18,11 +42,12 @@ class hmarray(np.ndarray):
                 context, np.prod(shape) * obj.itemsize)
             obj.host_dirty = False
             obj.ocl_dirty = False
+        obj.events = EventTracker()
         obj.register = None
         return obj
 
     def __array_finalize__(self, obj):
-        if obj is None:
+        if obj is None or getattr(aliasing, "active", False):
             return
 
         if backend in {"ocl", "opencl", "OCL"}:
@@ -31,16 +56,86 @@ class hmarray(np.ndarray):
             self.ocl_buf = buf
             self.host_dirty = False
             self.ocl_dirty = False
+        self.events = EventTracker()
         self.register = None
 
+    def alias(self, shape, dtype=np.float32):
+        """
+        Return an array of shape and dtype sharing this array's memory on
+        the host and the device, this array must be at least as large.
+        Commands on either array are ordered through shared events.
+        """
+        aliasing.active = True
+        try:
+            obj = np.ndarray.__new__(hmarray, shape, dtype, self)
+        finally:
+            aliasing.active = False
+        if backend in {"ocl", "opencl", "OCL"}:
+            obj.ocl_buf = self.ocl_buf
+            obj.host_dirty = False
+            obj.ocl_dirty = False
+        obj.events = self.events
+        obj.register = None
+        return obj
+
+    @property
+    def write_events(self):
+        return self.events.write_events
+
+    @write_events.setter
+    def write_events(self, events):
+        self.events.write_events = events
+
+    @property
+    def read_events(self):
+        return self.events.read_events
+
+    @read_events.setter
+    def read_events(self, events):
+        self.events.read_events = events
+
+    def get_wait_events(self, write):
+        """
+        Return the events a command accessing the buffer must wait on, a
+        read waits on pending writes, a write also on pending reads.
+        """
+        if write:
+            return self.read_events + self.write_events
+        return list(self.write_events)
+
+    def record_write(self, write_events, read_events=()):
+        """
+        Record that write_events now produce the buffer contents, and that
+        read_events read it afterwards.
+        """
+        self.write_events = list(write_events)
+        self.read_events = list(read_events)
+
+    def record_read(self, read_events):
+        """
+        Record commands reading the buffer.
+        """
+        if len(self.read_events) >= 16:
+            # Arrays that are only ever read (such as weights) would
+            # otherwise accumulate events forever
+            self.read_events = [evt for evt in self.read_events
+                                if not QueueScheduler.is_complete(evt)]
+        self.read_events.extend(read_events)
+
     def sync_host(self):
         if backend in {"ocl", "opencl", "OCL"}:
             if os.environ.get("HM_BACKEND") in {'omp', 'openmp'}:
                 return
-            _, evt = cl.buffer_to_ndarray(queue, self.ocl_buf, self)
+            _, evt = cl.buffer_to_ndarray(queue, self.ocl_buf, self,
+                                          wait_for=self.write_events)
             evt.wait()
+            self.write_events = []
 
     def sync_ocl(self):
         if backend in {"ocl", "opencl", "OCL"}:
-            _, evt = cl.buffer_from_ndarray(queue, self, self.ocl_buf)
+            _, evt = cl.buffer_from_ndarray(
+                queue, self, self.ocl_buf,
+                wait_for=self.get_wait_events(True))
             evt.wait()
+            self.write_events = []
+            self.read_events = []
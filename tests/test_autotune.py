@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import hindemith as hm
+from hindemith import autotune
+from hindemith.core import compose
+from hindemith.operations.array import ArrayAdd, Square
+
+
+def add_square(a, b, c):
+    c = ArrayAdd(a, Square(b))
+    return c
+
+
+class TestAutotune(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = autotune.database
+        self.settings = autotune.enabled, autotune.launches
+        autotune.database = autotune.TuningDatabase(
+            os.path.join(self.directory, "tuning.json"))
+        autotune.enabled, autotune.launches = True, 1
+
+    def tearDown(self):
+        autotune.database = self.database
+        autotune.enabled, autotune.launches = self.settings
+        shutil.rmtree(self.directory)
+
+    def test_tune(self):
+        a = hm.random((16, 12), _range=(0, 1))
+        b = hm.random((16, 12), _range=(0, 1))
+        fn = compose(add_square)
+        c = fn(a, b, hm.zeros(a.shape))
+        c.sync_host()
+        np.testing.assert_allclose(c, a + b * b, rtol=1e-6)
+        kernel = fn.composed.kernels[0]
+        parameters = autotune.database.get(kernel.tuning_key())
+        self.assertEqual(sorted(parameters), sorted(kernel.tunable))
+
+        # A later process finds the entry on disk and generates the kernel
+        # with it, without tuning again
+        parameters = dict((name, values[-1])
+                          for name, values in kernel.tunable.items())
+        autotune.database.set(kernel.tuning_key(), parameters, 0.0)
+        autotune.database = autotune.TuningDatabase(
+            autotune.database.path)
+        fn = compose(add_square)
+        c = fn(a, b, hm.zeros(a.shape))
+        c.sync_host()
+        np.testing.assert_allclose(c, a + b * b, rtol=1e-6)
+        kernel = fn.composed.kernels[0]
+        self.assertFalse(kernel.tune_pending)
+        for name, value in parameters.items():
+            self.assertEqual(getattr(kernel, name), value)
+
+    def test_merge(self):
+        path = autotune.database.path
+        first = autotune.TuningDatabase(path)
+        second = autotune.TuningDatabase(path)
+        first.set("a", {"x": 1}, 1.0)
+        self.assertEqual(second.get("a"), {"x": 1})
+        # An entry another process wrote since is not reverted
+        first.set("a", {"x": 2}, 0.5)
+        second.set("b", {"x": 3}, 1.0)
+        self.assertEqual(autotune.TuningDatabase(path).get("a"), {"x": 2})
+        self.assertEqual(autotune.TuningDatabase(path).get("b"), {"x": 3})
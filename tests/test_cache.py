@@ -0,0 +1,65 @@
+import unittest
+import os
+import shutil
+import tempfile
+from hindemith.cache import KernelCache, make_key
+import hindemith.cl as hmcl
+
+backend = os.getenv("HM_BACKEND", "ocl")
+
+
+class TestKernelCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = KernelCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_make_key(self):
+        self.assertEqual(make_key("a", 1), make_key("a", 1))
+        self.assertNotEqual(make_key("a", 1), make_key("a", 2))
+        self.assertNotEqual(make_key("ab", ""), make_key("a", "b"))
+
+    def test_store_load(self):
+        key = make_key("kernel source")
+        self.assertIsNone(self.cache.load(key, "bin"))
+        self.cache.store(key, "bin", b"\x00binary\x00data")
+        self.assertEqual(self.cache.load(key, "bin"), b"\x00binary\x00data")
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+        # A new process starts with an empty memory cache
+        cache = KernelCache(self.directory)
+        self.assertEqual(cache.load(key, "bin"), b"\x00binary\x00data")
+
+    def test_memory(self):
+        first, second = object(), object()
+        self.assertIs(self.cache.set("key", first), first)
+        self.assertIs(self.cache.set("key", second), first)
+        self.assertIs(self.cache.get("key"), first)
+
+    def test_disabled(self):
+        cache = KernelCache(self.directory, enabled=False)
+        cache.store("key", "bin", b"data")
+        self.assertIsNone(cache.load("key", "bin"))
+
+
+@unittest.skipUnless(backend in {"omp", "openmp"}, "OpenMP backend only")
+class TestCompileAndLoad(unittest.TestCase):
+    def test_deduplicate(self):
+        source = "int hm_test_cache_fn(int x) { return x + 1; }\n"
+        lib = hmcl.hm_compile_and_load(source)
+        self.assertIs(hmcl.hm_compile_and_load(source), lib)
+        self.assertEqual(lib.hm_test_cache_fn(1), 2)
+
+    def test_persistent(self):
+        source = "int hm_test_cache_persist(int x) { return x * 2; }\n"
+        hmcl.hm_compile_and_load(source)
+        key = [k for k, v in hmcl.kernel_cache.memory.items()
+               if hasattr(v, 'hm_test_cache_persist')][0]
+        self.assertTrue(os.path.exists(hmcl.kernel_cache.path(key, "so")))
+        # Simulate a new process, the shared object is loaded from disk
+        del hmcl.kernel_cache.memory[key]
+        lib = hmcl.hm_compile_and_load(source)
+        self.assertEqual(lib.hm_test_cache_persist(2), 4)
@@ -0,0 +1,521 @@
+import hindemith as hm
+from hindemith.core import compose, get_dependencies, \
+    get_buffer_accesses, UnpackBinOps, ValueNumbering, ReplaceArrayOps, \
+    HoistInvariants
+import hindemith.core as hmcore
+from hindemith import peephole
+from hindemith.types import hmarray
+from hindemith.operations.array import ArrayAdd, ArrayScalarMul, Square
+from hindemith.operations.convolve import Convolve2D
+from hindemith.operations.concat import ConcatForward
+from hindemith.operations.reduce import MaxAbsDiff
+from hindemith.memory import MemoryPlan, Placeholder
+import hindemith.cl as hmcl
+from test_convolve import convolve
+import numpy as np
+import unittest
+import ast
+import textwrap
+
+
+class TestPlanCache(unittest.TestCase):
+    def _check(self, actual, expected):
+        np.testing.assert_allclose(actual, expected)
+
+    def test_shapes(self):
+        @compose
+        def fn(a, b):
+            c = ArrayAdd(a, b)
+            return c
+
+        for shape in [(16, 16), (32, 8), (16, 16)]:
+            a = hm.random(shape, _range=(0, 255))
+            b = hm.random(shape, _range=(0, 255))
+            c = fn(a, b)
+            c.sync_host()
+            self.assertEqual(c.shape, shape)
+            self._check(c, a + b)
+        self.assertEqual(fn.plans.misses, 2)
+        self.assertEqual(fn.plans.hits, 1)
+
+    def test_dtypes(self):
+        @compose
+        def fn(a, b):
+            c = ArrayAdd(a, b)
+            return c
+
+        a = hm.random((16, 16), _range=(0, 255))
+        b = hm.random((16, 16), _range=(0, 255))
+        fn(a, b)
+        fn(a.astype(np.float64), b.astype(np.float64))
+        self.assertEqual(fn.plans.misses, 2)
+
+    def test_scalar_values(self):
+        @compose
+        def fn(a, b, scale):
+            b = ArrayScalarMul(a, scale)
+            return b
+
+        a = hm.random((16, 16), _range=(0, 255))
+        b = hm.zeros_like(a)
+        for scale in [2.0, 3.0, 2.0]:
+            b = fn(a, b, scale)
+            b.sync_host()
+            self._check(b, a * scale)
+        self.assertEqual(fn.plans.misses, 2)
+        self.assertEqual(fn.plans.hits, 1)
+
+    def test_eviction(self):
+        @compose(max_plans=1)
+        def fn(a, b):
+            c = ArrayAdd(a, b)
+            return c
+
+        for shape in [(16, 16), (8, 8), (16, 16)]:
+            a = hm.random(shape, _range=(0, 255))
+            c = fn(a, a)
+            c.sync_host()
+            self._check(c, a + a)
+        self.assertEqual(len(fn.plans.plans), 1)
+        self.assertEqual(fn.plans.misses, 3)
+
+    def test_constant_params(self):
+        @compose
+        def fn(data, filters, output):
+            output = Convolve2D(data, filters)
+            return output
+
+        self.assertEqual(fn.plans.constant_params, {'filters'})
+        data = hm.random((8, 8), _range=(0, 1))
+        first = hm.random((3, 3), _range=(-1, 1))
+        second = hm.random((3, 3), _range=(-1, 1))
+        key = fn.plans.get_key((data, first, data), {})
+        self.assertEqual(key, fn.plans.get_key((data, first.copy(), data), {}))
+        self.assertNotEqual(key, fn.plans.get_key((data, second, data), {}))
+        # Only the contents of constants select a plan
+        host = np.asarray(data)
+        self.assertEqual(fn.plans.get_key((host, first, data), {}),
+                         fn.plans.get_key((host * 2, first, data), {}))
+
+    def test_runtime_constants(self):
+        @compose(runtime_constants=True)
+        def scale(a, b, alpha, beta):
+            b = ArrayScalarMul(a, alpha)
+            b = b * beta
+            return b
+
+        self.assertEqual(scale.plans.runtime_params, {'alpha', 'beta'})
+        a = hm.random((16, 16), _range=(0, 255))
+        b = hm.zeros_like(a)
+        for alpha, beta in [(2.0, 0.5), (3.0, 4.0), (-1.5, 2)]:
+            b = scale(a, b, alpha, beta)
+            b.sync_host()
+            self._check(b, a * alpha * beta)
+        self.assertEqual(scale.plans.misses, 2)
+
+        @compose(runtime_constants=True)
+        def fn(data, filters, output):
+            output = Convolve2D(data, filters)
+            return output
+
+        self.assertEqual(fn.plans.constant_params, set())
+        data = hm.random((37, 70), _range=(0, 1))
+        output = hm.zeros_like(data)
+        kernels = None
+        for _ in range(3):
+            filters = np.random.uniform(-1, 1, (3, 5))
+            filters[1, 2] = 0
+            output = fn(data, filters, output)
+            output.sync_host()
+            np.testing.assert_allclose(output, convolve(data, filters),
+                                       rtol=1e-5, atol=1e-5)
+            kernels = kernels or fn.composed.kernels
+            self.assertEqual(fn.composed.kernels, kernels)
+        self.assertEqual(fn.plans.misses, 1)
+
+
+class TestPrecompile(unittest.TestCase):
+    def test_precompile(self):
+        @compose
+        def fn(a, b):
+            c = ArrayAdd(a, b)
+            d = ArrayScalarMul(c, 2.0)
+            return d
+
+        a = hm.random((16, 16), _range=(0, 255))
+        b = hm.random((16, 16), _range=(0, 255))
+        fn.precompile(a, b)
+        self.assertGreater(len(fn.composed.kernels), 0)
+        kernels = list(fn.composed.kernels)
+
+        d = fn(a, b)
+        d.sync_host()
+        np.testing.assert_allclose(d, (a + b) * 2.0)
+        self.assertEqual(fn.plans.hits, 1)
+        hm.synchronize()
+        # Nothing is compiled on the first call
+        self.assertEqual(fn.composed.kernels, kernels)
+
+    def test_parallel_compile(self):
+        @compose
+        def fn(a, b):
+            c = ArrayAdd(a, a)
+            d = ArrayAdd(b, b)
+            return c, d
+
+        # Different launch sizes keep the kernels separate
+        a = hm.random((16, 16), _range=(0, 255))
+        b = hm.random((8, 8), _range=(0, 255))
+        threads = hmcl.compile_threads
+        hmcl.compile_threads = 2
+        try:
+            fn.precompile(a, b)
+        finally:
+            hmcl.compile_threads = threads
+        self.assertEqual(len(fn.composed.kernels), 2)
+        c, d = fn(a, b)
+        c.sync_host()
+        d.sync_host()
+        np.testing.assert_allclose(c, a + a)
+        np.testing.assert_allclose(d, b + b)
+
+
+class TestLaunchPlan(unittest.TestCase):
+    def test_replay(self):
+        @compose
+        def fn(a, b, c):
+            d = ArrayAdd(a, b)
+            c = ArrayAdd(d, a)
+            return c
+
+        arrays = [hm.random((16, 16), _range=(0, 255)) for _ in range(4)]
+        outputs = [hm.zeros((16, 16)) for _ in range(2)]
+        # Swap inputs and outputs between calls, the recorded plan is
+        # rebound instead of recorded again
+        for a, b, c in [(arrays[0], arrays[1], outputs[0]),
+                        (arrays[2], arrays[1], outputs[1]),
+                        (arrays[2], arrays[1], outputs[1]),
+                        (arrays[3], arrays[0], outputs[0])]:
+            fn(a, b, c)
+            c.sync_host()
+            np.testing.assert_allclose(c, a + b + a)
+        self.assertEqual(len(fn.composed.launch_plans), 1)
+        self.assertIs(fn.composed.launch_plans[0].ret, outputs[0])
+
+
+class TestMemoryPlan(unittest.TestCase):
+    def test_assignment(self):
+        placeholders = {
+            'a': Placeholder((25, )),
+            'b': Placeholder((25, )),
+            'c': Placeholder((5, 10), np.uint8),
+            'd': Placeholder((50, )),
+        }
+        plan = MemoryPlan(placeholders, {'a': (0, 1), 'b': (1, 2),
+                                         'c': (2, 3), 'd': (3, 4)})
+        # d does not fit the buffer a and c share, b's buffer grows
+        self.assertEqual(plan.assignment, {'a': 0, 'b': 1, 'c': 0, 'd': 1})
+        self.assertEqual(plan.sizes, [100, 200])
+        self.assertEqual(plan.storage, {'a': 'a', 'b': 'b', 'c': 'a',
+                                        'd': 'b'})
+        self.assertEqual(plan.unplanned_bytes, 450)
+        self.assertEqual(plan.planned_bytes, 300)
+        self.assertEqual(plan.live_bytes, 250)
+
+    def test_alias(self):
+        storage = hm.zeros((100, ))
+        view = storage.alias((5, 10))
+        self.assertEqual(view.shape, (5, 10))
+        self.assertTrue(np.shares_memory(view, storage))
+        self.assertIs(view.events, storage.events)
+        if hasattr(storage, 'ocl_buf'):
+            # The view uses the storage's buffer, none is allocated
+            self.assertIs(view.ocl_buf, storage.ocl_buf)
+
+    def test_reuse(self):
+        @compose
+        def fn(a, out):
+            b = ArrayAdd(a, a)
+            c = ConcatForward(b)
+            d = ArrayAdd(c, c)
+            e = ConcatForward(d)
+            out = ArrayAdd(e, a)
+            return out
+
+        a = hm.random((2, 3, 8, 8), _range=(0, 1))
+        out = hm.zeros(a.shape)
+        for _ in range(2):
+            fn(a, out)
+            out.sync_host()
+            np.testing.assert_allclose(out, a * 5, rtol=1e-5)
+        plan = fn.composed.memory_plan
+        # d reuses the buffer of b, e the buffer of c
+        self.assertEqual(len(plan.sizes), 2)
+        self.assertEqual(plan.storage['d'], plan.storage['b'])
+        self.assertEqual(plan.storage['e'], plan.storage['c'])
+        self.assertEqual(plan.planned_bytes * 2, plan.unplanned_bytes)
+
+    def test_registers(self):
+        @compose
+        def fn(a, filters, out):
+            b = ArrayAdd(a, a)
+            c = ArrayAdd(b, a)
+            d = Convolve2D(c, filters)
+            out = ArrayAdd(d, c)
+            return out
+
+        a = hm.random((16, 16), _range=(0, 1))
+        filters = hm.random((3, 3), _range=(-1, 1))
+        out = hm.zeros(a.shape)
+        fn(a, filters, out)
+        out.sync_host()
+        c = a * 3
+        np.testing.assert_allclose(out, convolve(c, filters) + c, rtol=1e-4,
+                                   atol=1e-6)
+        plan = fn.composed.memory_plan
+        # b never leaves a register, c is gathered by the convolution and
+        # is only allocated when the kernels are built
+        self.assertEqual(plan.registers, {'b', 'c', 'd'})
+        self.assertEqual(plan.materialized, ['c'])
+        self.assertIsInstance(fn.composed.symbol_table['b'], Placeholder)
+
+    def test_escaping(self):
+        @compose
+        def fn(a):
+            b = ArrayAdd(a, a)
+            c = ConcatForward(b)
+            d = ArrayAdd(c, c)
+            return d
+
+        a = hm.random((2, 3, 8, 8), _range=(0, 1))
+        d = fn(a)
+        d.sync_host()
+        np.testing.assert_allclose(d, a * 4, rtol=1e-5)
+        # The returned array keeps a buffer of its own
+        self.assertEqual(fn.composed.memory_plan.unplanned, ['d'])
+
+
+class TestLoopPlan(unittest.TestCase):
+    def test_loop(self):
+        @compose
+        def fn(a, filters, b):
+            for _ in range(5):
+                c = Convolve2D(b, filters)
+                d = ArrayAdd(c, a)
+                b = d
+            return b
+
+        a = hm.random((16, 16), _range=(0, 1))
+        filters = hm.random((3, 3), _range=(-0.2, 0.2))
+        b = fn(a, filters, hm.zeros(a.shape))
+        b.sync_host()
+        expected = np.zeros(a.shape, np.float32)
+        for _ in range(5):
+            expected = convolve(expected, filters) + a
+        np.testing.assert_allclose(b, expected, rtol=1e-4, atol=1e-6)
+        loop_plan = fn.composed.loop_plans[0]
+        self.assertEqual(loop_plan.trip_count, 5)
+        # d is written while the previous d is still gathered as b, it
+        # alternates between two buffers
+        self.assertEqual(loop_plan.partners, {'d'})
+
+    def test_convergence(self):
+        @compose
+        def fixed_point(a, b):
+            change = 1.0
+            while change > 1e-3:
+                c = ArrayScalarMul(b, 0.5)
+                d = ArrayAdd(c, a)
+                change = MaxAbsDiff(d, b)
+                b = d
+            return b
+
+        @compose
+        def limited(a, b):
+            for _ in range(100):
+                c = ArrayScalarMul(b, 0.5)
+                d = ArrayAdd(c, a)
+                change = MaxAbsDiff(d, b)
+                b = d
+                if change < 1e-3:
+                    break
+            return b
+
+        # b converges to 2 * a, halving its distance every iteration
+        a = hm.random((16, 16), _range=(0.5, 1))
+        for fn in [fixed_point, limited]:
+            b = fn(a, hm.zeros(a.shape))
+            b.sync_host()
+            np.testing.assert_allclose(b, a * 2, atol=1e-3)
+            self.assertLess(fn.composed.loop_plans[0].iterations, 20)
+
+    def test_python_loop(self):
+        @compose
+        def fixed_point(a, b):
+            change = 1.0
+            while change > 1e-3:
+                c = ArrayScalarMul(b, 0.5)
+                d = ArrayAdd(c, a)
+                change = MaxAbsDiff(d, b)
+                # Not an operation, the loop runs as Python statements
+                size = np.size(d)
+                b = d
+            return b
+
+        a = hm.random((16, 16), _range=(0.5, 1))
+        b = fixed_point(a, hm.zeros(a.shape))
+        b.sync_host()
+        self.assertEqual(fixed_point.composed.loop_plans, [])
+        # d and b do not share an array, so the change is not 0 after the
+        # first iteration
+        np.testing.assert_allclose(b, a * 2, atol=1e-3)
+
+
+alpha = 3.0
+
+
+class TestValueNumbering(unittest.TestCase):
+    def test_cse(self):
+        a = hm.random((8, 8), _range=(0, 1))
+        symbol_table = dict(vars(hmcore), a=a, b=a)
+        tree = ast.parse(textwrap.dedent("""
+            def fn(a, b):
+                c = a * b + b * a
+                d = a * b - c
+                return d
+            """))
+        tree = UnpackBinOps().visit(tree)
+        tree = ValueNumbering(symbol_table).visit(tree)
+        tree = ReplaceArrayOps(symbol_table).visit(tree)
+        funcs = [statement.value.func.id for statement in tree.body[0].body
+                 if isinstance(statement.value, ast.Call)]
+        self.assertEqual(funcs, ['ArrayMul', 'ArrayAdd', 'ArraySub'])
+
+    def test_fold(self):
+        @compose
+        def fn(a):
+            b = a * (alpha ** 2) + a * (alpha ** 2)
+            c = b - 1.0 / alpha
+            return c
+
+        a = hm.random((8, 8), _range=(0, 1))
+        c = fn(a)
+        c.sync_host()
+        np.testing.assert_allclose(c, a * 18 - 1 / 3.0, rtol=1e-5)
+        # No Python statement is left between the operations
+        self.assertEqual(len(fn.composed.kernels), 1)
+
+
+class TestHoistInvariants(unittest.TestCase):
+    def _hoist(self, source, reciprocals):
+        a = hm.random((8, 8), _range=(1, 2))
+        symbol_table = dict(vars(hmcore), Square=Square, a=a, b=a, d=a)
+        tree = UnpackBinOps().visit(ast.parse(textwrap.dedent(source)))
+        replace_array_ops = ReplaceArrayOps(symbol_table)
+        tree = replace_array_ops.visit(tree)
+        tree = HoistInvariants(symbol_table, replace_array_ops.placeholders,
+                               reciprocals).visit(tree)
+        return tree.body[0].body
+
+    def test_hoist(self):
+        body = self._hoist("""
+            def fn(a, b, d):
+                for _ in range(4):
+                    e = Square(a)
+                    f = ArrayScalarMul(a, 2.0)
+                    g = e + f
+                    h = b / d
+                    b = h + g
+                return b
+            """, False)
+        # e, f and g only depend on a, 2.0 is the literal passed to f
+        self.assertEqual([ast.dump(statement.targets[0])
+                          for statement in body[:4]],
+                         [ast.dump(ast.Name(name, ast.Store()))
+                          for name in ['e', '_hm_generated_0', 'f', 'g']])
+        loop = body[4]
+        self.assertEqual([statement.value.func.id for statement in loop.body],
+                         ['ArrayDiv', 'ArrayAdd'])
+
+    def test_reciprocal(self):
+        body = self._hoist("""
+            def fn(b, d):
+                for _ in range(4):
+                    h = b / d
+                    b = h + d
+                return b
+            """, True)
+        self.assertEqual(body[0].value.func.id, 'Reciprocal')
+        self.assertEqual(body[1].body[0].value.func.id, 'ArrayMul')
+        self.assertEqual(body[1].body[0].value.args[1].id,
+                         body[0].targets[0].id)
+
+    def test_fast_math(self):
+        @compose
+        def fn(a, b, d):
+            for _ in range(4):
+                h = b / d
+                b = h + a
+            return b
+
+        a = hm.random((8, 8), _range=(0, 1))
+        d = hm.random((8, 8), _range=(1, 2))
+        fast_math = peephole.fast_math
+        peephole.fast_math = True
+        try:
+            b = fn(a, hm.zeros(a.shape), d)
+        finally:
+            peephole.fast_math = fast_math
+        b.sync_host()
+        expected = np.zeros(a.shape, np.float32)
+        for _ in range(4):
+            expected = expected / d + a
+        np.testing.assert_allclose(b, expected, rtol=1e-5)
+
+
+class FakeKernel(object):
+    class Param(object):
+        def __init__(self, name):
+            self.name = name
+            self.level = 'buffer'
+
+    def __init__(self, sources, sinks):
+        self.sources = set(self.Param(name) for name in sources)
+        self.sinks = set(self.Param(name) for name in sinks)
+
+
+class TestDependencies(unittest.TestCase):
+    def test_hazards(self):
+        kernels = [
+            FakeKernel(['a'], ['b']),  # 0
+            FakeKernel(['b'], ['c']),  # 1 RAW on b
+            FakeKernel(['d'], ['a']),  # 2 WAR on a
+            FakeKernel(['e'], ['c']),  # 3 WAW on c
+            FakeKernel(['d'], ['f']),  # 4 independent
+        ]
+        self.assertEqual(get_dependencies(kernels),
+                         [[], [0], [0], [1], []])
+
+    def test_transitive_reduction(self):
+        kernels = [
+            FakeKernel(['a'], ['b']),
+            FakeKernel(['b'], ['c']),
+            FakeKernel(['b', 'c'], ['d']),
+        ]
+        # 2 -> 0 is implied by 2 -> 1 -> 0
+        self.assertEqual(get_dependencies(kernels), [[], [0], [1]])
+
+    def test_buffer_accesses(self):
+        kernels = [
+            FakeKernel(['a'], ['b']),
+            FakeKernel(['b', 'c'], ['a']),
+            FakeKernel(['b'], ['d']),
+        ]
+        external, accesses = get_buffer_accesses(kernels)
+        # b is produced inside the block, a is only read before it is
+        # written so its writer still waits on readers from earlier blocks
+        self.assertEqual(external, [[('a', False), ('b', True)],
+                                    [('a', True), ('c', False)],
+                                    [('d', True)]])
+        self.assertEqual(accesses, [('a', 1, []), ('b', 0, [1, 2]),
+                                    ('c', None, [1]), ('d', 2, [])])
@@ -5,6 +5,7 @@ import hindemith as hm
 from hindemith.types import hmarray
 from hindemith.core import compose
 from hindemith.operations.convolve import Convolve2D
+from hindemith.operations.array import ArrayAdd
 import numpy as np
 
 
@@ -41,3 +42,85 @@ class TestConvolve(unittest.TestCase):
         # np.testing.assert_array_almost_equal(output[2:-2, 2:-2], expected[2:-2, 2:-2], decimal=4)
         np.testing.assert_array_almost_equal(output, expected, decimal=4)
 
+
+
+class TestConvolveFusion(unittest.TestCase):
+    def test_inlined_producer(self):
+        @compose
+        def fn(a, b, filters, output):
+            c = ArrayAdd(a, b)
+            output = Convolve2D(c, filters)
+            return output
+
+        a = hm.random((16, 16), _range=(0, 1))
+        b = hm.random((16, 16), _range=(0, 1))
+        filters = hm.random((3, 3), _range=(-1, 1))
+        output = hm.zeros((16, 16))
+        fn(a, b, filters, output)
+        output.sync_host()
+        np.testing.assert_array_almost_equal(
+            output, convolve(a + b, filters), decimal=4)
+        self.assertEqual(len(fn.composed.kernels), 1)
+
+    def test_live_producer(self):
+        # c is returned so it is computed in a kernel of its own, the
+        # convolution reads it once every work item has written it
+        @compose
+        def fn(a, b, filters, c, output):
+            c = ArrayAdd(a, b)
+            output = Convolve2D(c, filters)
+            return c, output
+
+        a = hm.random((16, 16), _range=(0, 1))
+        b = hm.random((16, 16), _range=(0, 1))
+        filters = hm.random((3, 3), _range=(-1, 1))
+        c = hm.zeros((16, 16))
+        output = hm.zeros((16, 16))
+        fn(a, b, filters, c, output)
+        output.sync_host()
+        np.testing.assert_array_almost_equal(
+            output, convolve(a + b, filters), decimal=4)
+        self.assertEqual(len(fn.composed.kernels), 2)
+
+    def test_stencil_kernel(self):
+        # Two stencils over an array that no tile shape divides share a
+        # kernel, clamped at the edges for every tile shape
+        @compose
+        def fn(a, b, dx, jacobi, output):
+            c = ArrayAdd(a, b)
+            d = Convolve2D(c, dx)
+            e = Convolve2D(b, jacobi)
+            output = d + e
+            return output
+
+        a = hm.random((37, 70), _range=(0, 1))
+        b = hm.random((37, 70), _range=(0, 1))
+        dx = hm.random((1, 5), _range=(-1, 1))
+        jacobi = hm.random((3, 3), _range=(-1, 1))
+        expected = convolve(a + b, dx) + convolve(b, jacobi)
+        fn(a, b, dx, jacobi, hm.zeros(a.shape))
+        self.assertEqual(len(fn.composed.kernels), 1)
+        kernel = fn.composed.kernels[0]
+        for tile_shape in kernel.tunable["tile_shape"]:
+            kernel.configure(tile_shape=tile_shape)
+            output = fn(a, b, dx, jacobi, hm.zeros(a.shape))
+            output.sync_host()
+            np.testing.assert_array_almost_equal(output, expected, decimal=4)
+
+    def test_separable(self):
+        # A rank 1 filter is applied as a row pass and a column pass
+        @compose
+        def fn(a, filters, output):
+            output = Convolve2D(a, filters)
+            return output
+
+        a = hm.random((37, 70), _range=(0, 1))
+        column = np.array([[1.0], [4.0], [6.0], [4.0], [1.0]]) / 16
+        row = np.array([[1.0, 2.0, 1.0]]) / 4
+        for filters, num_kernels in ((column * row, 2),
+                                     (column * row + 0.1, 1)):
+            output = fn(a, filters, hm.zeros(a.shape))
+            output.sync_host()
+            np.testing.assert_array_almost_equal(
+                output, convolve(a, filters), decimal=4)
+            self.assertEqual(len(fn.composed.kernels), num_kernels)
@@ -0,0 +1,25 @@
+import unittest
+import numpy as np
+import hindemith as hm
+from hindemith.core import compose
+from hindemith.operations.dropout import Dropout
+
+
+class TestDropout(unittest.TestCase):
+    def test_scale(self):
+        @compose(runtime_constants=True)
+        def fn(top, bottom, mask, scale):
+            top = Dropout(bottom, mask, scale)
+            return top
+
+        bottom = hm.random((4, 8, 6), _range=(-1, 1))
+        mask = hm.random((4, 8, 6), _range=(0, 1))
+        top = hm.zeros_like(bottom)
+        for threshold in (0.5, 0.25):
+            scale = 1.0 / (1.0 - threshold)
+            top = fn(top, bottom, mask, scale)
+            top.sync_host()
+            np.testing.assert_allclose(top, bottom * mask * scale,
+                                       rtol=1e-6)
+        # The scale is a kernel argument, not part of the plan
+        self.assertEqual(fn.plans.misses, 1)
@@ -0,0 +1,165 @@
+"""
+Event ordering tests.  Run with HM_QUEUE_MODE=out_of_order these check that
+every operation threads its events through correctly, since nothing but
+the event graph orders commands on an out-of-order queue.  Each composed
+function chains operations with read-after-write and write-after-read
+hazards between them and is called repeatedly to expose races.
+"""
+import unittest
+import os
+import numpy as np
+import hindemith as hm
+from hindemith.core import compose
+from hindemith.operations.array import ArrayAdd, ArrayScalarMul
+from hindemith.operations.relu import ReluForward
+from test_conv import reference_conv
+from test_lrn import reference_lrn, alpha, beta, local_size
+
+backend = os.getenv("HM_BACKEND", "ocl")
+if backend in {"ocl", "opencl", "OCL"}:
+    from hindemith.operations.conv import ConvForward
+    from hindemith.operations.lrn import LrnForward
+    from hindemith.operations.softmax import SoftmaxForward
+    from hindemith.operations.concat import ConcatForward
+
+iterations = 5
+
+
+def reference_softmax(bottom):
+    exp = np.exp(bottom - np.max(bottom, axis=1, keepdims=True))
+    return exp / np.sum(exp, axis=1, keepdims=True)
+
+
+@unittest.skipUnless(backend in {"ocl", "opencl", "OCL"},
+                     "OpenCL backend only")
+class TestEventOrdering(unittest.TestCase):
+    def test_conv_relu_lrn(self):
+        @compose
+        def fn(a, weights, bias, conv, relu, top, scale):
+            conv = ConvForward(a, weights, bias, kernel_size=(5, 5),
+                               padding=(0, 0), stride=(2, 2))
+            relu = ReluForward(conv)
+            top, scale = LrnForward(relu, alpha=alpha, beta=beta,
+                                    local_size=local_size, k=1)
+            return top, scale
+
+        # More batch items than queues, col buffers are reused
+        a = hm.random((10, 3, 15, 15), _range=(0, 1))
+        weights = hm.random((8, 75), _range=(-.2, .2))
+        bias = hm.random((8, ))
+        conv = hm.zeros((10, 8, 6, 6))
+        relu = hm.zeros((10, 8, 6, 6))
+        top = hm.zeros((10, 8, 6, 6))
+        scale = hm.zeros((10, 8, 6, 6))
+
+        expected = np.zeros((10, 8, 6, 6), np.float32)
+        reference_conv(a, weights.reshape(8, 3, 5, 5), bias, expected,
+                       (2, 2), (0, 0))
+        expected = reference_lrn(np.maximum(expected, 0))
+        for _ in range(iterations):
+            top.fill(0)
+            top.sync_ocl()
+            fn(a, weights, bias, conv, relu, top, scale)
+            top.sync_host()
+            np.testing.assert_array_almost_equal(top, expected, decimal=2)
+
+    def test_elementwise_softmax(self):
+        @compose
+        def fn(a, b, top):
+            b = ArrayScalarMul(a, 2.0)
+            top = SoftmaxForward(b)
+            return top
+
+        a = hm.random((16, 10, 4), _range=(-2, 2))
+        b = hm.zeros(a.shape)
+        top = hm.zeros(a.shape)
+        for _ in range(iterations):
+            top.fill(0)
+            top.sync_ocl()
+            fn(a, b, top)
+            top.sync_host()
+            np.testing.assert_array_almost_equal(
+                top, reference_softmax(a * 2.0), decimal=4)
+
+    def test_elementwise_concat(self):
+        @compose
+        def fn(a, b, a2, b2, top):
+            a2 = ArrayAdd(a, a)
+            b2 = ArrayScalarMul(b, 3.0)
+            top = ConcatForward(a2, b2)
+            return top
+
+        a = hm.random((4, 6, 8, 8))
+        b = hm.random((4, 2, 8, 8))
+        a2 = hm.zeros(a.shape)
+        b2 = hm.zeros(b.shape)
+        top = hm.zeros((4, 8, 8, 8))
+        for _ in range(iterations):
+            top.fill(0)
+            top.sync_ocl()
+            fn(a, b, a2, b2, top)
+            top.sync_host()
+            np.testing.assert_array_almost_equal(top[:, :6], a + a)
+            np.testing.assert_array_almost_equal(top[:, 6:], b * 3.0)
+
+    def test_write_after_read(self):
+        @compose
+        def fn(a, b, c):
+            c = ArrayAdd(a, a)
+            a = SoftmaxForward(b)
+            return c, a
+
+        b = hm.random((16, 10, 4), _range=(-2, 2))
+        c = hm.zeros(b.shape)
+        for _ in range(iterations):
+            a = hm.random(b.shape, _range=(-2, 2))
+            expected = a * 2
+            fn(a, b, c)
+            c.sync_host()
+            a.sync_host()
+            np.testing.assert_array_almost_equal(c, expected)
+            np.testing.assert_array_almost_equal(a, reference_softmax(b),
+                                                 decimal=4)
+
+    def test_fused_chain(self):
+        @compose
+        def fn(a, b, c):
+            d = ArrayAdd(a, b)
+            e = ArrayScalarMul(d, 0.5)
+            c = ReluForward(e)
+            return c
+
+        a = hm.random((64, 64), _range=(-1, 1))
+        b = hm.random((64, 64), _range=(-1, 1))
+        c = hm.zeros((64, 64))
+        for _ in range(iterations):
+            fn(a, b, c)
+            c.sync_host()
+            np.testing.assert_array_almost_equal(
+                c, np.maximum((a + b) * 0.5, 0))
+
+    def test_across_calls(self):
+        # Blocks do not block the host, the next call orders itself after
+        # the previous one through the events recorded on the arrays
+        @compose
+        def scale(a, b):
+            b = ArrayScalarMul(a, 2.0)
+            return b
+
+        @compose
+        def softmax(b, top):
+            top = SoftmaxForward(b)
+            return top
+
+        a = hm.random((16, 10, 4), _range=(-2, 2))
+        b = hm.zeros(a.shape)
+        top = hm.zeros(a.shape)
+        for _ in range(iterations):
+            scale(a, b)
+            softmax(b, top)
+            scale(top, b)
+        b.sync_host()
+        np.testing.assert_array_almost_equal(
+            b, reference_softmax(a * 2.0) * 2.0, decimal=4)
+        hm.synchronize()
+        self.assertEqual(b.write_events, [])
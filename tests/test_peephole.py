@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+import hindemith as hm
+from hindemith import peephole
+from hindemith.core import compose
+from hindemith.operations.array import Square, ArrayScalarDiv
+
+
+class TestPeephole(unittest.TestCase):
+    def test_pow(self):
+        self.assertEqual(
+            peephole.simplify("b[index] = pow(a[index], 2) + pow(t, 3.0);"),
+            "b[index] = (a[index] * a[index]) + (t * t * t);")
+        # Not a small integer exponent or not a plain operand
+        code = "b = pow(a, 0.5) + pow(a, 8) + pow(f(a), 2);"
+        self.assertEqual(peephole.simplify(code), code)
+
+    def test_reciprocal(self):
+        code = "b = a / 4.0 + c / 3.0f + index / 4;"
+        self.assertEqual(peephole.simplify(code),
+                         "b = a * 0.25 + c / 3.0f + index / 4;")
+        fast_math = peephole.fast_math
+        peephole.fast_math = True
+        try:
+            self.assertEqual(peephole.simplify("c / 3.0f"),
+                             "c * {!r}f".format(1 / 3.0))
+        finally:
+            peephole.fast_math = fast_math
+
+    def test_index_math(self):
+        body = peephole.optimize(
+            "int w = index % 8;\n"
+            "int h = (index / 8) % 4;\n"
+            "int n = index / 8 / 4;\n"
+            "int a = k * index / 8;\n")
+        self.assertEqual(body,
+                         "const int _hm_index_0 = index / 8;\n"
+                         "int w = index % 8;\n"
+                         "int h = (_hm_index_0) % 4;\n"
+                         "int n = _hm_index_0 / 4;\n"
+                         "int a = k * index / 8;\n")
+
+    def test_kernels(self):
+        @compose
+        def fn(a, b):
+            c = Square(a)
+            b = ArrayScalarDiv(c, 2.0)
+            return b
+
+        a = hm.random((16, 16), _range=(0, 4))
+        b = fn(a, hm.zeros(a.shape))
+        b.sync_host()
+        np.testing.assert_allclose(b, a * a / 2.0, rtol=1e-6)
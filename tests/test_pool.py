@@ -4,6 +4,8 @@ import hindemith as hm
 from hindemith.types import hmarray
 from hindemith.operations.pool import PoolForward, PoolBackward, AvePoolForward
 from hindemith.core import compose
+from hindemith.operations.relu import ReluForward
+from hindemith.operations.array import ArrayAdd
 
 
 def reference_pool(data, output, mask, kernel_size, stride, pad):
@@ -120,3 +122,32 @@ class TestPool(unittest.TestCase):
         actual.sync_host()
         reference_ave_pool(a, expected, (2, 2), (2, 2), (0, 0))
         self._check(actual, expected)
+
+
+class TestPoolFusion(unittest.TestCase):
+    def test_fused(self):
+        @compose
+        def fn(bottom, pooled, mask, top):
+            relu = ReluForward(bottom)
+            pooled, mask = PoolForward(relu, kernel_size=(2, 2),
+                                       padding=(0, 0), stride=(2, 2))
+            top = ArrayAdd(pooled, pooled)
+            return top
+
+        bottom = hm.random((2, 4, 8, 8), _range=(-1, 1))
+        pooled = hm.zeros((2, 4, 4, 4))
+        mask = hm.zeros((2, 4, 4, 4))
+        top = hm.zeros((2, 4, 4, 4))
+        fn(bottom, pooled, mask, top)
+        top.sync_host()
+        expected = hmarray((2, 4, 4, 4))
+        expected.fill(float('-inf'))
+        reference_pool(np.maximum(bottom, 0), expected,
+                       np.zeros(expected.shape), (2, 2), (2, 2), (0, 0))
+        np.testing.assert_array_almost_equal(top, expected * 2)
+        # The ReLU is computed at the gather sites and the add runs on
+        # the pooled register, neither gets a kernel of its own
+        self.assertEqual(len(fn.composed.kernels), 1)
+        self.assertEqual(
+            sorted(param.name for param in fn.composed.kernels[0].params),
+            ['bottom', 'top'])
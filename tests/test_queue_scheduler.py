@@ -0,0 +1,72 @@
+import unittest
+import pycl as cl
+from hindemith.cl import QueueScheduler
+
+
+class FakeQueue(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeEvent(object):
+    def __init__(self, queue, status=cl.CL_QUEUED):
+        self.queue = queue
+        self.status = status
+
+
+class TestQueueScheduler(unittest.TestCase):
+    def setUp(self):
+        self.queues = [FakeQueue(i + 1) for i in range(3)]
+        self.scheduler = QueueScheduler(self.queues)
+
+    def test_spread_independent(self):
+        chosen = []
+        for _ in range(3):
+            queue, wait_for = self.scheduler.get_queue([])
+            self.scheduler.submitted(queue, [FakeEvent(queue)])
+            chosen.append(queue)
+        self.assertEqual(chosen, self.queues)
+
+    def test_chain_stays_on_queue(self):
+        queue, _ = self.scheduler.get_queue()
+        evt = FakeEvent(queue)
+        self.scheduler.submitted(queue, [evt])
+        next_queue, wait_for = self.scheduler.get_queue([evt])
+        self.assertIs(next_queue, queue)
+        # Ordering is provided by the in-order queue
+        self.assertEqual(wait_for, [])
+
+    def test_join_waits_on_other_queues(self):
+        first = FakeEvent(self.queues[0])
+        second = FakeEvent(self.queues[1])
+        third = FakeEvent(self.queues[1])
+        queue, wait_for = self.scheduler.get_queue([first, second, third])
+        self.assertIs(queue, self.queues[1])
+        self.assertEqual(wait_for, [first])
+
+    def test_least_loaded(self):
+        busy = self.queues[0]
+        for _ in range(4):
+            self.scheduler.submitted(busy, [FakeEvent(busy)])
+        self.scheduler.submitted(self.queues[1],
+                                 [FakeEvent(self.queues[1], cl.CL_COMPLETE)])
+        self.scheduler.next = 0
+        queue, _ = self.scheduler.get_queue()
+        self.assertIs(queue, self.queues[1])
+        self.assertEqual(self.scheduler.pending(1), 0)
+        self.assertEqual(self.scheduler.pending(0), 4)
+
+    def test_release_completed(self):
+        for in_order in (True, False):
+            scheduler = QueueScheduler(self.queues[:1], in_order=in_order)
+            queue = self.queues[0]
+            wait_for = []
+            for _ in range(5000):
+                queue, _ = scheduler.get_queue(wait_for)
+                wait_for = [FakeEvent(queue, cl.CL_COMPLETE)]
+                scheduler.submitted(queue, wait_for)
+            self.assertEqual(len(scheduler.outstanding[0]), 0)
+            for _ in range(5000):
+                scheduler.submitted(queue, [FakeEvent(queue)])
+            self.assertEqual(len(scheduler.outstanding[0]),
+                             QueueScheduler.max_outstanding)
@@ -0,0 +1,70 @@
+import unittest
+import numpy as np
+import hindemith as hm
+from hindemith.core import compose
+from hindemith.operations.reduce import Sum, Max, Min, ArgMax, Norm, \
+    MaxAbsDiff
+
+
+class TestReduce(unittest.TestCase):
+    def test_reductions(self):
+        @compose
+        def fn(a):
+            total = Sum(a)
+            largest = Max(a)
+            smallest = Min(a)
+            index = ArgMax(a)
+            norm = Norm(a)
+            return total, largest, smallest, index, norm
+
+        a = hm.random((37, 53), _range=(-1, 1))
+        a[5, 7] = 3.0
+        a[20, 1] = 3.0
+        a.sync_ocl()
+        results = fn(a)
+        for value in results:
+            value.sync_host()
+        total, largest, smallest, index, norm = results
+        np.testing.assert_allclose(total, np.sum(a, dtype=np.float64),
+                                   rtol=1e-4)
+        self.assertEqual(largest[0], 3.0)
+        self.assertEqual(smallest[0], a.min())
+        self.assertEqual(index[0], 5 * 53 + 7)
+        np.testing.assert_allclose(norm, np.linalg.norm(a), rtol=1e-5)
+
+    def test_fused(self):
+        @compose
+        def fn(a, b):
+            change = MaxAbsDiff(a, b)
+            norm = Norm(a - b * 2.0)
+            return change, norm
+
+        a = hm.random((1000, ), _range=(0, 1))
+        b = hm.random((1000, ), _range=(0, 1))
+        change, norm = fn(a, b)
+        change.sync_host()
+        norm.sync_host()
+        np.testing.assert_allclose(change, np.abs(a - b).max(), rtol=1e-6)
+        np.testing.assert_allclose(norm, np.linalg.norm(a - b * 2.0),
+                                   rtol=1e-5)
+        # a - b * 2.0 is computed inside the reduction, not in a kernel of
+        # its own
+        self.assertEqual(len(fn.composed.kernels), 2)
+
+    def test_tuning_key(self):
+        @compose
+        def total(a):
+            s = Sum(a)
+            return s
+
+        @compose
+        def largest(a):
+            s = Max(a)
+            return s
+
+        a = hm.random((64, ), _range=(0, 1))
+        keys = []
+        for fn in (total, largest):
+            fn(a).sync_host()
+            keys.append(fn.composed.kernels[0].tuning_key())
+        self.assertNotEqual(keys[0], keys[1])
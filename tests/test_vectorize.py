@@ -0,0 +1,63 @@
+import unittest
+import numpy as np
+import hindemith as hm
+import hindemith.cl as hmcl
+from hindemith.cl import vectorize
+from hindemith.core import compose
+from hindemith.operations.array import ArrayAdd, Square, Sqrt
+
+
+class TestVectorize(unittest.TestCase):
+    def test_vectorize(self):
+        self.assertEqual(
+            vectorize("t = a[index] * 0.5;\n"
+                      "b[index] = max(t, 0.0) + c[index] * 2;\n", 4),
+            "\t\t\tt = vload4(index, a) * 0.5f;\n"
+            "\t\t\tvstore4(max(t, 0.0f) + vload4(index, c) * 2, index, b);\n")
+        # Selects, neighbours, updates and index arithmetic stay scalar
+        for body in ["b[index] = a[index] > 0 ? 1.0 : 0.0;",
+                     "b[index] = a[index + 1];",
+                     "b[index] += a[index];",
+                     "const int _hm_index_0 = index / 8;"]:
+            self.assertIsNone(vectorize(body, 4))
+
+    def test_kernels(self):
+        # 7 * 9 elements leave a tail of 3 for a width of 4
+        width = hmcl.vector_width
+        hmcl.vector_width = 4
+        try:
+            @compose
+            def fn(a, b, c):
+                d = ArrayAdd(a, b)
+                c = Sqrt(Square(d))
+                return c
+
+            a = hm.random((7, 9), _range=(0, 1))
+            b = hm.random((7, 9), _range=(0, 1))
+            c = fn(a, b, hm.zeros(a.shape))
+            c.sync_host()
+            np.testing.assert_allclose(c, a + b, rtol=1e-6)
+            for kernel in fn.composed.kernels:
+                self.assertEqual(kernel.vector_width, 4)
+        finally:
+            hmcl.vector_width = width
+
+    def test_configure(self):
+        @compose
+        def fn(a, b, c):
+            c = ArrayAdd(a, Square(b))
+            return c
+
+        a = hm.random((7, 9), _range=(0, 1))
+        b = hm.random((7, 9), _range=(0, 1))
+        c = hm.zeros(a.shape)
+        fn(a, b, c)
+        # The largest value of every parameter the backend can tune
+        for kernel in fn.composed.kernels:
+            kernel.configure(**dict((name, values[-1]) for name, values
+                                    in kernel.tunable.items()))
+        c = fn(a, b, hm.zeros(a.shape))
+        c.sync_host()
+        np.testing.assert_allclose(c, a + b * b, rtol=1e-6)
+        with self.assertRaises(ValueError):
+            fn.composed.kernels[0].configure(tile_size=8)